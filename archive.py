@@ -0,0 +1,137 @@
+"""
+Archive pipeline: buffers crawled documents and writes them to an archive backend in the background
+"""
+
+import asyncio
+import logging
+import time
+import zlib
+from typing import Dict, List
+
+from backends import ArchiveBackend, MongoArchive
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ('zlib', 'zstd')
+
+_CLOSE = object()
+
+
+def compress(data: str, compression: str) -> bytes:
+    raw = data.encode('utf8')
+    if compression == 'zlib':
+        return zlib.compress(raw)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd compression requires the zstandard package')
+        return zstandard.ZstdCompressor().compress(raw)
+    raise ValueError('Unknown compression {}'.format(compression))
+
+
+def decompress(data: bytes, compression: str) -> str:
+    if compression == 'zlib':
+        raw = zlib.decompress(data)
+    elif compression == 'zstd':
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError('Unknown compression {}'.format(compression))
+    return raw.decode('utf8')
+
+
+class ArchiveWriter:
+    """Writes documents to an archive backend in bulks, upserting them by _id. A MongoDB collection may be given
+    instead of a backend.
+
+    Documents are buffered (at most max_buffer of them, put waits when the buffer is full so that the crawl slows
+    down instead of growing the memory) and flushed by a background task when flush_size documents are waiting or
+    flush_interval seconds after the first one arrived. The body_field of each document can be compressed. Set
+    blocking for a pymongo collection, whose writes then run in the default executor, instead of a motor one.
+    close must be awaited to flush the remaining documents. The flushes are recorded in metrics, if given.
+    """
+
+    def __init__(self, backend, max_buffer: int = 1000, flush_size: int = 100, flush_interval: float = 5.,
+                 compression: str = None, body_field: str = 'text', blocking: bool = False, metrics=None):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression {}'.format(compression))
+        if not isinstance(backend, ArchiveBackend):
+            backend = MongoArchive(backend, blocking=blocking)
+        self.backend = backend
+        self.max_buffer = max_buffer
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.body_field = body_field
+        self.metrics = metrics
+        self.n_written = 0
+        self._queue = None
+        self._task = None
+
+    def __repr__(self):
+        return 'ArchiveWriter object: {} documents written'.format(self.n_written)
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def put(self, doc: Dict):
+        """Adds a document to the buffer, waiting if it is full"""
+
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_buffer)
+            self._task = asyncio.ensure_future(self._run())
+        if self.compression and isinstance(doc.get(self.body_field), str):
+            doc[self.body_field] = compress(doc[self.body_field], self.compression)
+            doc['compression'] = self.compression
+        await self._queue.put(doc)
+
+    async def close(self):
+        """Flushes the buffered documents and stops the writer"""
+
+        if self._task is None:
+            return
+        await self._queue.put(_CLOSE)
+        await self._task
+        self._task = None
+        await self.backend.close()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0., deadline - loop.time())
+            try:
+                doc = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                doc = None
+            if doc is _CLOSE:
+                await self._flush(batch)
+                return
+            if doc is not None:
+                batch.append(doc)
+                if deadline is None:
+                    deadline = loop.time() + self.flush_interval
+            if batch and (doc is None or len(batch) >= self.flush_size):
+                await self._flush(batch)
+                batch = []
+                deadline = None
+
+    async def _flush(self, batch: List[Dict]):
+        if not batch:
+            return
+        start = time.monotonic()
+        try:
+            await self.backend.write(batch)
+        except Exception as exc:
+            logging.error('Could not write {} documents: {}'.format(len(batch), exc))
+            if self.metrics:
+                self.metrics.counter('archive_errors_total', 'Failed archive bulk writes').inc()
+            return
+        elapsed = time.monotonic() - start
+        self.n_written += len(batch)
+        if self.metrics:
+            self.metrics.histogram('archive_flush_seconds', 'Duration of the archive bulk writes').observe(elapsed)
+            self.metrics.counter('archived_documents_total', 'Documents written to the archive').inc(len(batch))
+        logging.debug('Wrote {} documents in {:.3f}s'.format(len(batch), elapsed))
@@ -0,0 +1,223 @@
+"""
+Storage backends of the crawl
+
+The crawl state (the 'to_crawl' and 'crawled' sets, the leases, the frontier checkpoints...) is kept by a StateBackend,
+which hands out connections understanding the subset of the Redis commands implemented by memory.MemoryRedis:
+RedisState keeps it in Redis, to be shared by several processes, MemoryState in the crawl process, saved to a
+snapshot file. The crawled documents are written by an ArchiveBackend: MongoArchive upserts them in a MongoDB
+collection, JsonlArchive appends them to gzip compressed JSON lines segment files, for single box crawls which do not
+want to wait for network round trips.
+"""
+
+import asyncio
+import base64
+import functools
+import glob
+import gzip
+import json
+import logging
+import os
+from typing import Dict, List
+
+import aioredis
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from memory import MemoryPool, MemoryRedis
+
+
+class StateBackend:
+    """Interface of the crawl state backends"""
+
+    async def open(self):
+        """Returns a pool whose get() method is an async context manager yielding a connection"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class RedisState(StateBackend):
+
+    def __init__(self, address: tuple = ('localhost', 6389), minsize: int = 5, maxsize: int = 100):
+        self.address = address
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.pool = None
+
+    def __repr__(self):
+        return 'RedisState object: {}:{}'.format(*self.address)
+
+    async def open(self):
+        if self.pool is None:
+            self.pool = await aioredis.create_pool(self.address, minsize=self.minsize, maxsize=self.maxsize,
+                                                   encoding='utf-8')
+        return self.pool
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+
+class MemoryState(StateBackend):
+    """Crawl state kept in the process. If path is given, the state is loaded from this gzip compressed JSON snapshot
+    and saved to it on close and every snapshot_interval seconds."""
+
+    def __init__(self, path: str = None, snapshot_interval: float = 300., redis: MemoryRedis = None):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.redis = redis or MemoryRedis()
+        self.pool = None
+        self._task = None
+
+    def __repr__(self):
+        return 'MemoryState object: {}'.format(self.path or 'not saved')
+
+    async def open(self):
+        if self.pool is None:
+            if self.path and os.path.exists(self.path):
+                self.load()
+            self.pool = MemoryPool(self.redis)
+            if self.path and self.snapshot_interval:
+                self._task = asyncio.ensure_future(self._run())
+        return self.pool
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await asyncio.get_event_loop().run_in_executor(None, self.save, self.snapshot())
+
+    def snapshot(self) -> Dict:
+        """Copies the state, tagging the type of each key"""
+
+        data = {}
+        for key, value in self.redis.data.items():
+            if isinstance(value, set):
+                data[key] = ['set', list(value)]
+            elif isinstance(value, dict):
+                data[key] = ['hash', dict(value)]
+            elif isinstance(value, list):
+                data[key] = ['list', list(value)]
+            else:
+                data[key] = ['string', value]
+        return data
+
+    def save(self, data: Dict):
+        with gzip.open(self.path + '.tmp', 'wt', encoding='utf8') as file:
+            json.dump(data, file)
+        os.replace(self.path + '.tmp', self.path)
+        logging.debug('Saved the crawl state to {}'.format(self.path))
+
+    def load(self):
+        with gzip.open(self.path, 'rt', encoding='utf8') as file:
+            data = json.load(file)
+        for key, (kind, value) in data.items():
+            if kind == 'set':
+                value = set(value)
+            elif kind == 'list' and value and isinstance(value[0], list):
+                value = [tuple(entry) for entry in value]  # stream entries
+            self.redis.data[key] = value
+        logging.info('Loaded {} keys of crawl state from {}'.format(len(data), self.path))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.path:
+            self.save(self.snapshot())
+        self.pool = None
+
+
+class ArchiveBackend:
+    """Interface of the archive backends"""
+
+    async def write(self, docs: List[Dict]):
+        """Writes a batch of documents, replacing the ones with the same _id"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MongoArchive(ArchiveBackend):
+    """Writes the documents in unordered bulks of upserts. Set blocking for a pymongo collection, whose writes then
+    run in the default executor, instead of a motor one."""
+
+    def __init__(self, coll, blocking: bool = False):
+        self.coll = coll
+        self.blocking = blocking
+
+    def __repr__(self):
+        return 'MongoArchive object'
+
+    async def write(self, docs: List[Dict]):
+        requests = [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in docs]
+        try:
+            if self.blocking:
+                write = functools.partial(self.coll.bulk_write, requests, ordered=False)
+                await asyncio.get_event_loop().run_in_executor(None, write)
+            else:
+                await self.coll.bulk_write(requests, ordered=False)
+        except BulkWriteError as bwe:
+            logging.warning('Error in bulk insertion:\n' +
+                            '\n'.join([str(err['errmsg']) for err in bwe.details.get('writeErrors')]))
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return {'$binary': base64.b64encode(value).decode('ascii')}
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+def _decode(obj: Dict):
+    if len(obj) == 1 and '$binary' in obj:
+        return base64.b64decode(obj['$binary'])
+    return obj
+
+
+class JsonlArchive(ArchiveBackend):
+    """Appends the documents to directory/segment-<n>.jsonl.gz files, starting a new segment once one is larger than
+    segment_size bytes. Each batch is one gzip member, so that a segment is only ever appended to. Bytes values, like
+    compressed bodies, are stored in base64. A document written twice is in the archive twice: read keeps the last
+    one."""
+
+    def __init__(self, directory: str, segment_size: int = 256 * 1024 ** 2, compresslevel: int = 6):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compresslevel = compresslevel
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self.n_segment = int(segments[-1].split('-')[-1].split('.')[0]) if segments else 0
+
+    def __repr__(self):
+        return 'JsonlArchive object: {}'.format(self.directory)
+
+    def segments(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, 'segment-*.jsonl.gz')))
+
+    @property
+    def segment(self) -> str:
+        return os.path.join(self.directory, 'segment-{:05d}.jsonl.gz'.format(self.n_segment))
+
+    def _append(self, docs: List[Dict]):
+        data = ''.join(json.dumps(doc, default=_encode) + '\n' for doc in docs).encode('utf8')
+        if os.path.exists(self.segment) and os.path.getsize(self.segment) >= self.segment_size:
+            self.n_segment += 1
+        with open(self.segment, 'ab') as file:
+            file.write(gzip.compress(data, self.compresslevel))
+
+    async def write(self, docs: List[Dict]):
+        await asyncio.get_event_loop().run_in_executor(None, self._append, docs)
+
+    def read(self) -> Dict[str, Dict]:
+        """Returns the archived documents by _id"""
+
+        docs = {}
+        for segment in self.segments():
+            with gzip.open(segment, 'rt', encoding='utf8') as file:
+                for line in file:
+                    doc = json.loads(line, object_hook=_decode)
+                    docs[doc['_id']] = doc
+        return docs
@@ -0,0 +1,268 @@
+"""
+Benchmarks of the spider building blocks
+
+usage: python benchmark.py extractors <corpus directory>
+       python benchmark.py crawl [--crawler spider|crawler] [--discovery] [--robots] [--seeds 1] [--pages 2000]
+                                 [--save results.jsonl]
+       python benchmark.py compare results.jsonl
+
+The corpus is a directory of saved pages, each file being named after the quoted url of the page
+(e.g. http%3A%2F%2Fexample.onion%2Findex.php.html).
+
+The crawl benchmark runs TorSpider or crawler.handle_task end to end against the local synthetic web, with in-memory
+Redis and MongoDB stand-ins, and reports the pages/sec, the p50/p99 latency from the start of a fetch to the write of
+the page in the archive, the peak RSS, the Redis round trips per page and the discovery rate: the number of distinct
+sites among the first 1000 fetches. Start from a few --seeds and compare TorSpider --discovery to the FIFO crawler to
+measure how fast new sites are found. Saved results are appended as JSON lines, so
+that compare can show the runs side by side.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+from urllib.parse import unquote
+
+import aiohttp
+
+import crawler
+from archive import ArchiveWriter
+from backends import MemoryState, MongoArchive
+from connectors import PooledConnector, connector_options
+from extractors import BACKENDS, parse_page
+from hosts import HostTracker
+from memory import MemoryCollection, MemoryRedis
+from synthetic_web import SyntheticWeb
+from tor_spider import TorSpider
+
+
+def load_corpus(path: str) -> List[Tuple[str, str]]:
+    """Returns the (url, html) of the pages saved in the given directory"""
+
+    pages = []
+    for name in sorted(os.listdir(path)):
+        url = unquote(name[:-5] if name.endswith('.html') else name)
+        if not url.startswith(('http://', 'https://')):
+            url = 'http://corpus.onion/' + url
+        with open(os.path.join(path, name), encoding='utf8', errors='replace') as file:
+            pages.append((url, file.read()))
+    return pages
+
+
+def bench_extractors(pages: List[Tuple[str, str]], repeat: int = 3) -> Dict[str, Dict]:
+    """Parses the pages with every extractor backend and returns the pages/sec and peak memory of each one"""
+
+    results = {}
+    for backend in BACKENDS:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for url, html in pages:
+                parse_page(html, url, backend)
+        elapsed = time.perf_counter() - start
+
+        # tracing slows down allocations a lot, so memory is measured in a separate pass
+        tracemalloc.start()
+        for url, html in pages:
+            parse_page(html, url, backend)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[backend] = {'pages_per_sec': len(pages) * repeat / elapsed, 'peak_memory': peak}
+    return results
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss() -> int:
+    """Peak resident memory of the process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def timed(fetch, starts: Dict[str, float], key=lambda url: url):
+    """Wraps a fetch coroutine function taking (session, url, ...) to record when each fetch starts"""
+
+    async def wrapper(session, url, *args, **kwargs):
+        starts[key(url)] = time.monotonic()
+        return await fetch(session, url, *args, **kwargs)
+    return wrapper
+
+
+def discovery_rate(urls: List[str], per: int = 1000) -> float:
+    """Distinct sites among the first per fetched urls, scaled up if there were fewer fetches"""
+
+    urls = urls[:per]
+    sites = {url.replace('http://', '').split('/')[0] for url in urls}
+    return len(sites) / max(1, len(urls)) * per
+
+
+def crawl_results(coll: MemoryCollection, redis: MemoryRedis, starts: Dict[str, float], elapsed: float) -> Dict:
+    latencies = [coll.write_times[url] - starts[url] for url in coll.docs if url in starts]
+    return {'pages': len(coll.docs),
+            'sites': len({url.replace('http://', '').split('/')[0] for url in starts}),
+            'sites_per_1000_fetches': discovery_rate(list(starts)),
+            'pages_per_sec': len(coll.docs) / elapsed,
+            'p50_latency': percentile(latencies, 0.5),
+            'p99_latency': percentile(latencies, 0.99),
+            'peak_rss': peak_rss(),
+            'redis_round_trips_per_page': redis.n_round_trips / max(1, len(coll.docs)),
+            'redis_commands_per_page': redis.n_commands / max(1, len(coll.docs)),
+            'elapsed': elapsed}
+
+
+async def bench_spider(web: SyntheticWeb, max_pages: int, n_tasks: int = 100, idle_time: float = 2.,
+                       n_seeds: int = None, **options) -> Dict:
+    """Crawls the synthetic web with TorSpider, from its n_seeds first hosts, until max_pages pages are archived or the
+    frontier stays empty for idle_time seconds"""
+
+    redis, coll, starts = MemoryRedis(), MemoryCollection(), {}
+    options.setdefault('host_delay', 0.)
+    options.setdefault('timeout', 5.)
+    options.setdefault('archive_flush_interval', 0.5)
+    spider = TorSpider(n_tasks=n_tasks, resolver=web.resolver, state=MemoryState(redis=redis),
+                       storage=MongoArchive(coll), **options)
+    spider.get = timed(spider.get, starts)
+    start = time.monotonic()
+    await spider.start(web.seeds[:n_seeds])
+    spider._tasks = [asyncio.ensure_future(spider.crawl()) for _ in range(n_tasks)]
+    idle_since = None
+    while len(coll.docs) + spider.archive.qsize() < max_pages:
+        await asyncio.sleep(0.1)
+        if spider.frontier.empty() and not spider.frontier._in_flight:
+            idle_since = idle_since or time.monotonic()
+            if time.monotonic() - idle_since >= idle_time:
+                break
+        else:
+            idle_since = None
+    spider.stop()
+    await asyncio.gather(*spider._tasks, return_exceptions=True)
+    await spider.close()
+    if spider.parse_executor:
+        spider.parse_executor.shutdown()
+    return crawl_results(coll, redis, starts, time.monotonic() - start)
+
+
+async def bench_crawler(web: SyntheticWeb, max_pages: int, n_tasks: int = crawler.N_TASKS,
+                        n_seeds: int = None) -> Dict:
+    """Crawls the synthetic web with crawler.handle_task, from its n_seeds first hosts, until its queue is empty or
+    max_pages pages are archived"""
+
+    redis, coll, starts = MemoryRedis(), MemoryCollection(), {}
+    queue = asyncio.Queue()
+    for url in web.seeds[:n_seeds]:
+        queue.put_nowait(url.replace('http://', '').rstrip('/'))
+    crawler.crawled_urls.clear()
+    get_body = crawler.get_body
+    crawler.get_body = timed(get_body, starts)
+    conn = PooledConnector(**connector_options(crawler.POOL_LIMIT, crawler.POOL_LIMIT_PER_HOST, resolver=web.resolver))
+    archive = ArchiveWriter(coll, flush_size=crawler.BATCH_SIZE, flush_interval=0.5, body_field='source')
+    hosts = HostTracker(min_timeout=crawler.MIN_TIMEOUT, max_timeout=crawler.MAX_TIMEOUT)
+    start = time.monotonic()
+    try:
+        async with aiohttp.ClientSession(connector=conn) as session:
+            tasks = [asyncio.ensure_future(crawler.handle_task(queue, session, archive, None, hosts))
+                     for _ in range(n_tasks)]
+            while not all(task.done() for task in tasks) and len(coll.docs) + archive.qsize() < max_pages:
+                await asyncio.sleep(0.1)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await archive.close()
+    finally:
+        crawler.get_body = get_body
+    return crawl_results(coll, redis, starts, time.monotonic() - start)
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        return revision.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_result(path: str, result: Dict):
+    with open(path, 'a') as file:
+        file.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def compare(path: str) -> List[str]:
+    """Formats the saved runs of the crawl benchmark, one line per run"""
+
+    columns = ('pages_per_sec', 'p50_latency', 'p99_latency', 'peak_rss', 'redis_round_trips_per_page',
+               'sites_per_1000_fetches')
+    lines = ['{:<20} {:<10} {:<10} {:>10} {:>8} {:>8} {:>10} {:>8} {:>10}'.format(
+        'time', 'revision', 'crawler', 'pages/sec', 'p50', 'p99', 'RSS MiB', 'rtt/page', 'sites/1k')]
+    with open(path) as file:
+        for line in file:
+            run = json.loads(line)
+            values = [run.get(column, 0) for column in columns]
+            crawler_ = run['crawler'] + ''.join('+' + option[:4] for option in ('discovery', 'robots')
+                                                if run.get(option))
+            lines.append('{:<20} {:<10} {:<10} {:>10.1f} {:>8.3f} {:>8.3f} {:>10.1f} {:>8.2f} {:>10.1f}'.format(
+                run['time'], run.get('revision') or '-', crawler_, values[0], values[1], values[2],
+                values[3] / 1024 ** 2, values[4], values[5]))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    extractors_parser = subparsers.add_parser('extractors', help='compare the html extractor backends')
+    extractors_parser.add_argument('corpus', help='directory of saved pages')
+    extractors_parser.add_argument('--repeat', type=int, default=3)
+    crawl_parser = subparsers.add_parser('crawl', help='crawl the local synthetic web')
+    crawl_parser.add_argument('--crawler', choices=('spider', 'crawler'), default='spider')
+    crawl_parser.add_argument('--discovery', action='store_true', help='score the spider links for site discovery')
+    crawl_parser.add_argument('--robots', action='store_true', help='follow robots.txt and ingest the sitemaps')
+    crawl_parser.add_argument('--seeds', type=int, help='start from the first hosts only, all of them by default')
+    crawl_parser.add_argument('--pages', type=int, default=2000, help='stop after this number of pages')
+    crawl_parser.add_argument('--tasks', type=int, default=100)
+    crawl_parser.add_argument('--hosts', type=int, default=50)
+    crawl_parser.add_argument('--seed', type=int, default=0)
+    crawl_parser.add_argument('--port', type=int, default=8080)
+    crawl_parser.add_argument('--save', help='append the results to this JSON lines file')
+    compare_parser = subparsers.add_parser('compare', help='show the saved crawl benchmark runs')
+    compare_parser.add_argument('results', help='JSON lines file written by crawl --save')
+    args = parser.parse_args()
+
+    if args.command == 'extractors':
+        pages = load_corpus(args.corpus)
+        for backend, result in bench_extractors(pages, args.repeat).items():
+            print('{:<8} {:>10.1f} pages/sec {:>10.1f} KiB peak'.format(
+                backend, result['pages_per_sec'], result['peak_memory'] / 1024))
+    elif args.command == 'crawl':
+        web = SyntheticWeb(n_hosts=args.hosts, seed=args.seed, port=args.port)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(web.start())
+        try:
+            if args.crawler == 'spider':
+                result = loop.run_until_complete(bench_spider(web, args.pages, args.tasks, n_seeds=args.seeds,
+                                                              discovery=args.discovery, robots=args.robots))
+            else:
+                result = loop.run_until_complete(bench_crawler(web, args.pages, args.tasks, n_seeds=args.seeds))
+        finally:
+            loop.run_until_complete(web.close())
+        result.update(crawler=args.crawler, discovery=args.discovery, robots=args.robots, seeds=args.seeds,
+                      tasks=args.tasks, hosts=args.hosts, seed=args.seed, time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                      revision=git_revision())
+        for key, value in sorted(result.items()):
+            print('{:<28} {}'.format(key, value))
+        if args.save:
+            save_result(args.save, result)
+    elif args.command == 'compare':
+        print('\n'.join(compare(args.results)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Checkpoints of the crawl frontier in Redis
+
+Urls waiting in the frontier are members of the 'to_crawl' set. While a url is crawled it is moved to the 'in_flight'
+sorted set, scored by the expiry time of its lease: the urls of a worker which died are requeued once their lease has
+expired. The in-memory frontier, with the priority of each url, is periodically saved in one list per priority.
+When the crawl is sharded, each shard saves its own frontier under its name and only takes back the urls it owns.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Callable, Iterable, List
+
+from frontier import INTERNAL, HostScheduler
+from metrics import Metrics
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+CHECKPOINT_KEY = '{}:{}'  # name, priority
+CHUNK_SIZE = 1000
+
+
+def chunks(items: List, size: int = CHUNK_SIZE) -> Iterable[List]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class FrontierCheckpoint:
+    """Saves and restores a HostScheduler, and leases the urls being crawled"""
+
+    def __init__(self, frontier: HostScheduler, lease_time: float = 300., interval: float = 60.,
+                 name: str = 'frontier', owns: Callable[[Url], bool] = None, metrics: Metrics = None):
+        self.frontier = frontier
+        self.lease_time = lease_time
+        self.interval = interval
+        self.name = name
+        self.owns = owns
+        self.metrics = metrics or Metrics()
+
+    def __repr__(self):
+        return 'FrontierCheckpoint object'
+
+    async def lease(self, redis_cache, url: Url):
+        """Moves the url from 'to_crawl' to 'in_flight' until it is released or its lease expires"""
+
+        pipe = redis_cache.pipeline()
+        pipe.srem('to_crawl', url)
+        pipe.zadd('in_flight', time.time() + self.lease_time, url)
+        with self.metrics.time('redis_seconds', op='lease'):
+            await pipe.execute()
+
+    async def release(self, redis_cache, url: Url, crawled: bool = True):
+        """Ends the lease of the url, marking it as crawled"""
+
+        pipe = redis_cache.pipeline()
+        pipe.zrem('in_flight', url)
+        if crawled:
+            pipe.sadd('crawled', url)
+        with self.metrics.time('redis_seconds', op='release'):
+            await pipe.execute()
+
+    async def requeue_expired(self, redis_cache, seen: set = None) -> List[Url]:
+        """Puts the urls whose lease has expired back in 'to_crawl' and in the frontier, unless they are in seen"""
+
+        urls = await redis_cache.zrangebyscore('in_flight', max=time.time())
+        if self.owns is not None:
+            urls = [url for url in urls if self.owns(url)]
+        if not urls:
+            return []
+        pipe = redis_cache.pipeline()
+        for chunk in chunks(urls):
+            pipe.sadd('to_crawl', *chunk)
+            pipe.zrem('in_flight', *chunk)
+        await pipe.execute()
+        self._put_all(urls, INTERNAL, set() if seen is None else seen)
+        logging.info('Requeued {} urls with an expired lease'.format(len(urls)))
+        return urls
+
+    async def save(self, redis_cache):
+        """Saves the urls of the frontier with their priority"""
+
+        by_priority = [[] for _ in range(self.frontier.n_priorities)]
+        for url, priority in self.frontier.items():
+            by_priority[priority].append(url)
+        pipe = redis_cache.pipeline()
+        for priority, urls in enumerate(by_priority):
+            key = CHECKPOINT_KEY.format(self.name, priority)
+            pipe.delete(key + ':tmp')
+            for chunk in chunks(urls):
+                pipe.rpush(key + ':tmp', *chunk)
+            if urls:
+                pipe.rename(key + ':tmp', key)
+            else:
+                pipe.delete(key)
+        with self.metrics.time('redis_seconds', op='checkpoint'):
+            await pipe.execute()
+        logging.debug('Saved {} urls of the frontier'.format(sum(len(urls) for urls in by_priority)))
+
+    async def restore(self, redis_cache, size: int) -> int:
+        """Fills the frontier with the last checkpoint and the expired leases, then with up to size urls of
+        'to_crawl'. Returns the number of restored urls."""
+
+        pipe = redis_cache.pipeline()
+        for priority in range(self.frontier.n_priorities):
+            pipe.lrange(CHECKPOINT_KEY.format(self.name, priority), 0, -1)
+        checkpoint = await pipe.execute()
+        # urls crawled since the checkpoint are not in 'to_crawl' anymore
+        pipe = redis_cache.pipeline()
+        for urls in checkpoint:
+            for url in urls:
+                pipe.sismember('to_crawl', url)
+        waiting = iter(await pipe.execute())
+        seen = set()
+        for priority, urls in enumerate(checkpoint):
+            self._put_all([url for url in urls if next(waiting)], priority, seen)
+        await self.requeue_expired(redis_cache, seen)
+        urls = await redis_cache.srandmember('to_crawl', size)
+        self._put_all([url for url in urls if self.owns is None or self.owns(url)], INTERNAL, seen)
+        logging.info('Restored {} urls in the frontier'.format(len(seen)))
+        return len(seen)
+
+    def _put_all(self, urls: Iterable[Url], priority: int, seen: set):
+        for url in urls:
+            if url not in seen and self.frontier.put_nowait(url, priority):
+                seen.add(url)
+
+    async def run(self, redis_cache):
+        """Saves the frontier and requeues the expired leases every interval seconds"""
+
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.requeue_expired(redis_cache)
+                await self.save(redis_cache)
+            except Exception as exc:
+                logging.error('Could not checkpoint the frontier: {}'.format(exc))
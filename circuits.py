@@ -0,0 +1,143 @@
+"""
+Pool of Tor circuits
+
+Each circuit is a SOCKS endpoint, either a different local tor instance or the same one with different credentials
+(tor isolates streams by SOCKS credentials with IsolateSOCKSAuth). Domains are assigned to circuits by consistent
+hashing, so that a hidden service keeps using the same circuit, and circuits which are much slower or fail much more
+than the others are ejected for a while, their domains being spread over the remaining ones.
+"""
+
+import logging
+import statistics
+import time
+from typing import Dict, Iterable, Tuple
+
+import aiohttp
+from aiohttp_socks import ProxyConnector, ProxyType
+
+from connectors import PoolStatsMixin
+from hashring import HashRing
+
+Domain = str  # e.g www.google.com
+Endpoint = Tuple  # (host, port) or (host, port, username, password)
+
+
+class PooledSocksConnector(PoolStatsMixin, ProxyConnector):
+    """aiohttp connector opening its connections through a SOCKS5 proxy, the hosts being resolved by the proxy"""
+
+
+class Circuit:
+    """A SOCKS endpoint with its own aiohttp session, shared by all the crawl workers"""
+
+    def __init__(self, host: str, port: int, username: str = None, password: str = None,
+                 connector_options: Dict = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.name = '{}:{}'.format(host, port) + ('/' + username if username else '')
+        self.latency = None  # exponentially weighted moving average, in seconds
+        self.error_rate = 0.
+        self.n_requests = 0
+        self.ejected_until = None
+        self.connector_options = connector_options or {}
+        self._session = None
+
+    def __repr__(self):
+        return 'Circuit object: ' + self.name
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            conn = PooledSocksConnector(host=self.host, port=self.port, proxy_type=ProxyType.SOCKS5,
+                                        username=self.username, password=self.password, rdns=True,
+                                        **self.connector_options)
+            self._session = aiohttp.ClientSession(connector=conn)
+        return self._session
+
+    def report(self, latency: float = None, ok: bool = True, alpha: float = 0.2):
+        """Updates the circuit statistics with the result of a request"""
+
+        self.n_requests += 1
+        self.error_rate += alpha * ((0. if ok else 1.) - self.error_rate)
+        if ok and latency is not None:
+            self.latency = latency if self.latency is None else self.latency + alpha * (latency - self.latency)
+
+    @property
+    def pool_stats(self) -> Dict[str, int]:
+        return self._session.connector.stats if self._session is not None else {}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class CircuitPool:
+    """Assigns domains to circuits and ejects the bad ones
+
+    A circuit is ejected for eject_time seconds when, after min_requests requests, its average latency is more than
+    slow_factor times the median latency of the pool, or its error rate exceeds the median one by more than
+    error_margin. The last active circuit is never ejected.
+    """
+
+    def __init__(self, endpoints: Iterable[Endpoint], min_requests: int = 20, slow_factor: float = 3.,
+                 error_margin: float = 0.3, eject_time: float = 60., connector_options: Dict = None):
+        self.circuits = {}
+        for endpoint in endpoints:
+            circuit = Circuit(*endpoint, connector_options=connector_options)
+            self.circuits[circuit.name] = circuit
+        if not self.circuits:
+            raise ValueError('At least one SOCKS endpoint is needed')
+        self.min_requests = min_requests
+        self.slow_factor = slow_factor
+        self.error_margin = error_margin
+        self.eject_time = eject_time
+        self.ring = HashRing(self.circuits)
+
+    def __repr__(self):
+        return 'CircuitPool object: {}/{} active circuits'.format(len(self.ring), len(self.circuits))
+
+    @property
+    def active(self) -> Iterable[Circuit]:
+        return [self.circuits[name] for name in self.ring.nodes]
+
+    def circuit(self, domain: Domain) -> Circuit:
+        """Returns the circuit to use for the given domain"""
+
+        self._readmit()
+        return self.circuits[self.ring.get(domain)]
+
+    def report(self, circuit: Circuit, latency: float = None, ok: bool = True):
+        """Records the result of a request made through the circuit, ejecting it if it behaves badly"""
+
+        circuit.report(latency, ok)
+        if circuit.name not in self.ring or len(self.ring) < 2 or circuit.n_requests < self.min_requests:
+            return
+        others = [other for other in self.active if other is not circuit]
+        latencies = [other.latency for other in others if other.latency is not None]
+        too_slow = latencies and circuit.latency is not None and \
+            circuit.latency > self.slow_factor * statistics.median(latencies)
+        failing = circuit.error_rate > statistics.median(other.error_rate for other in others) + self.error_margin
+        if too_slow or failing:
+            self.eject(circuit)
+
+    def eject(self, circuit: Circuit):
+        logging.warning('Ejecting {} (latency {}, error rate {:.2f})'.format(circuit, circuit.latency,
+                                                                          circuit.error_rate))
+        self.ring.remove(circuit.name)
+        circuit.ejected_until = time.monotonic() + self.eject_time
+
+    def _readmit(self):
+        now = time.monotonic()
+        for circuit in self.circuits.values():
+            if circuit.ejected_until is not None and circuit.ejected_until <= now:
+                circuit.ejected_until = None
+                circuit.latency = None
+                circuit.error_rate = 0.
+                circuit.n_requests = 0
+                self.ring.add(circuit.name)
+
+    async def close(self):
+        for circuit in self.circuits.values():
+            await circuit.close()
@@ -0,0 +1,50 @@
+"""
+aiohttp connectors shared by all the crawl workers, reporting how their connections are used
+"""
+
+from typing import Dict
+
+import aiohttp
+
+
+class PoolStatsMixin:
+    """Counts the connections created by a connector and the ones reused from its keep-alive pool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_connects = 0
+        self.n_created = 0
+
+    async def connect(self, req, *args, **kwargs):
+        self.n_connects += 1
+        return await super().connect(req, *args, **kwargs)
+
+    async def _create_connection(self, req, *args, **kwargs):
+        self.n_created += 1
+        return await super()._create_connection(req, *args, **kwargs)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Numbers of connections in use, idle in the pool, opened and reused since the start"""
+
+        return {'open': len(self._acquired),
+                'idle': sum(len(conns) for conns in self._conns.values()),
+                'created': self.n_created,
+                'reused': self.n_connects - self.n_created}
+
+
+class PooledConnector(PoolStatsMixin, aiohttp.TCPConnector):
+    pass
+
+
+def connector_options(limit: int = 1000, limit_per_host: int = 8, dns_cache_ttl: int = 300,
+                      keepalive_timeout: float = 30., resolver=None) -> Dict:
+    """Keyword arguments of the pooled connectors: total and per host connection limits, time to live of the DNS
+    cache in seconds (None to cache forever), time during which idle connections are kept alive and the DNS resolver,
+    aiohttp default one if None"""
+
+    options = {'limit': limit, 'limit_per_host': limit_per_host, 'use_dns_cache': True, 'ttl_dns_cache': dns_cache_ttl,
+               'keepalive_timeout': keepalive_timeout}
+    if resolver is not None:
+        options['resolver'] = resolver
+    return options
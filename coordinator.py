@@ -0,0 +1,164 @@
+"""
+Runs a sharded crawl: one TorSpider process per shard, started, watched and stopped through Redis
+
+With a MemoryState, the shards run as tasks of the coordinator event loop instead, sharing the state, to try out or
+test a sharded crawl on one box without Redis.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import sys
+from collections import OrderedDict
+from typing import Dict, Iterable, Union
+
+import aioredis
+
+from backends import MemoryState
+from shards import STOP_KEY, ShardRouter, shard_names, shard_stats, total_stats
+from tor_spider import TorSpider
+
+Url = str  # e.g: http://www.google.com/hello.php
+Shard = Union[multiprocessing.Process, asyncio.Future]
+
+
+def run_shard(name: str, urls: Iterable[Url], n_tasks: int, tor_only: bool, redis_address: tuple,
+              spider_options: Dict, heartbeat: float = 5.):
+    """Entry point of a shard process"""
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    spider = TorSpider(redis_address=redis_address, shard=ShardRouter(name, heartbeat, 3 * heartbeat),
+                       **spider_options)
+    spider.run(n_tasks=n_tasks, tor_only=tor_only, urls=urls)
+
+
+class Coordinator:
+    """Class which starts the crawl shards, adds new ones while they run, aggregates their stats and stops them
+
+    The shards are processes sharing the Redis at redis_address, or tasks of the coordinator event loop sharing state
+    if it is given. They send a heartbeat every heartbeat seconds.
+    """
+
+    def __init__(self, urls: Iterable[Url] = (), n_tasks: int = 100, tor_only: bool = False,
+                 redis_address: tuple = ('localhost', 6389), state: MemoryState = None, heartbeat: float = 5.,
+                 **spider_options):
+        self.urls = list(urls)
+        self.n_tasks = n_tasks
+        self.tor_only = tor_only
+        self.redis_address = redis_address
+        self.state = state
+        self.heartbeat = heartbeat
+        self.spider_options = spider_options
+        self.shards = OrderedDict()  # type: Dict[str, Shard]
+        self.spiders = {}  # type: Dict[str, TorSpider]
+        self.redis = None
+
+    def __repr__(self):
+        return 'Coordinator object: {} shards'.format(len(self.shards))
+
+    async def connect(self):
+        if self.redis is None:
+            if self.state is not None:
+                await self.state.open()
+                self.redis = self.state.redis
+            else:
+                self.redis = await aioredis.create_redis(self.redis_address, encoding='utf-8')
+
+    @staticmethod
+    def is_alive(shard: Shard) -> bool:
+        return not shard.done() if isinstance(shard, asyncio.Future) else shard.is_alive()
+
+    async def start(self, n_shards: int):
+        await self.connect()
+        await self.redis.delete(STOP_KEY)
+        for name in shard_names(n_shards):
+            self.add_shard(name)
+
+    def add_shard(self, name: str = None) -> str:
+        """Starts a new shard, the running shards hand it its domains at their next heartbeat"""
+
+        name = name or 'shard{}'.format(len(self.shards))
+        if name in self.shards:
+            raise ValueError('Shard {} is already running'.format(name))
+        if self.state is not None:
+            spider = TorSpider(state=self.state, shard=ShardRouter(name, self.heartbeat, 3 * self.heartbeat),
+                               **self.spider_options)
+            self.spiders[name] = spider
+            self.shards[name] = asyncio.ensure_future(spider.run_crawl(self.n_tasks, self.tor_only, self.urls))
+            logging.info('Started shard {} in the coordinator process'.format(name))
+            return name
+        process = multiprocessing.Process(target=run_shard, name=name, args=(
+            name, self.urls, self.n_tasks, self.tor_only, self.redis_address, self.spider_options, self.heartbeat))
+        process.start()
+        self.shards[name] = process
+        logging.info('Started shard {} (pid {})'.format(name, process.pid))
+        return name
+
+    async def stats(self) -> Dict[str, int]:
+        """Sums the last stats sent by the shards"""
+
+        await self.connect()
+        stats = await shard_stats(self.redis, self.shards)
+        alive = [name for name, shard in self.shards.items() if self.is_alive(shard)]
+        return dict(total_stats(stats), shards=len(alive))
+
+    async def stop(self, timeout: float = 60.):
+        """Asks the shards to stop, waits for them to save their frontier, and kills the ones still running after
+        timeout seconds"""
+
+        await self.connect()
+        await self.redis.set(STOP_KEY, 1)
+        loop = asyncio.get_event_loop()
+        for name, shard in self.shards.items():
+            if isinstance(shard, asyncio.Future):
+                await asyncio.wait([shard], timeout=timeout)
+                if not shard.done():
+                    logging.warning('Shard {} did not stop, stopping it'.format(name))
+                    self.spiders[name].stop()
+                    await asyncio.wait([shard])
+                if not shard.cancelled() and shard.exception() is not None:
+                    logging.error('Shard {} failed: {!r}'.format(name, shard.exception()))
+                continue
+            await loop.run_in_executor(None, shard.join, timeout)
+            if shard.is_alive():
+                logging.warning('Shard {} did not stop, terminating it'.format(name))
+                shard.terminate()
+        self.shards.clear()
+        self.spiders.clear()
+        if self.state is None:
+            self.redis.close()
+        self.redis = None
+
+    def run(self, n_shards: int, stats_interval: float = 30.):
+        """Runs the shards and logs their stats until interrupted"""
+
+        async def watch():
+            await self.start(n_shards)
+            while any(self.is_alive(shard) for shard in self.shards.values()):
+                await asyncio.sleep(stats_interval)
+                logging.info('Crawl stats: {}'.format(await self.stats()))
+
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(watch())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            loop.run_until_complete(self.stop())
+
+
+def main():
+    n_shards = int(sys.argv[1]) if len(sys.argv) > 1 else multiprocessing.cpu_count()
+    logging.basicConfig(level=logging.INFO)
+    with open('tor_websites.txt') as file:
+        urls = [line.split(' ')[0] for line in file if line.startswith('http://')]
+    coordinator = Coordinator(urls, n_tasks=1000 // n_shards, tor_only=True, compact=True,
+                              max_memory=512 * 1024 ** 2 // n_shards, bloom_capacity=10 ** 7 // n_shards,
+                              max_per_host=4, host_delay=0.5, compression='zlib',
+                              socks_endpoints=[('127.0.0.1', 9150, 'circuit{}'.format(i), 'aiospider')
+                                               for i in range(8)])
+    coordinator.run(n_shards)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,41 +10,59 @@ inspired by:
 """
 
 import re
-from typing import Iterable
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List
 import logging
 
 from bs4 import BeautifulSoup
 from tld import get_tld
 import aiohttp
+import async_timeout
 import asyncio
 import pymongo
-from pymongo.errors import BulkWriteError
+
+from archive import ArchiveWriter
+from backends import ArchiveBackend, MongoArchive
+from connectors import PooledConnector, connector_options
+from extractors import DEFAULT_BACKEND, extract, soup_hrefs
+from hosts import HostTracker
+from robots import RobotsCache, SitemapParser, parse_robots
 
 
 BATCH_SIZE = 5
 N_TASKS = 9
+PARSE_WORKERS = 2  # 0 to parse pages in the event loop
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 4
+MIN_TIMEOUT = 2
+MAX_TIMEOUT = 10
 
 root_urls = ['www.cybelangel.com', 'stackoverflow.com', 'github.com']
 crawled_urls = set()
+robots = RobotsCache()
 url_hub = []
 for url in root_urls:
     url_hub.extend([url, "{}/sitemap.xml".format(url), "{}/robots.txt".format(url)])
 
-db = pymongo.MongoClient().get_database('test')
-coll = db.get_collection('crawls')
-
 
-async def get_body(session: aiohttp.ClientSession, url: str) -> str:
-    """Returns the html from the given url"""
+async def get_body(session: aiohttp.ClientSession, url: str, hosts: HostTracker = None, binary: bool = False):
+    """Returns the html from the given url, or its raw bytes if binary is set, with a timeout adapted to the latency of
+    its host"""
 
+    host = url.split('/')[0]
+    start = time.monotonic()
+    ok = False
     try:
-        with aiohttp.Timeout(5):
+        with async_timeout.timeout(hosts.timeout(host) if hosts else 5):
             async with session.get('http://' + url) as response:
-                return await response.text()
+                body = await (response.read() if binary else response.text())
+                ok = True
+                return body
     except asyncio.TimeoutError:
         logging.warning('Timeout exception for {}'.format(url))
         return None
-    except aiohttp.errors.ClientOSError as coe:
+    except aiohttp.ClientOSError as coe:
         logging.warning('ClientOSError exception for {}\n{}'.format(url, coe))
         return None
     except UnicodeDecodeError as ude:
@@ -52,15 +70,18 @@ async def get_body(session: aiohttp.ClientSession, url: str) -> str:
         return None
     except ConnectionResetError:
         logging.warning('ConnectionResetError for {}'.format(url))
+    finally:
+        if hosts:
+            hosts.record(host, time.monotonic() - start, ok=ok)
 
 
-def get_internal_links(bs_obj: BeautifulSoup, include_url: str) -> Iterable[str]:
-    """Finds all links that begin with a "/" or which contain the page url"""
+def iter_internal_links(hrefs: Iterable[str], include_url: str) -> Iterable[str]:
+    """Keeps the links that begin with a "/" or which contain the page url"""
 
     already_saw = {include_url}
-    for link in bs_obj.find_all("a", href=re.compile(r"^(/(?!/)|.*" + get_tld('http://' + include_url) + ")")):
-        if link.attrs['href'] is not None:
-            ref = link.attrs['href']
+    pattern = re.compile(r"^(/(?!/)|.*" + get_tld('http://' + include_url) + ")")
+    for ref in hrefs:
+        if pattern.search(ref):
             if ref.startswith('http'):
                 url = ref.split('//')[1]
             elif ref.startswith('/'):
@@ -74,50 +95,88 @@ def get_internal_links(bs_obj: BeautifulSoup, include_url: str) -> Iterable[str]
                 yield url
 
 
-def get_external_links(bs_obj: BeautifulSoup, exclude_url: str) -> Iterable[str]:
-    """Finds all links that start with "http" or "www" that do not contain the current URL"""
+def iter_external_links(hrefs: Iterable[str], exclude_url: str) -> Iterable[str]:
+    """Keeps the links that start with "http" or "www" that do not contain the current URL"""
 
     already_saw = {exclude_url}
     exclude_tld = get_tld('http://' + exclude_url)
-    for link in bs_obj.find_all("a", href=re.compile(r"^(http|https|www)(?!"+exclude_tld+").*$")):
-        if link.attrs['href'] is not None:
-            tld = get_tld(link.attrs['href'])
+    pattern = re.compile(r"^(http|https|www)(?!" + exclude_tld + ").*$")
+    for ref in hrefs:
+        if pattern.search(ref):
+            tld = get_tld(ref)
             if tld not in already_saw:
                 already_saw.add(tld)
                 yield tld
 
 
-def insert_bulk(bulk: dict):
-    """Insert the crawled pages in Mongodb"""
+def get_internal_links(bs_obj: BeautifulSoup, include_url: str) -> Iterable[str]:
+    """Finds all links that begin with a "/" or which contain the page url"""
 
-    try:
-        coll.insert_many(bulk)
-    except BulkWriteError as bwe:
-        logging.warning('Error in bulk insertion:\n' +
-                        '\n'.join([str(err['errmsg']) for err in bwe.details.get('writeErrors')]))
+    return iter_internal_links(soup_hrefs(bs_obj), include_url)
+
+
+def get_external_links(bs_obj: BeautifulSoup, exclude_url: str) -> Iterable[str]:
+    """Finds all links that start with "http" or "www" that do not contain the current URL"""
 
-    logging.debug('Bulk emptied')
+    return iter_external_links(soup_hrefs(bs_obj), exclude_url)
 
 
-async def handle_task(work_queue):
+def parse_body(body: str, url: str, backend: str = DEFAULT_BACKEND) -> Dict:
+    """Parses the given html and returns its links as plain data, so that it can run in a separate process"""
+
+    title, hrefs = extract(body, backend)
+    return {'title': title,
+            'internal_links': list(iter_internal_links(hrefs, url)),
+            'external_links': list(iter_external_links(hrefs, url))}
+
+
+def is_seed_file(url: str) -> bool:
+    """Whether the url is a robots.txt or a sitemap, gzip compressed or not"""
+
+    name = url.split('?', 1)[0].rsplit('/', 1)[-1].lower()
+    return name == 'robots.txt' or name.endswith(('.xml', '.xml.gz'))
+
+
+def parse_seed_file(url: str, body: bytes) -> List[str]:
+    """Returns the urls listed by a robots.txt (its sitemaps) or a sitemap, without scheme, and caches the rules of the
+    robots.txt"""
+
+    if url.endswith('/robots.txt'):
+        rules = parse_robots(body.decode('utf-8', errors='replace'))
+        robots.set(url.split('/')[0], rules)
+        urls = rules.sitemaps
+    else:
+        parser = SitemapParser()
+        urls = parser.feed(body) + parser.close() + parser.sitemaps
+    return [new_url.split('//', 1)[-1].rstrip('/') for new_url in urls]
+
+
+async def handle_task(work_queue, session: aiohttp.ClientSession, archive: ArchiveWriter,
+                      parse_executor: ProcessPoolExecutor = None, hosts: HostTracker = None):
     """Get a new url from the Queue, crawls it, store page in Mongodb, extracts external links, adds them to Queue"""
 
-    bulk = []
-    with aiohttp.ClientSession() as session:
-        while not work_queue.empty():
-            queue_url = await work_queue.get()
-            crawled_urls.add(queue_url)
-            body = await get_body(session, queue_url)
-            if body:
-                bulk.append({'_id': queue_url, 'source': body})
-                if len(bulk) >= BATCH_SIZE:
-                    await asyncio.get_event_loop().run_in_executor(None, insert_bulk, bulk)
-                    bulk = []
-                bs_obj = BeautifulSoup(body, 'html.parser')
-                for new_url in get_external_links(bs_obj, queue_url):
-                    if new_url not in crawled_urls:
-                        work_queue.put_nowait(new_url)
-                        print(new_url)
+    while not work_queue.empty():
+        queue_url = await work_queue.get()
+        crawled_urls.add(queue_url)
+        if hosts and not hosts.allow(queue_url.split('/')[0]):
+            logging.warning('Skipping {}, its host is down'.format(queue_url))
+            continue
+        seed_file = is_seed_file(queue_url)
+        body = await get_body(session, queue_url, hosts, binary=seed_file)
+        if body and seed_file:
+            for new_url in parse_seed_file(queue_url, body):
+                if new_url not in crawled_urls and robots.allowed('http://' + new_url):
+                    work_queue.put_nowait(new_url)
+        elif body:
+            await archive.put({'_id': queue_url, 'source': body})
+            if parse_executor:
+                parsed = await asyncio.get_event_loop().run_in_executor(parse_executor, parse_body, body, queue_url)
+            else:
+                parsed = parse_body(body, queue_url)
+            for new_url in parsed['external_links']:
+                if new_url not in crawled_urls and robots.allowed('http://' + new_url):
+                    work_queue.put_nowait(new_url)
+                    print(new_url)
 
 
 def ask_exit(signame):
@@ -125,15 +184,35 @@ def ask_exit(signame):
     asyncio.get_event_loop().stop()
 
 
+async def crawl(work_queue, parse_executor: ProcessPoolExecutor = None, storage: ArchiveBackend = None):
+    """Runs the crawl tasks, sharing one pooled session. The pages are archived in storage, by default in the 'crawls'
+    collection of the local MongoDB"""
+
+    if storage is None:
+        storage = MongoArchive(pymongo.MongoClient().get_database('test').get_collection('crawls'), blocking=True)
+    conn = PooledConnector(**connector_options(POOL_LIMIT, POOL_LIMIT_PER_HOST))
+    archive = ArchiveWriter(storage, flush_size=BATCH_SIZE, body_field='source')
+    hosts = HostTracker(min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT, failure_threshold=3)
+    async with aiohttp.ClientSession(connector=conn) as session:
+        try:
+            await asyncio.gather(*[handle_task(work_queue, session, archive, parse_executor, hosts)
+                                   for _ in range(N_TASKS)])
+        finally:
+            await archive.close()
+        logging.info('Connection pool: {}'.format(conn.stats))
+
+
 def main():
 
     q = asyncio.Queue()
     [q.put_nowait(url) for url in url_hub]
     loop = asyncio.get_event_loop()
     loop.set_debug(True)
-    tasks = [handle_task(q) for _ in range(N_TASKS)]
-    loop.run_until_complete(asyncio.wait(tasks))
+    parse_executor = ProcessPoolExecutor(PARSE_WORKERS) if PARSE_WORKERS else None
+    loop.run_until_complete(crawl(q, parse_executor))
     loop.close()
+    if parse_executor:
+        parse_executor.shutdown()
 
 
 if __name__ == '__main__':
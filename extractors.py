@@ -0,0 +1,154 @@
+"""
+Links extraction from html pages
+
+Two backends are available to read the html: "soup" builds a BeautifulSoup tree, "stream" is a single pass scanner
+which only collects the <a href> and <title> of the page without building a tree. The functions of this module only
+deal with plain data so that they can run in a separate process.
+"""
+
+import re
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Dict, Iterable, List, Tuple
+
+from bs4 import BeautifulSoup
+
+from fingerprint import fingerprint
+
+Url = str  # e.g: http://www.google.com/hello.php
+Urls = Iterable[Url]
+Raw_Url = str  # e.g www.google.com/hello.php
+Domain = str  # e.g www.google.com
+
+BACKENDS = ('stream', 'soup')
+DEFAULT_BACKEND = 'stream'
+
+
+class LinkParser(HTMLParser):
+    """Single pass html scanner which collects the hrefs of <a> tags and the page title"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.hrefs = []
+        self.title = None
+        self._title_parts = None
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]):
+        if tag == 'a':
+            href = None
+            for name, value in attrs:
+                if name == 'href':
+                    href = value
+            if href is not None:
+                self.hrefs.append(href)
+        elif tag == 'title' and self.title is None:
+            self._title_parts = []
+
+    def handle_endtag(self, tag: str):
+        if tag == 'title' and self._title_parts is not None:
+            self.title = ''.join(self._title_parts)
+            self._title_parts = None
+
+    def handle_data(self, data: str):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+
+def url_scheme(url: Url) -> str:
+    if url.startswith('http://'):
+        return 'http://'
+    elif url.startswith('https://'):
+        return 'https://'
+    else:
+        raise ValueError('Unknow protocol for page {}'.format(url))
+
+
+def soup_hrefs(soup: BeautifulSoup) -> List[str]:
+    return [link.attrs['href'] for link in soup.find_all('a', href=True)]
+
+
+def extract(html: str, backend: str = DEFAULT_BACKEND) -> Tuple[str, List[str]]:
+    """Returns the title and the hrefs of the given html"""
+
+    if backend == 'stream':
+        parser = LinkParser()
+        parser.feed(html)
+        parser.close()
+        return parser.title, parser.hrefs
+    elif backend == 'soup':
+        soup = BeautifulSoup(html, 'html.parser')
+        return soup.title.string if soup.title else None, soup_hrefs(soup)
+    else:
+        raise ValueError('Unknown extractor backend {}'.format(backend))
+
+
+@lru_cache(maxsize=1024)
+def _external_pattern(domain: Domain):
+    return re.compile(r"^(?:http://|https://)(?!" + re.escape(domain) + ").*$")
+
+
+@lru_cache(maxsize=1024)
+def _internal_pattern(domain: Domain):
+    return re.compile(r"^/(?!/)|.*" + re.escape(domain))
+
+
+def filter_external_links(hrefs: Iterable[str], domain: Domain) -> Urls:
+    """Keeps the links that start with "http" or "https" that do not contain the page domain"""
+
+    pattern = _external_pattern(domain)
+    external_urls = set()
+    for link in hrefs:
+        if pattern.search(link) and link not in external_urls:
+            external_urls.add(link)
+    return list(external_urls)
+
+
+def filter_internal_links(hrefs: Iterable[str], scheme: str, domain: Domain) -> Urls:
+    """Keeps the urls that begin with a "/" or which contain the page url"""
+
+    pattern = _internal_pattern(domain)
+    internal_links = set()
+    for ref in hrefs:
+        if pattern.search(ref):
+            url = scheme + domain + ref if ref.startswith('/') else ref
+            url = url.strip('/')
+            if url not in internal_links:
+                internal_links.add(url)
+    return list(internal_links)
+
+
+def find_external_links(soup: BeautifulSoup, domain: Domain) -> Urls:
+    """Finds all links that start with "http" or "https" that do not contain the page domain"""
+
+    return filter_external_links(soup_hrefs(soup), domain)
+
+
+def find_internal_links(soup: BeautifulSoup, scheme: str, domain: Domain) -> Urls:
+    """Finds all urls that begin with a "/" or which contain the page url"""
+
+    return filter_internal_links(soup_hrefs(soup), scheme, domain)
+
+
+def find_parent_urls(raw_url: Raw_Url) -> Urls:
+    """e.g ['www.google.com', 'www.google.com/bonjour', 'www.google.com/bonjour/hello'] for
+    www.google.com/bonjour/hello/lol"""
+
+    parts = raw_url.split('/')
+    return list('/'.join(parts[:i]) for i in range(1, len(parts)))
+
+
+def parse_page(html: str, url: Url, backend: str = DEFAULT_BACKEND) -> Dict:
+    """Parses the given html and returns the title, internal links, external links, parent urls and content
+    fingerprints of the page"""
+
+    scheme = url_scheme(url)
+    raw_url = url.replace(scheme, '')
+    domain = raw_url.split('/')[0]
+    title, hrefs = extract(html, backend)
+    content_hash, simhash = fingerprint(html)
+    return {'title': title,
+            'internal_links': filter_internal_links(hrefs, scheme, domain),
+            'external_links': filter_external_links(hrefs, domain),
+            'parent_urls': find_parent_urls(raw_url),
+            'content_hash': content_hash,
+            'simhash': simhash}
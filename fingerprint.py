@@ -0,0 +1,127 @@
+"""
+Content fingerprints, to detect pages served under several urls
+
+Each page gets an exact hash of its content and a 64 bits SimHash of the words of its main text: pages whose
+SimHashes differ by only a few bits are near duplicates (mirrors, session ids in urls, language variants...). The
+scripts, the navigation blocks and the text of the links are left out of the SimHash, so that the pages of a site
+sharing a large template are not taken for near duplicates of each other.
+"""
+
+import hashlib
+import re
+from collections import OrderedDict, deque
+from typing import Iterable, Tuple
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+N_BITS = 64
+SHINGLE_SIZE = 3
+MAX_SHINGLES = 2 ** 16 - 1  # the SimHash counters are 16 bits wide
+
+_boilerplate = re.compile(r'<(script|style|nav|header|footer|aside|a)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+_tags = re.compile(r'<[^>]*>')
+_words = re.compile(r'\w+')
+
+# _SPREAD[byte] puts each bit of byte in its own 16 bits counter, so that the bits of many hashes can be counted with
+# plain integer additions instead of a loop over the 64 bits of every hash
+_SPREAD = [sum(((byte >> bit) & 1) << (16 * bit) for bit in range(8)).to_bytes(16, 'little') for byte in range(256)]
+
+
+def words(html: str) -> Iterable[str]:
+    """Words of the main text of the page"""
+    return _words.findall(_tags.sub(' ', _boilerplate.sub(' ', html)).lower())
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf8', errors='replace')).hexdigest()
+
+
+def simhash(tokens: Iterable[str]) -> int:
+    """64 bits SimHash of the word shingles of the given tokens"""
+
+    tokens = list(tokens)
+    # the first distinct shingles in the order of the text, so that long pages get the same SimHash in every process
+    shingles = OrderedDict.fromkeys(' '.join(tokens[i:i + SHINGLE_SIZE])
+                                    for i in range(max(1, len(tokens) - SHINGLE_SIZE + 1)))
+    shingles = list(shingles)[:MAX_SHINGLES]
+    counts = 0
+    for shingle in shingles:
+        digest = hashlib.md5(shingle.encode('utf8')).digest()[:8]
+        counts += int.from_bytes(b''.join(_SPREAD[byte] for byte in digest), 'little')
+    fingerprint = 0
+    for bit in range(N_BITS):
+        if ((counts >> (16 * bit)) & 0xFFFF) * 2 > len(shingles):
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def fingerprint(html: str) -> Tuple[str, int]:
+    """Returns the exact hash and the SimHash of the page"""
+    return content_hash(html), simhash(words(html))
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+class DuplicateIndex:
+    """In-process index of the fingerprints of the last max_size pages
+
+    SimHashes are split in max_distance + 1 bands: two fingerprints differing by at most max_distance bits have at
+    least one identical band, so only the pages sharing a band with the new one are compared.
+    """
+
+    def __init__(self, max_distance: int = 3, max_size: int = 10 ** 6):
+        self.max_distance = max_distance
+        self.max_size = max_size
+        self.n_bands = max_distance + 1
+        self.band_size = N_BITS // self.n_bands
+        self._hashes = {}
+        self._bands = [{} for _ in range(self.n_bands)]
+        self._order = deque()
+
+    def __repr__(self):
+        return 'DuplicateIndex object: {} pages'.format(len(self))
+
+    def __len__(self):
+        return len(self._order)
+
+    def _band_keys(self, simhash_: int) -> Iterable[int]:
+        mask = (1 << self.band_size) - 1
+        return [(simhash_ >> (i * self.band_size)) & mask for i in range(self.n_bands)]
+
+    def find(self, hash_: str, simhash_: int) -> Url:
+        """Returns the url of an indexed page with the same or a nearly identical content, None if there is none"""
+
+        if hash_ in self._hashes:
+            return self._hashes[hash_]
+        for band, key in zip(self._bands, self._band_keys(simhash_)):
+            for other, url in band.get(key, ()):
+                if distance(simhash_, other) <= self.max_distance:
+                    return url
+        return None
+
+    def add(self, url: Url, hash_: str, simhash_: int):
+        self._hashes[hash_] = url
+        for band, key in zip(self._bands, self._band_keys(simhash_)):
+            band.setdefault(key, []).append((simhash_, url))
+        self._order.append((url, hash_, simhash_))
+        if len(self._order) > self.max_size:
+            self._remove(*self._order.popleft())
+
+    def _remove(self, url: Url, hash_: str, simhash_: int):
+        if self._hashes.get(hash_) == url:
+            del self._hashes[hash_]
+        for band, key in zip(self._bands, self._band_keys(simhash_)):
+            entries = band.get(key, [])
+            entries.remove((simhash_, url))
+            if not entries:
+                del band[key]
+
+    def check(self, url: Url, hash_: str, simhash_: int) -> Url:
+        """Returns the url this page duplicates, or indexes the page and returns None"""
+
+        duplicate_of = self.find(hash_, simhash_)
+        if duplicate_of is None:
+            self.add(url, hash_, simhash_)
+        return duplicate_of
@@ -0,0 +1,400 @@
+"""
+Crawl frontier: structures deciding which urls are crawled next
+"""
+
+import asyncio
+import hashlib
+import heapq
+import logging
+import math
+from collections import defaultdict, deque
+from typing import Iterable, Tuple
+
+from graph import LinkGraph
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+EXTERNAL = 0  # priority of urls leading to other sites, crawled first
+INTERNAL = 1
+DEPRIORITISED = 2  # urls which may be crawler traps
+
+
+class BloomFilter:
+    """In-process Bloom filter, used to drop already seen urls before asking Redis
+
+    The size of the filter is computed from the expected number of urls (capacity) and the accepted false positive
+    rate (error_rate) once capacity urls have been added.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError('capacity must be positive and error_rate between 0 and 1')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def __repr__(self):
+        return 'BloomFilter object: {} items, {} bytes'.format(self.count, self.size)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(item))
+
+    @property
+    def size(self) -> int:
+        """Memory used by the filter bits, in bytes"""
+        return len(self.bits)
+
+    @property
+    def false_positive_rate(self) -> float:
+        """Estimated probability that an unseen item is reported as seen, given the current number of items"""
+        return (1 - math.exp(-self.n_hashes * self.count / self.n_bits)) ** self.n_hashes
+
+    def _indexes(self, item: str) -> Iterable[int]:
+        digest = hashlib.md5(item.encode('utf8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, item: str) -> bool:
+        """Adds the item and returns True if it was not already in the filter"""
+
+        new = False
+        for i in self._indexes(item):
+            mask = 1 << (i & 7)
+            if not self.bits[i >> 3] & mask:
+                self.bits[i >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+class HostScheduler:
+    """Frontier which hands out urls host by host
+
+    Urls are grouped by host inside priority classes (lower is crawled first). Inside a class, hosts are visited in
+    round robin, a host is skipped while it has max_per_host urls in flight or while min_delay seconds have not elapsed
+    since its last fetch. At most max_size urls are kept in memory, put_nowait returns False when the frontier is full.
+    Every url returned by get must be given back to done once crawled.
+
+    Only the hosts which can be fetched right away are kept in the round robin queues of the classes. The hosts waiting
+    for their next fetch time are kept in a heap ordered by that time, and the hosts with max_per_host urls in flight
+    are out of both until done is called, so that get costs O(log hosts) however many hosts are parked.
+    """
+
+    def __init__(self, max_per_host: int = 2, min_delay: float = 1.0, max_size: int = 10 ** 6,
+                 n_priorities: int = 3):
+        self.max_per_host = max_per_host
+        self.min_delay = min_delay
+        self.max_size = max_size
+        self.n_priorities = n_priorities
+        self._classes = [{} for _ in range(n_priorities)]  # host -> deque of urls, for each priority
+        self._sizes = [0] * n_priorities
+        self._ready = [deque() for _ in range(n_priorities)]  # hosts which can be fetched, for each priority
+        self._queued = [set() for _ in range(n_priorities)]  # hosts in _ready, for each priority
+        self._delayed = []  # heap of (next fetch time, host)
+        self._scheduled = {}  # host -> its next fetch time in _delayed
+        self._in_flight = defaultdict(int)
+        self._priorities = {}  # url -> priority it was queued with, for the urls in flight
+        self._next_fetch = {}
+        self._waiters = deque()
+        self._timer = None
+        self._timer_at = None
+
+    def __repr__(self):
+        return 'HostScheduler object: {} urls'.format(self.qsize())
+
+    @staticmethod
+    def host(url: Url) -> str:
+        return url.replace('http://', '').replace('https://', '').split('/')[0]
+
+    def qsize(self, priority: int = None) -> int:
+        if priority is None:
+            return sum(self._sizes)
+        return self._sizes[priority]
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    def full(self) -> bool:
+        return self.qsize() >= self.max_size
+
+    def items(self) -> Iterable[Tuple[Url, int]]:
+        """Iterates over the queued urls and their priority"""
+        for priority, hosts in enumerate(self._classes):
+            for urls in hosts.values():
+                for url in urls:
+                    yield url, priority
+
+    def in_flight(self, host: str) -> int:
+        return self._in_flight.get(host, 0)
+
+    def priority(self, url: Url, default: int = 0) -> int:
+        """Priority the url returned by get was queued with, until done is called"""
+        return self._priorities.get(url, default)
+
+    def park(self, host: str, delay: float):
+        """Keeps the urls of the host in the frontier for at least delay seconds"""
+
+        next_fetch = asyncio.get_event_loop().time() + delay
+        if next_fetch > self._next_fetch.get(host, 0):
+            self._next_fetch[host] = next_fetch
+            self._schedule(host, next_fetch - delay)
+
+    def put_nowait(self, url: Url, priority: int = 0) -> bool:
+        """Adds the url to the frontier, returns False if it has been dropped because the frontier is full"""
+
+        if self.full():
+            logging.debug('Frontier full, dropping {}'.format(url))
+            return False
+        host = self.host(url)
+        hosts = self._classes[priority]
+        if host not in hosts:
+            hosts[host] = deque()
+        hosts[host].append(url)
+        self._sizes[priority] += 1
+        self._schedule(host, asyncio.get_event_loop().time())
+        self._wakeup_next()
+        return True
+
+    async def get(self) -> Url:
+        """Removes and returns the next url which can be crawled, waiting for one if needed"""
+
+        loop = asyncio.get_event_loop()
+        while True:
+            url = self._pop_ready(loop.time())
+            if url is not None:
+                if any(self._ready):
+                    self._wakeup_next()
+                return url
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                waiter.cancel()
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif any(self._ready):
+                    # the wakeup was meant for this waiter, pass it on
+                    self._wakeup_next()
+                raise
+
+    def done(self, url: Url):
+        """Marks the url returned by get as crawled, letting its host be scheduled again"""
+
+        host = self.host(url)
+        self._priorities.pop(url, None)
+        self._in_flight[host] -= 1
+        if not self._in_flight[host]:
+            del self._in_flight[host]
+        self._schedule(host, asyncio.get_event_loop().time())
+        self._wakeup_next()
+
+    def _schedule(self, host: str, now: float):
+        """Puts the host in the round robin queues of its classes if it can be fetched, in the delayed heap if it has
+        to wait. A host with max_per_host urls in flight is left out until done. The next fetch time of an idle host
+        is forgotten once it has passed."""
+
+        next_fetch = self._next_fetch.get(host, 0)
+        if next_fetch > now:
+            if self._scheduled.get(host) != next_fetch:
+                self._scheduled[host] = next_fetch
+                heapq.heappush(self._delayed, (next_fetch, host))
+                self._set_timer()
+            return
+        if self._in_flight.get(host, 0) >= self.max_per_host:
+            return
+        if host not in self._in_flight:
+            self._next_fetch.pop(host, None)
+        for priority, hosts in enumerate(self._classes):
+            if host in hosts and host not in self._queued[priority]:
+                self._ready[priority].append(host)
+                self._queued[priority].add(host)
+
+    def _promote(self, now: float):
+        """Moves the hosts whose next fetch time has passed out of the delayed heap"""
+
+        while self._delayed and self._delayed[0][0] <= now:
+            next_fetch, host = heapq.heappop(self._delayed)
+            if self._scheduled.get(host) == next_fetch:
+                # older entries of a host whose next fetch time has been pushed back are ignored
+                del self._scheduled[host]
+                self._schedule(host, now)
+
+    def _pop_ready(self, now: float) -> Url:
+        """Returns the next ready url, or None if there is none"""
+
+        self._promote(now)
+        for priority, ready in enumerate(self._ready):
+            hosts = self._classes[priority]
+            while ready:
+                host = ready.popleft()
+                self._queued[priority].discard(host)
+                if host not in hosts or self._in_flight.get(host, 0) >= self.max_per_host or \
+                        self._next_fetch.get(host, 0) > now:
+                    # stale entry, the host is back in the queue once it can be fetched again
+                    continue
+                urls = hosts[host]
+                url = urls.popleft()
+                if not urls:
+                    del hosts[host]
+                self._sizes[priority] -= 1
+                self._in_flight[host] += 1
+                self._priorities[url] = priority
+                if self.min_delay:
+                    self._next_fetch[host] = now + self.min_delay
+                self._schedule(host, now)
+                return url
+        return None
+
+    def _set_timer(self):
+        """Wakes a waiter when the first delayed host can be fetched"""
+
+        if not self._delayed:
+            return
+        when = self._delayed[0][0]
+        if self._timer is not None:
+            if self._timer_at <= when:
+                return
+            self._timer.cancel()
+        self._timer_at = when
+        self._timer = asyncio.get_event_loop().call_at(when, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._promote(asyncio.get_event_loop().time())
+        self._set_timer()
+        self._wakeup_next()
+
+    def _wakeup_next(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+
+class DiscoveryScorer:
+    """Scores links by how likely they are to lead to new sites, and maps the scores to the n_buckets priorities of a
+    HostScheduler
+
+    The score of a link adds up, with the given weights: whether its site has never been linked to, the number of
+    distinct sites linking to it (saturating at hub_degree), the yield of the linking site (new sites found per page
+    crawled on it, at most 1), minus the depth of the url (saturating at max_depth). Links to new sites get the best
+    buckets, deprioritised urls the last one.
+    """
+
+    def __init__(self, graph: LinkGraph, n_buckets: int = 8, new_site_weight: float = 4., degree_weight: float = 2.,
+                 yield_weight: float = 2., depth_weight: float = 1., hub_degree: int = 50, max_depth: int = 8):
+        if n_buckets < 3:
+            raise ValueError('n_buckets must be at least 3')
+        self.graph = graph
+        self.n_buckets = n_buckets
+        self.new_site_weight = new_site_weight
+        self.degree_weight = degree_weight
+        self.yield_weight = yield_weight
+        self.depth_weight = depth_weight
+        self.hub_degree = hub_degree
+        self.max_depth = max_depth
+        # domain -> [pages crawled, new sites found]
+        self._yields = {}
+
+    def __repr__(self):
+        return 'DiscoveryScorer object: {} buckets'.format(self.n_buckets)
+
+    def site_yield(self, domain: str) -> float:
+        """New sites found per page crawled on the domain, 1 for a site not crawled yet"""
+
+        n_pages, n_new_sites = self._yields.get(domain, (0, 0))
+        return min(1., n_new_sites / n_pages) if n_pages else 1.
+
+    def score(self, url: Url, source: str) -> float:
+        """Score of a link of a page of the source domain, between 0 and 1"""
+
+        path = url.replace('http://', '').replace('https://', '')
+        domain = path.split('/')[0]
+        degree = math.log1p(self.graph.site_in_degree(domain)) / math.log1p(self.hub_degree)
+        depth = (len(path.rstrip('/').split('/')) - 1) / self.max_depth
+        total = (self.new_site_weight * (domain not in self.graph.domains) + self.degree_weight * min(1., degree) +
+                 self.yield_weight * self.site_yield(source) + self.depth_weight * (1. - min(1., depth)))
+        return total / (self.new_site_weight + self.degree_weight + self.yield_weight + self.depth_weight)
+
+    def bucket(self, url: Url, source: str, priority: int) -> int:
+        if priority == DEPRIORITISED:
+            return self.n_buckets - 1
+        return min(self.n_buckets - 2, int((1. - self.score(url, source)) * (self.n_buckets - 1)))
+
+    def page_crawled(self, domain: str, links: Iterable[Url]):
+        """Updates the yield of the domain with the links of one of its pages, before they are added to the graph"""
+
+        new_sites = {HostScheduler.host(link) for link in links} - {domain}
+        stats = self._yields.setdefault(domain, [0, 0])
+        stats[0] += 1
+        stats[1] += sum(1 for site in new_sites if site not in self.graph.domains)
+
+
+class FrontierSpill:
+    """Redis sorted set keeping the urls which do not fit in the frontier, scored by their priority
+
+    put buffers the urls, flush writes them in one pipeline, refill moves the best ones back to the frontier, at most
+    batch_size at once, while it is less than low_watermark full.
+    """
+
+    def __init__(self, frontier: HostScheduler, key: str = 'frontier:spill', low_watermark: float = 0.5,
+                 batch_size: int = 1000):
+        self.frontier = frontier
+        self.key = key
+        self.low_watermark = low_watermark
+        self.batch_size = batch_size
+        self.n_spilled = 0
+        self.n_refilled = 0
+        self._buffer = []
+
+    def __repr__(self):
+        return 'FrontierSpill object: {} urls spilled, {} refilled'.format(self.n_spilled, self.n_refilled)
+
+    def put(self, url: Url, priority: int):
+        self._buffer.append((url, priority))
+
+    async def flush(self, redis_cache):
+        if not self._buffer:
+            return
+        pipe = redis_cache.pipeline()
+        for url, priority in self._buffer:
+            pipe.zadd(self.key, priority, url)
+        await pipe.execute()
+        self.n_spilled += len(self._buffer)
+        self._buffer = []
+
+    async def refill(self, redis_cache) -> int:
+        """Moves the best spilled urls back to the frontier and returns their number"""
+
+        room = min(self.batch_size, int(self.low_watermark * self.frontier.max_size) - self.frontier.qsize())
+        if room <= 0:
+            return 0
+        pipe = redis_cache.pipeline()
+        for priority in range(self.frontier.n_priorities):
+            pipe.zrangebyscore(self.key, priority, priority, offset=0, count=room)
+        moved = []
+        for priority, urls in enumerate(await pipe.execute()):
+            for url in urls[:room - len(moved)]:
+                if not self.frontier.put_nowait(url, priority):
+                    break
+                moved.append(url)
+        if moved:
+            await redis_cache.zrem(self.key, *moved)
+            self.n_refilled += len(moved)
+        return len(moved)
+
+    async def run(self, redis_cache, interval: float = 1.):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush(redis_cache)
+            await self.refill(redis_cache)
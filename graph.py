@@ -0,0 +1,366 @@
+"""
+Link graph of the crawl, stored as integer ids
+
+Urls and domains are interned to consecutive integer ids. The page -> page edges are appended to two uint32 arrays
+(source ids and target ids), spilled to column files once buffer_size edges are waiting, and the site -> site edges are
+counted in a dict keyed by the packed pair of ids. The in and out degrees of every page and site are kept up to date,
+so that hubs can be looked up while crawling.
+
+The graph is exported to a directory of columnar files: one raw little endian uint32 file per column (e.g
+pages.src.u32, pages.dst.u32, sites.count.u32), the urls.tsv and domains.tsv id dictionaries and a graph.json
+manifest, readable with numpy.fromfile or turned into Parquet by any dataframe library. write_edge_list streams the
+edges as text instead. A graph created on the directory of an export is loaded from it, so that a restarted crawl
+goes on with its graph.
+"""
+
+import heapq
+import json
+import logging
+import os
+import shutil
+import sys
+from array import array
+from typing import Iterable, Iterator, List, Tuple
+
+Url = str  # e.g: http://www.google.com/hello.php
+Domain = str  # e.g: www.google.com
+
+TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+CHUNK_SIZE = 64 * 1024  # edges read or written at once
+
+
+def _column(values: Iterable[int] = ()) -> array:
+    return array(TYPECODE, values)
+
+
+def _write_column(file, values: array):
+    if sys.byteorder == 'big':
+        values = array(TYPECODE, values)
+        values.byteswap()
+    values.tofile(file)
+
+
+def _read_column(file, n: int) -> array:
+    values = array(TYPECODE)
+    try:
+        values.fromfile(file, n)
+    except EOFError:
+        pass
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class Interner:
+    """Maps strings to consecutive integer ids"""
+
+    def __init__(self):
+        self.ids = {}  # value -> id
+        self.values = []  # type: List[str]
+
+    def __repr__(self):
+        return 'Interner object: {} values'.format(len(self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value: str) -> bool:
+        return value in self.ids
+
+    def id(self, value: str) -> int:
+        """Returns the id of the value, giving it a new one if needed"""
+
+        id_ = self.ids.get(value)
+        if id_ is None:
+            id_ = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return id_
+
+    def get(self, value: str) -> int:
+        """Returns the id of the value, or None if it has never been seen"""
+        return self.ids.get(value)
+
+    def value(self, id_: int) -> str:
+        return self.values[id_]
+
+
+class Degrees:
+    """In and out degrees of the nodes of a graph, indexed by node id"""
+
+    def __init__(self):
+        self.ins = _column()
+        self.outs = _column()
+
+    def grow(self, n: int):
+        if n > len(self.ins):
+            extra = _column([0]) * (n - len(self.ins))
+            self.ins.extend(extra)
+            self.outs.extend(extra)
+
+    def add(self, source: int, target: int):
+        self.grow(max(source, target) + 1)
+        self.outs[source] += 1
+        self.ins[target] += 1
+
+    def in_degree(self, id_: int) -> int:
+        return self.ins[id_] if id_ is not None and id_ < len(self.ins) else 0
+
+    def out_degree(self, id_: int) -> int:
+        return self.outs[id_] if id_ is not None and id_ < len(self.outs) else 0
+
+
+class EdgeStore:
+    """Append-only list of (source, target) edges
+
+    The edges are kept in two uint32 arrays. If directory is given, they are appended to the src.u32 and dst.u32
+    column files of the directory once buffer_size of them are waiting, so that memory stays bounded. The first
+    n_edges edges already in the column files are kept, the ones after them are dropped.
+    """
+
+    def __init__(self, directory: str = None, buffer_size: int = 10 ** 6, n_edges: int = 0):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.sources = _column()
+        self.targets = _column()
+        self.n_spilled = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            itemsize = array(TYPECODE).itemsize
+            paths = [os.path.join(directory, name) for name in ('src.u32', 'dst.u32')]
+            sizes = [os.path.getsize(path) // itemsize if os.path.exists(path) else 0 for path in paths]
+            self.n_spilled = min([n_edges] + sizes)
+            for path in paths:
+                with open(path, 'ab') as file:
+                    file.truncate(self.n_spilled * itemsize)
+
+    def __repr__(self):
+        return 'EdgeStore object: {} edges'.format(len(self))
+
+    def __len__(self):
+        return self.n_spilled + len(self.sources)
+
+    def append(self, source: int, target: int):
+        self.sources.append(source)
+        self.targets.append(target)
+        if self.directory is not None and len(self.sources) >= self.buffer_size:
+            self.spill()
+
+    def spill(self):
+        """Appends the buffered edges to the column files"""
+
+        with open(os.path.join(self.directory, 'src.u32'), 'ab') as file:
+            _write_column(file, self.sources)
+        with open(os.path.join(self.directory, 'dst.u32'), 'ab') as file:
+            _write_column(file, self.targets)
+        self.n_spilled += len(self.sources)
+        self.sources = _column()
+        self.targets = _column()
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[Tuple[array, array]]:
+        """Iterates over the edges as pairs of source and target arrays of at most size edges"""
+
+        if self.n_spilled:
+            with open(os.path.join(self.directory, 'src.u32'), 'rb') as sources, \
+                    open(os.path.join(self.directory, 'dst.u32'), 'rb') as targets:
+                for start in range(0, self.n_spilled, size):
+                    n = min(size, self.n_spilled - start)
+                    yield _read_column(sources, n), _read_column(targets, n)
+        for start in range(0, len(self.sources), size):
+            yield self.sources[start:start + size], self.targets[start:start + size]
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        for sources, targets in self.chunks():
+            yield from zip(sources, targets)
+
+
+class LinkGraph:
+    """Graph of the links between the crawled pages, and between their sites
+
+    add_page records the links of a crawled page, once: the links of a page crawled again are ignored. If
+    directory is given, the page edges are spilled to it, see EdgeStore, and the graph last exported to it is loaded.
+    If pages is False, only the sites and the links between them are kept, so that memory grows with the number of
+    sites instead of urls: the urls are not interned, and the links of a page crawled again are counted again.
+    """
+
+    def __init__(self, directory: str = None, buffer_size: int = 10 ** 6, pages: bool = True):
+        self.keep_pages = pages
+        self.urls = Interner()
+        self.domains = Interner()
+        self.page_degrees = Degrees()
+        # number of links from a site to another, by source << 32 | target
+        self.site_counts = {}
+        self.site_degrees = Degrees()
+        self._linked = bytearray()  # 1 for the ids of the pages whose links have been recorded
+        n_edges = 0
+        if directory and os.path.exists(os.path.join(directory, 'graph.json')):
+            n_edges = self.load(directory)
+        spill = os.path.join(directory, 'spill') if directory else None
+        self.pages = EdgeStore(spill, buffer_size, n_edges)
+        if len(self.pages) < n_edges:
+            # the spill files are gone, the edges are copied back from the export
+            for name in ('src', 'dst'):
+                shutil.copyfile(os.path.join(directory, 'pages.{}.u32'.format(name)),
+                                os.path.join(spill, name + '.u32'))
+            self.pages = EdgeStore(spill, buffer_size, n_edges)
+        if n_edges or len(self.domains):
+            logging.info('Loaded {} from {}'.format(self, directory))
+
+    def __repr__(self):
+        return 'LinkGraph object: {} pages, {} sites, {} links'.format(len(self.urls), len(self.domains),
+                                                                         len(self.pages))
+
+    @staticmethod
+    def url_to_domain(url: Url) -> Domain:
+        return url.replace('http://', '').replace('https://', '').split('/')[0]
+
+    def add_page(self, url: Url, links: Iterable[Url]):
+        if not self.keep_pages:
+            domain = self.domains.id(self.url_to_domain(url))
+            for link in set(links):
+                target_domain = self.domains.id(self.url_to_domain(link))
+                if target_domain != domain:
+                    self._add_site_link(domain, target_domain)
+            return
+        source = self.urls.id(url)
+        if source < len(self._linked) and self._linked[source]:
+            return
+        if source >= len(self._linked):
+            self._linked.extend(bytes(source + 1 - len(self._linked)))
+        self._linked[source] = 1
+        domain = self.domains.id(self.url_to_domain(url))
+        targets = {self.urls.id(link) for link in links if link != url}
+        for target in sorted(targets):
+            self.pages.append(source, target)
+            self.page_degrees.add(source, target)
+            target_domain = self.domains.id(self.url_to_domain(self.urls.value(target)))
+            if target_domain != domain:
+                self._add_site_link(domain, target_domain)
+
+    def _add_site_link(self, source: int, target: int):
+        key = source << 32 | target
+        count = self.site_counts.get(key, 0)
+        if not count:
+            self.site_degrees.add(source, target)
+        self.site_counts[key] = count + 1
+
+    def in_degree(self, url: Url) -> int:
+        """Number of crawled pages linking to the url"""
+        return self.page_degrees.in_degree(self.urls.get(url))
+
+    def out_degree(self, url: Url) -> int:
+        return self.page_degrees.out_degree(self.urls.get(url))
+
+    def site_in_degree(self, domain: Domain) -> int:
+        """Number of other sites linking to the domain"""
+        return self.site_degrees.in_degree(self.domains.get(domain))
+
+    def site_out_degree(self, domain: Domain) -> int:
+        return self.site_degrees.out_degree(self.domains.get(domain))
+
+    def site_links(self, source: Domain, target: Domain) -> int:
+        """Number of links from pages of source to pages of target"""
+
+        source, target = self.domains.get(source), self.domains.get(target)
+        if source is None or target is None:
+            return 0
+        return self.site_counts.get(source << 32 | target, 0)
+
+    def hubs(self, n: int = 10) -> List[Tuple[Domain, int]]:
+        """The n sites linked to by the most other sites, with their in degree"""
+
+        best = heapq.nlargest(n, range(len(self.site_degrees.ins)), key=self.site_degrees.ins.__getitem__)
+        return [(self.domains.value(id_), self.site_degrees.ins[id_]) for id_ in best]
+
+    def site_edges(self) -> Iterator[Tuple[int, int, int]]:
+        for key, count in self.site_counts.items():
+            yield key >> 32, key & 0xFFFFFFFF, count
+
+    def write_edge_list(self, path: str, sites: bool = False, names: bool = False):
+        """Streams the page edges, or the site edges with their counts, to a tab separated file, as ids or names"""
+
+        values = self.domains.value if sites else self.urls.value
+        with open(path, 'w', encoding='utf8') as file:
+            edges = self.site_edges() if sites else self.pages
+            for edge in edges:
+                if names:
+                    edge = (values(edge[0]), values(edge[1])) + edge[2:]
+                file.write('\t'.join(str(value) for value in edge) + '\n')
+
+    def load(self, directory: str) -> int:
+        """Loads the ids, degrees and site links of the graph exported to directory, returns its number of page
+        links, whose spilled column files are kept by the page EdgeStore"""
+
+        with open(os.path.join(directory, 'graph.json')) as file:
+            manifest = json.load(file)
+
+        def column(name: str) -> array:
+            return read_column(os.path.join(directory, manifest['columns'][name]))
+
+        interners = [('domains', self.domains)] + ([('urls', self.urls)] if self.keep_pages else [])
+        for name, interner in interners:
+            with open(os.path.join(directory, name + '.tsv'), encoding='utf8') as file:
+                for line in file:
+                    interner.id(line.rstrip('\n').split('\t', 1)[1])
+        self.site_degrees.ins, self.site_degrees.outs = column('sites.in_degree'), column('sites.out_degree')
+        for source, target, count in zip(column('sites.src'), column('sites.dst'), column('sites.count')):
+            self.site_counts[source << 32 | target] = count
+        if not self.keep_pages:
+            return 0
+        self.page_degrees.ins, self.page_degrees.outs = column('pages.in_degree'), column('pages.out_degree')
+        self._linked = bytearray(1 if degree else 0 for degree in self.page_degrees.outs)
+        return manifest['n_page_edges']
+
+    def export(self, directory: str):
+        """Writes the graph as columnar files and id dictionaries, described by graph.json. Every file is written
+        next to the previous one and renamed over it, graph.json last, so that an export interrupted by a crash leaves
+        files which can still be loaded."""
+
+        os.makedirs(directory, exist_ok=True)
+        if self.pages.directory is not None:
+            # the spilled edges are those of the export, to be kept when the graph is loaded again
+            self.pages.spill()
+        paths = []
+        for name, interner in (('urls', self.urls), ('domains', self.domains)):
+            paths.append(os.path.join(directory, name + '.tsv'))
+            with open(paths[-1] + '.tmp', 'w', encoding='utf8') as file:
+                for id_, value in enumerate(interner.values):
+                    file.write('{}\t{}\n'.format(id_, value))
+        columns = {'pages.src': 'pages.src.u32', 'pages.dst': 'pages.dst.u32', 'sites.src': 'sites.src.u32',
+                   'sites.dst': 'sites.dst.u32', 'sites.count': 'sites.count.u32',
+                   'pages.in_degree': 'pages.in_degree.u32', 'pages.out_degree': 'pages.out_degree.u32',
+                   'sites.in_degree': 'sites.in_degree.u32', 'sites.out_degree': 'sites.out_degree.u32'}
+        paths.extend(os.path.join(directory, path) for path in columns.values())
+        files = {name: open(os.path.join(directory, path) + '.tmp', 'wb') for name, path in columns.items()}
+        try:
+            for sources, targets in self.pages.chunks():
+                _write_column(files['pages.src'], sources)
+                _write_column(files['pages.dst'], targets)
+            edges = self.site_edges()
+            while True:
+                chunk = [edge for _, edge in zip(range(CHUNK_SIZE), edges)]
+                if not chunk:
+                    break
+                for i, name in enumerate(('sites.src', 'sites.dst', 'sites.count')):
+                    _write_column(files[name], _column(edge[i] for edge in chunk))
+            for name, degrees in (('pages', self.page_degrees), ('sites', self.site_degrees)):
+                degrees.grow(len(self.urls) if name == 'pages' else len(self.domains))
+                _write_column(files[name + '.in_degree'], degrees.ins)
+                _write_column(files[name + '.out_degree'], degrees.outs)
+        finally:
+            for file in files.values():
+                file.close()
+        manifest = {'format': 'uint32 little endian columns', 'columns': columns,
+                    'n_pages': len(self.urls), 'n_sites': len(self.domains), 'n_page_edges': len(self.pages),
+                    'n_site_edges': len(self.site_counts)}
+        paths.append(os.path.join(directory, 'graph.json'))
+        with open(paths[-1] + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+        for path in paths:
+            os.replace(path + '.tmp', path)
+
+
+def read_column(path: str) -> array:
+    """Reads a column file written by LinkGraph.export"""
+
+    with open(path, 'rb') as file:
+        return _read_column(file, os.path.getsize(path) // array(TYPECODE).itemsize)
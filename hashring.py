@@ -0,0 +1,57 @@
+"""
+Consistent hashing, used to assign domains to Tor circuits and to crawl shards
+"""
+
+import bisect
+import hashlib
+from typing import Iterable, List
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing ring: adding or removing a node only moves the keys of this node"""
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 100):
+        self.replicas = replicas
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def __repr__(self):
+        return 'HashRing object: {}'.format(', '.join(self.nodes))
+
+    def __len__(self):
+        return len(self._nodes) // self.replicas
+
+    def __contains__(self, node: str) -> bool:
+        return node in self._nodes
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(set(self._nodes))
+
+    def add(self, node: str):
+        if node in self:
+            return
+        for i in range(self.replicas):
+            position = hash_key('{}#{}'.format(node, i))
+            index = bisect.bisect(self._hashes, position)
+            self._hashes.insert(index, position)
+            self._nodes.insert(index, node)
+
+    def remove(self, node: str):
+        keep = [(position, other) for position, other in zip(self._hashes, self._nodes) if other != node]
+        self._hashes = [position for position, _ in keep]
+        self._nodes = [other for _, other in keep]
+
+    def get(self, key: str) -> str:
+        """Returns the node owning the given key"""
+
+        if not self._nodes:
+            raise LookupError('Empty hash ring')
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._hashes)
+        return self._nodes[index]
@@ -0,0 +1,126 @@
+"""
+Per-host health: adaptive timeouts, retry backoff and circuit breaking
+
+The timeout of a host follows its observed latency like the TCP retransmission timeout: a smoothed latency plus four
+times its mean deviation, bounded by min_timeout and max_timeout, and doubled at each retry of a url. After
+failure_threshold consecutive failures the breaker of the host opens: its urls are parked for open_time seconds, then
+a single probe is let through. A successful probe closes the breaker, a failed one opens it again for twice as long, up
+to max_open_time.
+"""
+
+import random
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class HostHealth:
+    """Latency estimate and breaker state of one host"""
+
+    __slots__ = ('latency', 'deviation', 'n_failures', 'state', 'open_time', 'open_until', 'n_requests')
+
+    def __init__(self):
+        self.latency = None
+        self.deviation = 0.
+        self.n_failures = 0
+        self.state = CLOSED
+        self.open_time = 0.
+        self.open_until = 0.
+        self.n_requests = 0
+
+    def __repr__(self):
+        return 'HostHealth object: {} (latency {}, {} failures)'.format(self.state, self.latency, self.n_failures)
+
+
+class HostTracker:
+    """Tracks the health of the crawled hosts"""
+
+    def __init__(self, min_timeout: float = 5., max_timeout: float = 20., alpha: float = 0.125, beta: float = 0.25,
+                 failure_threshold: int = 5, open_time: float = 60., max_open_time: float = 3600.,
+                 max_retries: int = 2, retry_delay: float = 2., max_hosts: int = 10 ** 6):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.failure_threshold = failure_threshold
+        self.base_open_time = open_time
+        self.max_open_time = max_open_time
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_hosts = max_hosts
+        self.hosts = {}  # host -> HostHealth
+
+    def __repr__(self):
+        return 'HostTracker object: {} hosts, {} open'.format(len(self.hosts), self.n_open)
+
+    @property
+    def n_open(self) -> int:
+        return sum(1 for health in self.hosts.values() if health.state != CLOSED)
+
+    def health(self, host: str) -> HostHealth:
+        health = self.hosts.get(host)
+        if health is None:
+            if len(self.hosts) >= self.max_hosts:
+                # forget the healthy hosts first, their state is only a latency estimate
+                self.hosts = {other: h for other, h in self.hosts.items() if h.state != CLOSED}
+            health = self.hosts[host] = HostHealth()
+        return health
+
+    def timeout(self, host: str, attempt: int = 0) -> float:
+        health = self.hosts.get(host)
+        if health is None or health.latency is None:
+            timeout = self.max_timeout
+        else:
+            timeout = max(self.min_timeout, health.latency + 4 * health.deviation)
+        return min(self.max_timeout * 2 ** attempt, timeout * 2 ** attempt)
+
+    def allow(self, host: str) -> bool:
+        """Returns whether a request may be sent to the host, turning an open breaker into a probe once its open
+        time has elapsed"""
+
+        health = self.hosts.get(host)
+        if health is None or health.state == CLOSED:
+            return True
+        if health.state == OPEN and time.monotonic() >= health.open_until:
+            health.state = HALF_OPEN
+            return True
+        return False
+
+    def parked_for(self, host: str) -> float:
+        """Seconds before the breaker of the host may let a request through, 0 if it is closed"""
+
+        health = self.hosts.get(host)
+        if health is None or health.state == CLOSED:
+            return 0.
+        if health.state == HALF_OPEN:
+            return self.max_timeout
+        return max(0., health.open_until - time.monotonic())
+
+    def record(self, host: str, latency: float, ok: bool = True):
+        health = self.health(host)
+        health.n_requests += 1
+        if ok:
+            if health.latency is None:
+                health.latency, health.deviation = latency, latency / 2
+            else:
+                health.deviation += self.beta * (abs(latency - health.latency) - health.deviation)
+                health.latency += self.alpha * (latency - health.latency)
+            health.n_failures = 0
+            health.state = CLOSED
+            health.open_time = 0.
+            return
+        health.n_failures += 1
+        if health.state == HALF_OPEN or health.n_failures >= self.failure_threshold:
+            health.open_time = min(self.max_open_time, health.open_time * 2 or self.base_open_time)
+            health.open_until = time.monotonic() + health.open_time
+            health.state = OPEN
+
+    def should_retry(self, attempt: int) -> bool:
+        return attempt < self.max_retries
+
+    def backoff(self, attempt: int) -> float:
+        """Jittered exponential delay before the given retry"""
+
+        return self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
@@ -0,0 +1,210 @@
+"""
+In-memory stand-ins for Redis and MongoDB, to run the spider offline in tests and benchmarks
+
+Only the commands used by the spider are implemented. The stand-ins count the commands and round trips they serve,
+a pipeline being a single round trip.
+"""
+
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+
+class MemoryPipeline:
+
+    def __init__(self, redis: 'MemoryRedis'):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self) -> List:
+        self.redis.n_round_trips += 1
+        results = []
+        for name, args, kwargs in self.commands:
+            results.append(await getattr(self.redis, name)(*args, _pipelined=True, **kwargs))
+        return results
+
+
+def command(method):
+    """Counts the calls of a MemoryRedis command, and the round trips of the ones which are not pipelined"""
+
+    async def wrapper(self, *args, _pipelined=False, **kwargs):
+        self.n_commands += 1
+        if not _pipelined:
+            self.n_round_trips += 1
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class MemoryRedis:
+    """Class which implements the aioredis commands used by the spider on plain Python containers"""
+
+    def __init__(self):
+        self.data = {}
+        self.n_commands = 0
+        self.n_round_trips = 0
+
+    def __repr__(self):
+        return 'MemoryRedis object: {} keys'.format(len(self.data))
+
+    def pipeline(self) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+    @command
+    def sadd(self, key, *members):
+        values = self.data.setdefault(key, set())
+        added = set(members) - values
+        values.update(added)
+        return len(added)
+
+    @command
+    def srem(self, key, *members):
+        values = self.data.get(key, set())
+        removed = values & set(members)
+        values.difference_update(removed)
+        return len(removed)
+
+    @command
+    def sismember(self, key, member):
+        return int(member in self.data.get(key, ()))
+
+    @command
+    def scard(self, key):
+        return len(self.data.get(key, ()))
+
+    @command
+    def srandmember(self, key, count):
+        values = list(self.data.get(key, ()))
+        return random.sample(values, min(count, len(values)))
+
+    @command
+    def zadd(self, key, score, member):
+        self.data.setdefault(key, {})[member] = score
+
+    @command
+    def zrem(self, key, *members):
+        for member in members:
+            self.data.get(key, {}).pop(member, None)
+
+    @command
+    def zrange(self, key, start, stop):
+        members = [member for _, member in sorted((score, member) for member, score in self.data.get(key, {}).items())]
+        return members[start:] if stop == -1 else members[start:stop + 1]
+
+    @command
+    def zrangebyscore(self, key, min=float('-inf'), max=float('inf'), offset=0, count=None):
+        members = sorted((score, member) for member, score in self.data.get(key, {}).items() if min <= score <= max)
+        members = [member for _, member in members][offset:]
+        return members if count is None else members[:count]
+
+    @command
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+
+    @command
+    def lrange(self, key, start, stop):
+        values = self.data.get(key, [])
+        return values[start:] if stop == -1 else values[start:stop + 1]
+
+    @command
+    def rename(self, key, new_key):
+        self.data[new_key] = self.data.pop(key)
+
+    @command
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    @command
+    def get(self, key):
+        return self.data.get(key)
+
+    @command
+    def set(self, key, value):
+        self.data[key] = value
+
+    @command
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    @command
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    @command
+    def hmset(self, key, *pairs):
+        self.data.setdefault(key, {}).update(zip(pairs[::2], pairs[1::2]))
+
+    @command
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    async def execute(self, name, key, *args, _pipelined=False):
+        """XADD key MAXLEN ~ n * field value ... and XREAD COUNT n BLOCK ms STREAMS key last_id"""
+
+        self.n_commands += 1
+        self.n_round_trips += not _pipelined
+        if name == 'XADD':
+            entries = self.data.setdefault(key, [])
+            entries.append(('{}-0'.format(len(entries) + 1), list(args[4:])))
+            return entries[-1][0]
+        if name == 'XREAD':
+            count, block, stream, last_id = args[0], args[2], args[4], args[5]
+            after = int(last_id.split('-')[0])
+            entries = [entry for entry in self.data.get(stream, []) if int(entry[0].split('-')[0]) > after][:count]
+            if not entries and block:
+                await asyncio.sleep(block / 1000)
+            return [[stream, entries]] if entries else None
+        raise NotImplementedError(name)
+
+
+class MemoryPool:
+    """Stand-in for an aioredis pool, whose connections all share the same MemoryRedis"""
+
+    def __init__(self, redis: MemoryRedis = None):
+        self.redis = redis or MemoryRedis()
+
+    def __repr__(self):
+        return 'MemoryPool object'
+
+    def get(self):
+        return self
+
+    async def __aenter__(self) -> MemoryRedis:
+        return self.redis
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def clear(self):
+        pass
+
+
+class MemoryCollection:
+    """Stand-in for a motor collection, supporting the bulk writes of ArchiveWriter. Documents are kept in insertion
+    order along with the time they were written."""
+
+    def __init__(self):
+        self.docs = OrderedDict()
+        self.write_times = {}
+        self.n_bulks = 0
+
+    def __repr__(self):
+        return 'MemoryCollection object: {} documents'.format(len(self.docs))
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        self.n_bulks += 1
+        now = time.monotonic()
+        for request in requests:
+            doc = request._doc
+            self.docs[doc['_id']] = doc
+            self.write_times[doc['_id']] = now
+
+    def find_one(self, query: Dict) -> Dict:
+        return self.docs.get(query.get('_id'))
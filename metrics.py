@@ -0,0 +1,259 @@
+"""
+Crawl metrics: counters, gauges and histograms, rendered in the Prometheus text format or dumped as JSON
+
+Recording a value is a dict lookup and an addition, cheap enough to stay enabled while crawling. Gauges of values the
+spider already holds, like the frontier size, are read from a function when the metrics are rendered. The stage
+timings of the hot path (fetch, parse, archive...) are only recorded when the registry is created with timings=True.
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 20., 40.)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"')) for key, value in labels) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, description: str = ''):
+        self.name = name
+        self.description = description
+        self.values = {}
+
+    def __repr__(self):
+        return '{} object: {}'.format(type(self).__name__, self.name)
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+    def to_dict(self):
+        if list(self.values) == [()]:
+            return self.values[()]
+        return {_format_labels(labels): value for labels, value in self.values.items()}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels(labels) if labels else ()
+        self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        return self.values.get(_labels(labels), 0)
+
+
+class Gauge(Metric):
+    """Gauge set by the spider, or read from function when rendered. The function may return a number or a dict of
+    label values to numbers, for one label named label"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str = '', function: Callable = None, label: str = None):
+        super().__init__(name, description)
+        self.function = function
+        self.label = label
+
+    def set(self, value: float, **labels):
+        self.values[_labels(labels)] = value
+
+    def collect(self):
+        if self.function is None:
+            return
+        value = self.function()
+        if isinstance(value, dict):
+            self.values = {((self.label, key),): number for key, number in value.items()}
+        else:
+            self.values = {(): value}
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str = '', buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels) if labels else ()
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.]  # buckets, +Inf, sum
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, **labels) -> int:
+        return sum(self.values.get(_labels(labels), [0])[:-1])
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield self.name + '_bucket', labels + (('le', bound),), total
+            yield self.name + '_count', labels, total
+            yield self.name + '_sum', labels, counts[-1]
+
+    def to_dict(self):
+        stats = {}
+        for labels, counts in self.values.items():
+            n = sum(counts[:-1])
+            stats[_format_labels(labels) or 'all'] = {'count': n, 'mean': counts[-1] / n if n else 0.}
+        return stats
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Metrics:
+    """Registry of the metrics of a crawl process"""
+
+    def __init__(self, prefix: str = 'aiospider_', timings: bool = False):
+        self.prefix = prefix
+        self.timings = timings
+        self.metrics = OrderedDict()
+
+    def __repr__(self):
+        return 'Metrics object: {} metrics'.format(len(self.metrics))
+
+    def _get(self, cls, name: str, *args, **kwargs) -> Metric:
+        name = self.prefix + name
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, description: str = '') -> Counter:
+        return self._get(Counter, name, description)
+
+    def gauge(self, name: str, description: str = '', function: Callable = None, label: str = None) -> Gauge:
+        return self._get(Gauge, name, description, function, label)
+
+    def histogram(self, name: str, description: str = '', buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, buckets)
+
+    def time(self, name: str, **labels):
+        """Context manager recording the duration of its block in the name histogram"""
+        return _Timer(self.histogram(name), labels)
+
+    def stage(self, stage: str):
+        """Times a stage of the hot path in the stage_seconds histogram, if timings are enabled"""
+        if not self.timings:
+            return _NO_TIMER
+        return _Timer(self.histogram('stage_seconds', 'Duration of the crawl stages'), {'stage': stage})
+
+    def collect(self):
+        for metric in self.metrics.values():
+            if isinstance(metric, Gauge):
+                metric.collect()
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+
+        self.collect()
+        lines = []
+        for metric in self.metrics.values():
+            if metric.description:
+                lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> Dict:
+        self.collect()
+        return {name: metric.to_dict() for name, metric in self.metrics.items()}
+
+
+class RateMeter:
+    """Sets the rate of a counter and the ratio of two counters since the last update as gauges, e.g pages per second
+    and error rate"""
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self._last = {}
+        self._last_time = time.monotonic()
+
+    def update(self, rates: Dict[str, Counter], ratios: Dict[str, Tuple[Counter, Counter]]):
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        deltas = {}
+        for counter in set(rates.values()) | {counter for pair in ratios.values() for counter in pair}:
+            total = sum(counter.values.values())
+            deltas[counter.name] = total - self._last.get(counter.name, 0)
+            self._last[counter.name] = total
+        for name, counter in rates.items():
+            self.metrics.gauge(name).set(deltas[counter.name] / elapsed)
+        for name, (part, whole) in ratios.items():
+            self.metrics.gauge(name).set(deltas[part.name] / deltas[whole.name] if deltas[whole.name] else 0.)
+        self._last_time = now
+
+
+async def serve(metrics: Metrics, host: str = '127.0.0.1', port: int = 9100):
+    """Serves the metrics in the Prometheus text format on http://host:port/metrics"""
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            if request.split()[1:2] == [b'/metrics']:
+                status, body = '200 OK', metrics.render().encode('utf8')
+            else:
+                status, body = '404 Not Found', b''
+            writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n'.format(
+                status, len(body)).encode('ascii') + body)
+            await writer.drain()
+        except Exception as exc:
+            logging.warning('Metrics request failed: {}'.format(exc))
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+def write_json(metrics: Metrics, path: str):
+    with open(path, 'w') as file:
+        json.dump(metrics.to_dict(), file, indent=2, sort_keys=True)
@@ -0,0 +1,114 @@
+"""
+Incremental re-crawl: conditional requests and adaptive revisit scheduling
+
+The validators of each crawled url (ETag, Last-Modified and content hash) and its revisit interval are kept in the
+'revisit:meta' Redis hash, and the 'revisit' sorted set holds the urls scored by their next visit time. The interval
+of a page is halved each time it changed since the previous visit and grows when it did not, so that pages are
+revisited about as often as they change. Each crawl shard has its own revisit queue, named after it.
+"""
+
+import json
+import logging
+import time
+from typing import Dict, List
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+META_KEY = 'revisit:meta'
+QUEUE_KEY = 'revisit'
+
+
+class RevisitScheduler:
+    """Stores the validators of the crawled pages and schedules their next visit
+
+    Urls returned by due are postponed by lease_time seconds, so that they come back if they could not be crawled.
+    """
+
+    def __init__(self, initial_interval: float = 24 * 3600., min_interval: float = 3600.,
+                 max_interval: float = 30 * 24 * 3600., backoff: float = 1.5, lease_time: float = 3600.,
+                 name: str = QUEUE_KEY):
+        self.initial_interval = initial_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.lease_time = lease_time
+        self.name = name
+        self.n_unchanged = 0
+        self.n_changed = 0
+
+    def __repr__(self):
+        return 'RevisitScheduler object: {} changed, {} unchanged'.format(self.n_changed, self.n_unchanged)
+
+    async def validators(self, redis_cache, url: Url) -> Dict:
+        meta = await redis_cache.hget(META_KEY, url)
+        return json.loads(meta) if meta else {}
+
+    @staticmethod
+    def conditional_headers(validators: Dict) -> Dict[str, str]:
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def next_interval(self, validators: Dict, changed: bool) -> float:
+        interval = validators.get('interval')
+        if interval is None:
+            return self.initial_interval
+        interval = interval / 2 if changed else interval * self.backoff
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    async def update(self, redis_cache, url: Url, validators: Dict, status: int, headers: Dict,
+                     content_hash: str = None, priority: int = None) -> bool:
+        """Records a visit of the url and schedules the next one. Returns whether the page changed since the
+        previous visit: a 304 response or the same content hash mean it did not. priority is the frontier priority
+        the url is revisited with."""
+
+        changed = status != 304 and content_hash != validators.get('content_hash')
+        interval = self.next_interval(validators, changed)
+        meta = {'etag': headers.get('ETag') or validators.get('etag'),
+                'last_modified': headers.get('Last-Modified') or validators.get('last_modified'),
+                'content_hash': content_hash or validators.get('content_hash'),
+                'interval': interval,
+                'n_visits': validators.get('n_visits', 0) + 1,
+                'n_changes': validators.get('n_changes', 0) + int(changed and 'content_hash' in validators),
+                'priority': validators.get('priority') if priority is None else priority}
+        pipe = redis_cache.pipeline()
+        pipe.hset(META_KEY, url, json.dumps(meta))
+        pipe.zadd(self.name, time.time() + interval, url)
+        await pipe.execute()
+        if 'content_hash' in validators:
+            if changed:
+                self.n_changed += 1
+            else:
+                self.n_unchanged += 1
+        return changed
+
+    async def due(self, redis_cache, count: int = 100) -> List[Url]:
+        """Returns at most count urls whose revisit time has passed"""
+
+        now = time.time()
+        urls = await redis_cache.zrangebyscore(self.name, max=now, offset=0, count=count)
+        if urls:
+            pipe = redis_cache.pipeline()
+            for url in urls:
+                pipe.zadd(self.name, now + self.lease_time, url)
+            await pipe.execute()
+            logging.debug('{} urls due for a revisit'.format(len(urls)))
+        return urls
+
+    async def priorities(self, redis_cache, urls: List[Url], default: int) -> Dict[Url, int]:
+        """Returns the frontier priority recorded for each url, or default"""
+
+        if not urls:
+            return {}
+        pipe = redis_cache.pipeline()
+        for url in urls:
+            pipe.hget(META_KEY, url)
+        metas = await pipe.execute()
+        priorities = {}
+        for url, meta in zip(urls, metas):
+            priority = json.loads(meta).get('priority') if meta else None
+            priorities[url] = default if priority is None else priority
+        return priorities
@@ -0,0 +1,301 @@
+"""
+robots.txt rules and sitemaps
+
+The robots.txt of a host is fetched once, and its rules for our user agent are compiled into a matcher: plain path
+prefixes are checked with str.startswith, patterns with wildcards with a regular expression, the longest matching rule
+deciding as in RFC 9309. RobotsCache keeps the rules of the recently crawled hosts in memory, and of all of them in a
+Redis hash, shared by the shards and across restarts, for ttl seconds.
+
+Sitemaps and sitemap indexes, gzip compressed or not, are parsed incrementally by SitemapParser as their chunks are
+received, so that a large sitemap never has to be held in memory.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Tuple
+from xml.etree import ElementTree
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+AGENT = 'aiospider'
+ROBOTS_KEY = 'robots'  # hash of host -> JSON rules and expiry time
+MAX_SITEMAP_BYTES = 50 * 2 ** 20  # the limit of the sitemaps protocol, uncompressed
+INFLATE_SIZE = 2 ** 16  # most bytes decompressed at once from a gzip sitemap
+
+_line = re.compile(r'^\s*([A-Za-z-]+)\s*:\s*(.*?)\s*$')
+
+
+def url_path(url: Url) -> str:
+    """Path and query of the url, e.g /hello.php?a=1 for http://www.google.com/hello.php?a=1"""
+
+    parts = url.split('/', 3)
+    return '/' + parts[3] if len(parts) > 3 else '/'
+
+
+def _matcher(pattern: str) -> Callable[[str], bool]:
+    if '*' not in pattern and not pattern.endswith('$'):
+        return lambda path: path.startswith(pattern)
+    regex = '.*'.join(re.escape(part) for part in pattern.rstrip('$').split('*'))
+    return re.compile(regex + ('$' if pattern.endswith('$') else '')).match
+
+
+class RobotsRules:
+    """Allow and disallow rules of a robots.txt for one user agent"""
+
+    __slots__ = ('rules', 'crawl_delay', 'sitemaps', '_matchers')
+
+    def __init__(self, rules: Iterable[Tuple[str, bool]] = (), crawl_delay: float = None,
+                 sitemaps: Iterable[Url] = ()):
+        """rules are (path pattern, allow) pairs"""
+        # longest pattern first, allow before disallow for patterns of the same length
+        self.rules = sorted(set(rules), key=lambda rule: (-len(rule[0]), not rule[1]))
+        self.crawl_delay = crawl_delay
+        self.sitemaps = list(sitemaps)
+        self._matchers = [(_matcher(pattern), allow) for pattern, allow in self.rules]
+
+    def __repr__(self):
+        return 'RobotsRules object: {} rules'.format(len(self.rules))
+
+    def allowed(self, url: Url) -> bool:
+        if not self._matchers:
+            return True
+        path = url_path(url)
+        if path == '/robots.txt':
+            return True
+        for match, allow in self._matchers:
+            if match(path):
+                return allow
+        return True
+
+    def to_json(self) -> str:
+        return json.dumps({'rules': self.rules, 'crawl_delay': self.crawl_delay, 'sitemaps': self.sitemaps})
+
+    @classmethod
+    def from_json(cls, data: str) -> 'RobotsRules':
+        data = json.loads(data)
+        return cls([tuple(rule) for rule in data['rules']], data['crawl_delay'], data['sitemaps'])
+
+
+def parse_robots(text: str, agent: str = AGENT) -> RobotsRules:
+    """Returns the rules of the group of the agent, or of the * group if there is none. Groups are matched on the
+    product token of the agent, e.g aiospider for aiospider/1.0, case-insensitively, and the groups of the same agent
+    are merged."""
+
+    groups = {}  # product token -> (rules, crawl delay)
+    agents = []
+    in_rules = False
+    sitemaps = []
+    for line in text.splitlines():
+        match = _line.match(line.split('#', 1)[0])
+        if not match:
+            continue
+        field, value = match.group(1).lower(), match.group(2)
+        if field == 'sitemap':
+            sitemaps.append(value)
+        elif field == 'user-agent':
+            if in_rules:
+                agents = []
+                in_rules = False
+            name = _product(value)
+            agents.append(name)
+            groups.setdefault(name, ([], None))
+        elif field in ('allow', 'disallow', 'crawl-delay') and agents:
+            in_rules = True
+            if field == 'crawl-delay':
+                try:
+                    delay = float(value)
+                except ValueError:
+                    continue
+                for name in agents:
+                    # the longest delay of the merged groups
+                    rules, previous = groups[name]
+                    groups[name] = (rules, delay if previous is None else max(previous, delay))
+            elif value:
+                for name in agents:
+                    groups[name][0].append((value, field == 'allow'))
+    name = _product(agent)
+    return RobotsRules(*groups.get(name if name in groups else '*', ((), None)), sitemaps=sitemaps)
+
+
+def _product(agent: str) -> str:
+    """Product token of a user agent, e.g aiospider for aiospider/1.0"""
+    return agent.split('/', 1)[0].strip().lower()
+
+
+class RobotsCache:
+    """Rules of the crawled hosts, cached for ttl seconds
+
+    The rules of at most max_hosts hosts are kept in memory, the least recently used ones being dropped first, and all
+    of them in the key hash of Redis. The rules of a host whose robots.txt could not be fetched allow everything, and
+    are cached for retry_ttl seconds only.
+    """
+
+    def __init__(self, ttl: float = 24 * 3600., retry_ttl: float = 600., agent: str = AGENT,
+                 max_hosts: int = 10 ** 5, key: str = ROBOTS_KEY):
+        self.ttl = ttl
+        self.retry_ttl = retry_ttl
+        self.agent = agent
+        self.max_hosts = max_hosts
+        self.key = key
+        self.n_fetched = 0
+        self._rules = OrderedDict()  # host -> (expiry time, RobotsRules)
+        self._pending = {}  # host -> asyncio.Future of the fetch in progress
+
+    def __repr__(self):
+        return 'RobotsCache object: {} hosts'.format(len(self._rules))
+
+    def get(self, host: str) -> RobotsRules:
+        """Rules of the host if they are in memory and have not expired, None otherwise"""
+
+        entry = self._rules.get(host)
+        if entry is None or entry[0] < time.time():
+            return None
+        self._rules.move_to_end(host)
+        return entry[1]
+
+    def set(self, host: str, rules: RobotsRules, ttl: float = None):
+        self._rules[host] = (time.time() + (self.ttl if ttl is None else ttl), rules)
+        self._rules.move_to_end(host)
+        while len(self._rules) > self.max_hosts:
+            self._rules.popitem(last=False)
+
+    def allowed(self, url: Url) -> bool:
+        """Checks the url against the rules of its host in memory, allowing it if they are unknown"""
+
+        rules = self.get(url.replace('http://', '').replace('https://', '').split('/')[0])
+        return rules is None or rules.allowed(url)
+
+    async def rules(self, redis_cache, host: str, fetch) -> Tuple[RobotsRules, bool]:
+        """Returns the rules of the host and whether they have just been fetched. fetch is a coroutine function
+        returning the status and the text of the robots.txt of a host. Concurrent calls for the same host share the
+        same fetch."""
+
+        rules = self.get(host)
+        if rules is not None:
+            return rules, False
+        pending = self._pending.get(host)
+        if pending is not None:
+            return await asyncio.shield(pending), False
+        future = self._pending[host] = asyncio.get_event_loop().create_future()
+        fetched = False
+        try:
+            cached = await redis_cache.hget(self.key, host)
+            if cached:
+                expires, data = cached.split(' ', 1)
+                if float(expires) > time.time():
+                    rules = RobotsRules.from_json(data)
+                    self.set(host, rules, float(expires) - time.time())
+            if rules is None:
+                rules, ttl = await self._fetch(host, fetch)
+                fetched = True
+                self.set(host, rules, ttl)
+                await redis_cache.hset(self.key, host, '{} {}'.format(time.time() + ttl, rules.to_json()))
+            future.set_result(rules)
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            del self._pending[host]
+        return rules, fetched
+
+    async def _fetch(self, host: str, fetch) -> Tuple[RobotsRules, float]:
+        self.n_fetched += 1
+        try:
+            status, text = await fetch(host)
+        except Exception as exc:
+            logging.debug('Could not fetch the robots.txt of {}: {}'.format(host, exc))
+            return RobotsRules(), self.retry_ttl
+        if 200 <= status < 300:
+            return parse_robots(text, self.agent), self.ttl
+        if 400 <= status < 500:
+            return RobotsRules(), self.ttl
+        return RobotsRules(), self.retry_ttl
+
+
+class SitemapParser:
+    """Incremental parser of a sitemap or a sitemap index, gzip compressed or not
+
+    feed takes the chunks of the body and returns the page urls found in them, the sitemaps listed by an index are
+    added to sitemaps. At most max_urls page urls are returned, and a compressed sitemap is decompressed
+    INFLATE_SIZE bytes at a time up to max_bytes.
+    """
+
+    def __init__(self, max_urls: int = 50000, max_bytes: int = MAX_SITEMAP_BYTES):
+        self.max_urls = max_urls
+        self.max_bytes = max_bytes
+        self.n_urls = 0
+        self.n_bytes = 0
+        self.sitemaps = []  # type: List[Url]
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self._decompressor = None
+        self._started = False
+        self._root = None
+
+    def __repr__(self):
+        return 'SitemapParser object: {} urls, {} sitemaps'.format(self.n_urls, len(self.sitemaps))
+
+    def feed(self, chunk: bytes) -> List[Url]:
+        if not self._started:
+            self._started = True
+            if chunk[:2] == b'\x1f\x8b':
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._decompressor is None:
+            return self._feed(chunk)
+        urls = []
+        try:
+            while self.n_bytes < self.max_bytes:
+                data = self._decompressor.decompress(chunk, min(INFLATE_SIZE, self.max_bytes - self.n_bytes))
+                if not data:
+                    break
+                chunk = self._decompressor.unconsumed_tail
+                self.n_bytes += len(data)
+                urls.extend(self._feed(data))
+        except zlib.error as exc:
+            logging.debug('Invalid sitemap: {}'.format(exc))
+        return urls
+
+    def _feed(self, data: bytes) -> List[Url]:
+        try:
+            self._parser.feed(data)
+        except ElementTree.ParseError as exc:
+            logging.debug('Invalid sitemap: {}'.format(exc))
+            return []
+        return self._urls()
+
+    def close(self) -> List[Url]:
+        try:
+            if self._decompressor is not None and self.n_bytes < self.max_bytes:
+                self._parser.feed(self._decompressor.flush())
+            self._parser.close()
+        except (ElementTree.ParseError, zlib.error) as exc:
+            logging.debug('Invalid sitemap: {}'.format(exc))
+        return self._urls()
+
+    def _urls(self) -> List[Url]:
+        urls = []
+        try:
+            for event, element in self._parser.read_events():
+                if event == 'start':
+                    if self._root is None:
+                        self._root = element
+                    continue
+                tag = element.tag.rsplit('}', 1)[-1]
+                if tag not in ('url', 'sitemap'):
+                    continue
+                loc = next((child.text.strip() for child in element
+                            if child.tag.rsplit('}', 1)[-1] == 'loc' and child.text), None)
+                if loc and tag == 'sitemap':
+                    self.sitemaps.append(loc)
+                elif loc and self.n_urls < self.max_urls:
+                    urls.append(loc)
+                    self.n_urls += 1
+                # the parsed entries are dropped to keep the memory bounded
+                self._root.clear()
+        except ElementTree.ParseError as exc:
+            logging.debug('Invalid sitemap: {}'.format(exc))
+        return urls
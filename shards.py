@@ -0,0 +1,156 @@
+"""
+Sharded crawling: each crawl process owns the domains that a consistent hash ring assigns to it
+
+Shards announce themselves with a heartbeat in the 'shards' sorted set and rebuild their ring from the live members,
+so that shards can join or die while the others keep running. The links found for a domain owned by another shard are
+forwarded to the 'shard:<name>' Redis stream of its owner. The urls a shard already queued for a domain which moved to
+a new shard are still crawled by it: only the new links go to the new owner.
+"""
+
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+from hashring import HashRing
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+SHARDS_KEY = 'shards'
+OFFSETS_KEY = 'shards:offsets'
+STOP_KEY = 'shards:stop'
+STREAM_KEY = 'shard:{}'
+STATS_KEY = 'shard:{}:stats'
+
+
+def url_to_domain(url: Url) -> str:
+    return url.replace('http://', '').replace('https://', '').split('/')[0]
+
+
+class ShardRouter:
+    """Routes urls to the shard owning their domain
+
+    Each stream entry holds all the urls a page forwarded to a shard, as url -> priority fields. The id of the last
+    entry read is saved in Redis so that a restarted shard goes on where it stopped, and the streams are capped to
+    about max_stream entries.
+    """
+
+    def __init__(self, name: str, heartbeat: float = 5., ttl: float = 15., batch_size: int = 100,
+                 max_stream: int = 10 ** 5):
+        self.name = name
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.max_stream = max_stream
+        self.ring = HashRing([name])
+        self.n_forwarded = 0
+        self.n_received = 0
+        self._last_id = '0-0'
+
+    def __repr__(self):
+        return 'ShardRouter object: {} in {}'.format(self.name, ', '.join(self.ring.nodes))
+
+    def owner(self, url: Url) -> str:
+        return self.ring.get(url_to_domain(url))
+
+    def owns(self, url: Url) -> bool:
+        return self.owner(url) == self.name
+
+    async def join(self, redis_cache):
+        """Registers the shard and loads the live members and the position of the shard in its stream"""
+
+        await redis_cache.zadd(SHARDS_KEY, time.time(), self.name)
+        self._last_id = await redis_cache.hget(OFFSETS_KEY, self.name) or '0-0'
+        await self.refresh(redis_cache)
+
+    async def leave(self, redis_cache):
+        await redis_cache.zrem(SHARDS_KEY, self.name)
+
+    async def refresh(self, redis_cache) -> bool:
+        """Rebuilds the ring from the shards which sent a heartbeat in the last ttl seconds, returns whether it
+        changed"""
+
+        live = set(await redis_cache.zrangebyscore(SHARDS_KEY, min=time.time() - self.ttl))
+        live.add(self.name)
+        current = set(self.ring.nodes)
+        if live == current:
+            return False
+        for name in current - live:
+            self.ring.remove(name)
+        for name in live - current:
+            self.ring.add(name)
+        logging.info('Shard {}: ring is now {}'.format(self.name, ', '.join(self.ring.nodes)))
+        return True
+
+    async def beat(self, redis_cache, stats: Dict[str, int]) -> bool:
+        """Sends a heartbeat with the stats of the shard and refreshes the ring. Returns True when the shards have
+        been asked to stop"""
+
+        pipe = redis_cache.pipeline()
+        pipe.zadd(SHARDS_KEY, time.time(), self.name)
+        fields = []
+        for key, value in sorted(stats.items()):
+            fields.extend((key, value))
+        pipe.hmset(STATS_KEY.format(self.name), *fields)
+        pipe.get(STOP_KEY)
+        _, _, stop = await pipe.execute()
+        await self.refresh(redis_cache)
+        return bool(stop)
+
+    async def forward(self, redis_cache, priorities: Dict[Url, int]) -> Dict[Url, int]:
+        """Sends the urls owned by other shards to their stream, returns the ones owned by this shard"""
+
+        local = {}
+        foreign = defaultdict(list)
+        for url, priority in priorities.items():
+            owner = self.owner(url)
+            if owner == self.name:
+                local[url] = priority
+            else:
+                foreign[owner].extend((url, priority))
+        for owner, fields in foreign.items():
+            await redis_cache.execute('XADD', STREAM_KEY.format(owner), 'MAXLEN', '~', self.max_stream, '*',
+                                      *fields)
+            self.n_forwarded += len(fields) // 2
+        return local
+
+    async def receive(self, redis_cache, timeout: float = 1.) -> Dict[Url, int]:
+        """Reads the urls forwarded to this shard, waiting at most timeout seconds for new ones"""
+
+        reply = await redis_cache.execute('XREAD', 'COUNT', self.batch_size, 'BLOCK', int(timeout * 1000),
+                                          'STREAMS', STREAM_KEY.format(self.name), self._last_id)
+        priorities = {}
+        if not reply:
+            return priorities
+        for _, entries in reply:
+            for entry_id, fields in entries:
+                for url, priority in zip(fields[::2], fields[1::2]):
+                    priorities[url] = int(priority)
+                self._last_id = entry_id
+        await redis_cache.hset(OFFSETS_KEY, self.name, self._last_id)
+        self.n_received += len(priorities)
+        return priorities
+
+
+async def shard_stats(redis_cache, names: Iterable[str] = None) -> Dict[str, Dict[str, int]]:
+    """Returns the last stats sent by the given shards, by default the registered ones"""
+
+    if names is None:
+        names = await redis_cache.zrange(SHARDS_KEY, 0, -1)
+    stats = {}
+    for name in names:
+        values = await redis_cache.hgetall(STATS_KEY.format(name))
+        stats[name] = {key: int(value) for key, value in values.items()}
+    return stats
+
+
+def total_stats(stats: Dict[str, Dict[str, int]]) -> Dict[str, int]:
+    total = defaultdict(int)
+    for values in stats.values():
+        for key, value in values.items():
+            total[key] += value
+    return dict(total)
+
+
+def shard_names(n_shards: int) -> List[str]:
+    return ['shard{}'.format(i) for i in range(n_shards)]
@@ -0,0 +1,279 @@
+"""
+Synthetic web served locally, to benchmark the crawlers offline
+
+A single aiohttp server answers for every host of a deterministic link graph: the host is read from the Host header,
+and SyntheticResolver makes every host resolve to the server address and port. The graph is generated from a seed
+and has crawler traps, slow hosts, large and binary responses and duplicate pages. Every host has a robots.txt, which
+disallows the traps, and a sitemap index listing its pages in a gzip compressed sitemap. SocksProxy stands in for the
+SOCKS endpoints of tor, relaying every connection to the server.
+
+usage: python synthetic_web.py [--port 8080] [--hosts 50]
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import random
+import re
+import socket
+from collections import Counter
+from typing import Dict, List
+
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+HOST = 'synthetic{}.com'
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+_host = re.compile(r'^(?:www\.)?synthetic(\d+)\.com$')
+
+WORDS = ('onion market forum wiki hidden service bitcoin escrow vendor review search index mirror news board chat '
+         'mail hosting library archive paste upload file image code leak dump guide tutorial privacy security').split()
+
+
+class SyntheticResolver(AbstractResolver):
+    """Resolves every host to the given address and port"""
+
+    def __init__(self, address: str = '127.0.0.1', port: int = 8080):
+        self.address = address
+        self.port = port
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict]:
+        return [{'hostname': host, 'host': self.address, 'port': self.port, 'family': socket.AF_INET, 'proto': 0,
+                 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+
+class SyntheticWeb:
+    """Deterministic link graph of n_hosts hosts of pages_per_host pages
+
+    Each page links to fan_out pages, an external_ratio of them on other hosts. The first n_traps hosts are crawler
+    traps, linking to ever deeper urls, the next n_slow hosts answer after slow_delay seconds. A large_ratio of the
+    pages are large_size bytes long, a binary_ratio of the links lead to binary files and a duplicate_ratio of the
+    links add a session id to the url of a page, which serves the same content.
+    """
+
+    def __init__(self, n_hosts: int = 50, pages_per_host: int = 100, fan_out: int = 10, external_ratio: float = 0.2,
+                 n_traps: int = 2, n_slow: int = 2, slow_delay: float = 0.5, large_ratio: float = 0.01,
+                 large_size: int = 4 * 1024 ** 2, binary_ratio: float = 0.02, duplicate_ratio: float = 0.05,
+                 words: int = 300, seed: int = 0, port: int = 8080):
+        self.n_hosts = n_hosts
+        self.pages_per_host = pages_per_host
+        self.fan_out = fan_out
+        self.external_ratio = external_ratio
+        self.n_traps = n_traps
+        self.n_slow = n_slow
+        self.slow_delay = slow_delay
+        self.large_ratio = large_ratio
+        self.large_size = large_size
+        self.binary_ratio = binary_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.words = words
+        self.seed = seed
+        self.port = port
+        self.n_requests = 0
+        self.server = None
+        self.handler = None
+
+    def __repr__(self):
+        return 'SyntheticWeb object: {} hosts of {} pages'.format(self.n_hosts, self.pages_per_host)
+
+    @staticmethod
+    def host(i: int) -> str:
+        return HOST.format(i)
+
+    @property
+    def resolver(self) -> SyntheticResolver:
+        return SyntheticResolver('127.0.0.1', self.port)
+
+    @property
+    def seeds(self) -> List[Url]:
+        return ['http://{}/'.format(self.host(i)) for i in range(self.n_hosts)]
+
+    def _random(self, *key) -> random.Random:
+        digest = hashlib.md5(repr((self.seed,) + key).encode('utf8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def links(self, host: int, path: str) -> List[str]:
+        rand = self._random(host, path)
+        links = []
+        for _ in range(self.fan_out):
+            page = rand.randrange(self.pages_per_host)
+            draw = rand.random()
+            if draw < self.binary_ratio:
+                links.append('/file{}.bin'.format(page))
+            elif draw < self.binary_ratio + self.duplicate_ratio:
+                links.append('/p{}?sid={}'.format(page, rand.getrandbits(32)))
+            elif rand.random() < self.external_ratio:
+                links.append('http://{}/p{}'.format(self.host(rand.randrange(self.n_hosts)), page))
+            else:
+                links.append('/p{}'.format(page))
+        if host < self.n_traps:
+            links.append(path.rstrip('/') + '/calendar/next')
+        return links
+
+    def page(self, host: int, path: str) -> str:
+        rand = self._random(host, path)
+        text = ' '.join(rand.choice(WORDS) for _ in range(self.words))
+        if rand.random() < self.large_ratio:
+            text += ' ' + 'x' * self.large_size
+        links = ''.join('<li><a href="{0}">{0}</a></li>'.format(link) for link in self.links(host, path))
+        return '<html><head><title>{} {}</title></head><body><p>{}</p><ul>{}</ul></body></html>'.format(
+            self.host(host), path, text, links)
+
+    def robots(self, host: int) -> str:
+        return 'User-agent: *\nDisallow: /*/calendar/\nSitemap: http://{}/sitemap.xml\n'.format(self.host(host))
+
+    def sitemap(self, host: int) -> bytes:
+        urls = ''.join('<url><loc>http://{}/p{}</loc></url>'.format(self.host(host), page)
+                       for page in range(self.pages_per_host))
+        return gzip.compress('<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{}">{}</urlset>'.format(
+            SITEMAP_NS, urls).encode('utf8'))
+
+    def sitemap_index(self, host: int) -> str:
+        return '<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{}"><sitemap>' \
+               '<loc>http://{}/sitemap-0.xml.gz</loc></sitemap></sitemapindex>'.format(SITEMAP_NS, self.host(host))
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.n_requests += 1
+        match = _host.match(request.host.split(':')[0])
+        if not match or int(match.group(1)) >= self.n_hosts:
+            return web.Response(status=404)
+        host = int(match.group(1))
+        if self.n_traps <= host < self.n_traps + self.n_slow:
+            await asyncio.sleep(self.slow_delay)
+        path = request.path
+        if path == '/robots.txt':
+            return web.Response(text=self.robots(host), content_type='text/plain')
+        if path == '/sitemap.xml':
+            return web.Response(text=self.sitemap_index(host), content_type='application/xml')
+        if path == '/sitemap-0.xml.gz':
+            return web.Response(body=self.sitemap(host), content_type='application/x-gzip')
+        if path.endswith('.bin'):
+            body = self._random(host, path).getrandbits(8 * 64 * 1024).to_bytes(64 * 1024, 'big')
+            return web.Response(body=body, content_type='application/octet-stream')
+        if path == '/':
+            path = '/p0'
+        elif not path.startswith('/p') and not (host < self.n_traps and '/calendar/' in path):
+            return web.Response(status=404)
+        # the session id of duplicate links is ignored: the page is the same
+        return web.Response(text=self.page(host, path), content_type='text/html')
+
+    async def start(self, address: str = '127.0.0.1'):
+        app = web.Application()
+        app.router.add_route('GET', '/{path:.*}', self.handle)
+        self.handler = app.make_handler(access_log=None)
+        self.server = await asyncio.get_event_loop().create_server(self.handler, address, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]  # port 0 picks a free one
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            await self.handler.shutdown(1.)
+            self.server = None
+
+
+class SocksProxy:
+    """SOCKS5 server relaying the connections to address:port, whatever host they ask for
+
+    Only the CONNECT command is supported, with no authentication or with any username and password, like a tor
+    SOCKS port. The hosts asked for and the usernames given are counted, to tell which circuit has been used.
+    """
+
+    def __init__(self, address: str = '127.0.0.1', port: int = 8080, proxy_port: int = 0):
+        self.address = address
+        self.port = port
+        self.proxy_port = proxy_port
+        self.hosts = Counter()
+        self.usernames = Counter()
+        self.server = None
+
+    def __repr__(self):
+        return 'SocksProxy object: {} -> {}:{}'.format(self.proxy_port, self.address, self.port)
+
+    async def start(self, address: str = '127.0.0.1'):
+        self.server = await asyncio.start_server(self.handle, address, self.proxy_port)
+        self.proxy_port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            _, n_methods = await reader.readexactly(2)
+            if 2 in await reader.readexactly(n_methods):
+                # username and password authentication, RFC 1929
+                writer.write(b'\x05\x02')
+                _, length = await reader.readexactly(2)
+                username = (await reader.readexactly(length)).decode('utf8')
+                length, = await reader.readexactly(1)
+                await reader.readexactly(length)
+                writer.write(b'\x01\x00')
+                self.usernames[username] += 1
+            else:
+                writer.write(b'\x05\x00')
+            _, command, _, address_type = await reader.readexactly(4)
+            if address_type == 3:
+                length, = await reader.readexactly(1)
+                host = (await reader.readexactly(length)).decode('utf8')
+            elif address_type == 1:
+                host = socket.inet_ntoa(await reader.readexactly(4))
+            else:
+                host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+            await reader.readexactly(2)  # the port asked for is ignored
+            if command != 1:
+                writer.write(b'\x05\x07\x00\x01' + bytes(6))
+                return
+            remote_reader, remote_writer = await asyncio.open_connection(self.address, self.port)
+            self.hosts[host] += 1
+            writer.write(b'\x05\x00\x00\x01' + bytes(6))
+            await asyncio.gather(self._relay(reader, remote_writer), self._relay(remote_reader, writer),
+                                 return_exceptions=True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--hosts', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    web_ = SyntheticWeb(n_hosts=args.hosts, seed=args.seed, port=args.port)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(web_.start())
+    print('Serving {}, e.g {}'.format(web_, web_.seeds[0]))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(web_.close())
+
+
+if __name__ == '__main__':
+    main()
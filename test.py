@@ -1,8 +1,36 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+
+import aiohttp
 import pytest
+from aiohttp import web
 from bs4 import BeautifulSoup
 import requests
 
-from crawler import get_external_links, get_internal_links
+from crawler import get_external_links, get_internal_links, is_seed_file, parse_seed_file
+from archive import ArchiveWriter, decompress
+from backends import JsonlArchive, MemoryState, MongoArchive
+from checkpoint import FrontierCheckpoint
+from coordinator import Coordinator
+from circuits import CircuitPool
+from extractors import parse_page
+from fingerprint import MAX_SHINGLES, SHINGLE_SIZE, DuplicateIndex, fingerprint, simhash
+from frontier import DEPRIORITISED, EXTERNAL, INTERNAL, BloomFilter, DiscoveryScorer, FrontierSpill, HostScheduler
+from graph import LinkGraph, read_column
+from hashring import HashRing
+from hosts import HostTracker
+from memory import MemoryCollection, MemoryRedis
+from metrics import Metrics, RateMeter
+from revisit import RevisitScheduler
+from robots import RobotsCache, SitemapParser, parse_robots
+from shards import ShardRouter
+from synthetic_web import SocksProxy, SyntheticWeb
+from tor_spider import Model, Page, Response, ResponseSkipped, TorSpider
+from urls import TrapScorer, canonicalize
 
 
 def test_get_external_links():
@@ -35,3 +63,691 @@ def test_get_internal_links():
                      'www.cybelangel.com?lang=fr',
                      'blog.cybelangel.com',
                      'www.cybelangel.com/#contact'}
+
+
+def test_site_links_aggregates():
+
+    model = Model()
+    html = '<a href="/a">a</a><a href="http://foo.onion/">foo</a><a href="http://bar.onion/b">b</a>'
+    Page(model, 'http://bar.onion/x', Response(200, {}, html))
+    page = Page(model, 'http://bar.onion/y', Response(200, {}, html + '<a href="/c">c</a>'))
+
+    assert set(page.site.internal_links) == {'http://bar.onion/a', 'http://bar.onion/b', 'http://bar.onion/c'}
+    assert page.site.external_links == ['http://foo.onion/']
+    assert page.site.links_ratio == 1.5
+    assert page.internal_links is page.internal_links
+
+
+def test_compact_model_evicts_inactive_sites():
+
+    model = Model(compact=True, max_memory=0)
+    first = Page(model, 'http://foo.onion/a/b', Response(200, {}, '<a href="/c">c</a>'))
+    second = Page(model, 'http://bar.onion/a', Response(200, {}, ''))
+    model.release(first)
+
+    assert 'foo.onion' not in model.sites
+    assert 'bar.onion' in model.sites
+    model.release(second)
+    assert model.sites == {}
+
+    page = Page(model, 'http://foo.onion/d', Response(200, {}, ''))
+    assert page.site.n_pages == 2
+    assert page.site.max_deepness == 2
+
+
+def test_parse_page():
+
+    html = '<title>Hello</title><a href="/a/">a</a><a href="http://foo.onion">foo</a>'
+    parsed = parse_page(html, 'http://bar.onion/x/y')
+
+    assert parsed['title'] == 'Hello'
+    assert parsed['internal_links'] == ['http://bar.onion/a']
+    assert parsed['external_links'] == ['http://foo.onion']
+    assert parsed['parent_urls'] == ['bar.onion', 'bar.onion/x']
+
+
+def test_extractor_backends_agree():
+
+    html = ('<html><head><title>Hi &amp; bye</title></head><body><a href="/a">a</a><a name="x">x</a>'
+            '<p><a href="http://foo.onion/b">b</a><a href="//bar.onion/c">c</a></p></body></html>')
+    stream = parse_page(html, 'http://bar.onion/', 'stream')
+    soup = parse_page(html, 'http://bar.onion/', 'soup')
+
+    assert stream['title'] == soup['title'] == 'Hi & bye'
+    assert sorted(stream['internal_links']) == sorted(soup['internal_links'])
+    assert stream['external_links'] == soup['external_links'] == ['http://foo.onion/b']
+
+
+def test_spider_get_skips_and_truncates_responses():
+    html = '<html><body>{}</body></html>'.format('a' * 2000)
+
+    async def handle(request):
+        if request.path == '/binary':
+            return web.Response(body=b'\0' * 100, content_type='application/octet-stream')
+        response = web.Response(text=html, content_type='text/html')
+        if request.path == '/chunked':
+            # no Content-Length: the size is only known once max_bytes have been read
+            response.enable_chunked_encoding()
+        return response
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_route('GET', '/{path:.*}', handle)
+        handler = app.make_handler(access_log=None)
+        server = await asyncio.get_event_loop().create_server(handler, '127.0.0.1', 0)
+        root = 'http://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+        session = aiohttp.ClientSession()
+        spiders = {truncate: TorSpider(max_bytes=1000, truncate=truncate, state=MemoryState(),
+                                       storage=JsonlArchive(tempfile.mkdtemp())) for truncate in (True, False)}
+        try:
+            response = await spiders[True].get(session, root + '/page')
+            assert response.status_code == 200 and response.text == html[:1000]
+            response = await spiders[True].get(session, root + '/chunked')
+            assert response.text == html[:1000] and 'Content-Length' not in response.headers
+            for path, reason in (('/binary', 'content_type'), ('/page', 'too_large'), ('/chunked', 'too_large')):
+                with pytest.raises(ResponseSkipped) as exc:
+                    await spiders[False].get(session, root + path)
+                assert exc.value.reason == reason
+
+            spider = spiders[False]
+            spider.std_session = session
+            redis = MemoryRedis()
+            for path in ('/binary', '/page'):
+                await spider.crawl_url(redis, root + path)
+            assert redis.data['skipped:content_type'] == {root + '/binary'}
+            assert redis.data['skipped:too_large'] == {root + '/page'}
+        finally:
+            await session.close()
+            server.close()
+            await server.wait_closed()
+            await handler.shutdown(1.)
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_bloom_filter():
+
+    bloom = BloomFilter(1000, 0.01)
+    urls = ['http://{}.onion/'.format(i) for i in range(1000)]
+
+    assert all(bloom.add(url) for url in urls[:500])
+    assert not bloom.add(urls[0])
+    assert all(url in bloom for url in urls[:500])
+    assert sum(url in bloom for url in urls[500:]) < 25
+    assert bloom.false_positive_rate < 0.01
+
+
+def test_host_scheduler():
+
+    async def scenario():
+        frontier = HostScheduler(max_per_host=1, min_delay=0, max_size=4)
+        for url in ['http://a.onion/1', 'http://a.onion/2', 'http://c.onion/1']:
+            assert frontier.put_nowait(url, INTERNAL)
+        assert frontier.put_nowait('http://b.onion/', EXTERNAL)
+        assert not frontier.put_nowait('http://d.onion/', EXTERNAL)
+
+        assert await frontier.get() == 'http://b.onion/'
+        assert await frontier.get() == 'http://a.onion/1'
+        assert await frontier.get() == 'http://c.onion/1'
+        assert frontier.priority('http://b.onion/', INTERNAL) == EXTERNAL
+        assert frontier.priority('http://c.onion/1') == INTERNAL
+        pending = asyncio.ensure_future(frontier.get())
+        await asyncio.sleep(0.01)
+        assert not pending.done()
+        frontier.done('http://a.onion/1')
+        assert await pending == 'http://a.onion/2'
+        frontier.done('http://b.onion/')
+        assert frontier.priority('http://b.onion/', INTERNAL) == INTERNAL
+        assert frontier.empty()
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_memory_backends_persist_state_and_archive():
+
+    async def scenario():
+        directory = tempfile.mkdtemp()
+        state = MemoryState(os.path.join(directory, 'state.json.gz'), snapshot_interval=0)
+        pool = await state.open()
+        async with pool.get() as redis:
+            await redis.sadd('crawled', 'http://foo.onion/')
+            await redis.zadd('frontier:0', 1, 'http://bar.onion/')
+        await state.close()
+        pool = await MemoryState(state.path).open()
+        async with pool.get() as redis:
+            assert await redis.sismember('crawled', 'http://foo.onion/')
+            assert await redis.zrange('frontier:0', 0, -1) == ['http://bar.onion/']
+
+        archive = ArchiveWriter(JsonlArchive(os.path.join(directory, 'archive'), segment_size=1), flush_size=2,
+                                compression='zlib')
+        for i in range(3):
+            await archive.put({'_id': 'http://foo.onion/{}'.format(i), 'text': 'hello'})
+        await archive.put({'_id': 'http://foo.onion/0', 'text': 'bye'})
+        await archive.close()
+        assert len(archive.backend.segments()) == 2
+        docs = archive.backend.read()
+        assert len(docs) == 3
+        assert decompress(docs['http://foo.onion/0']['text'], 'zlib') == 'bye'
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_hash_ring_moves_only_removed_node_keys():
+
+    ring = HashRing(['a', 'b', 'c'])
+    domains = ['{}.onion'.format(i) for i in range(1000)]
+    before = {domain: ring.get(domain) for domain in domains}
+    ring.remove('b')
+
+    assert set(before.values()) == {'a', 'b', 'c'}
+    assert all(ring.get(domain) == node for domain, node in before.items() if node != 'b')
+    assert all(ring.get(domain) != 'b' for domain in domains)
+
+
+def test_circuit_pool_ejects_failing_circuit():
+
+    pool = CircuitPool([('127.0.0.1', 9050), ('127.0.0.1', 9051), ('127.0.0.1', 9052)], min_requests=5)
+    domains = ['{}.onion'.format(i) for i in range(100)]
+    bad = pool.circuit(domains[0])
+    for circuit in pool.active:
+        for _ in range(10):
+            pool.report(circuit, 1., ok=circuit is not bad)
+
+    assert bad not in pool.active
+    assert all(pool.circuit(domain) is not bad for domain in domains)
+
+
+class FakeCollection:
+
+    def __init__(self):
+        self.bulks = []
+
+    async def bulk_write(self, requests, ordered=True):
+        self.bulks.append([request._doc for request in requests])
+
+
+def test_circuits_fetch_through_socks_proxies():
+
+    async def scenario():
+        synthetic = SyntheticWeb(n_hosts=20, n_slow=0, port=0)
+        await synthetic.start()
+        proxies = [SocksProxy(port=synthetic.port) for _ in range(2)]
+        for proxy in proxies:
+            await proxy.start()
+        pool = CircuitPool([('127.0.0.1', proxies[0].proxy_port),
+                            ('127.0.0.1', proxies[1].proxy_port, 'circuit1', 'secret')])
+        try:
+            domains = [synthetic.host(i) for i in range(20)]
+            for domain in domains:
+                async with pool.circuit(domain).session.get('http://{}/p1'.format(domain)) as resp:
+                    assert resp.status == 200 and domain in await resp.text()
+            for circuit, proxy in zip(pool.circuits.values(), proxies):
+                assert set(proxy.hosts) == {domain for domain in domains if pool.circuit(domain) is circuit}
+                assert proxy.hosts and circuit.pool_stats['created'] == sum(proxy.hosts.values())
+            assert not proxies[0].usernames and set(proxies[1].usernames) == {'circuit1'}
+        finally:
+            await pool.close()
+            for proxy in proxies:
+                await proxy.close()
+            await synthetic.close()
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_archive_writer_flushes_by_size_time_and_on_close():
+
+    async def scenario():
+        coll = FakeCollection()
+        archive = ArchiveWriter(coll, max_buffer=10, flush_size=2, flush_interval=0.05, compression='zlib')
+        for i in range(3):
+            await archive.put({'_id': 'http://foo.onion/{}'.format(i), 'text': 'hello'})
+        await asyncio.sleep(0.01)
+        assert [len(bulk) for bulk in coll.bulks] == [2]
+        await asyncio.sleep(0.1)
+        assert [len(bulk) for bulk in coll.bulks] == [2, 1]
+        await archive.put({'_id': 'http://foo.onion/3', 'text': 'bye'})
+        await archive.close()
+        assert [len(bulk) for bulk in coll.bulks] == [2, 1, 1]
+        assert decompress(coll.bulks[-1][0]['text'], 'zlib') == 'bye'
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_checkpoint_restores_frontier_and_expired_leases():
+
+    async def scenario():
+        redis = MemoryRedis()
+        frontier = HostScheduler()
+        checkpoint = FrontierCheckpoint(frontier, lease_time=-1)
+        await redis.sadd('to_crawl', 'http://a.onion', 'http://b.onion/x', 'http://c.onion', 'http://d.onion')
+        frontier.put_nowait('http://a.onion', EXTERNAL)
+        frontier.put_nowait('http://b.onion/x', INTERNAL)
+        frontier.put_nowait('http://c.onion', INTERNAL)
+        await checkpoint.save(redis)
+        await checkpoint.lease(redis, 'http://a.onion')  # the worker dies, its lease expires at once
+        await checkpoint.lease(redis, 'http://c.onion')
+        await checkpoint.release(redis, 'http://c.onion')
+
+        restored = HostScheduler()
+        assert await FrontierCheckpoint(restored).restore(redis, size=10) == 3
+        assert dict(restored.items()) == {'http://a.onion': INTERNAL, 'http://b.onion/x': INTERNAL,
+                                          'http://d.onion': INTERNAL}
+        assert redis.data['in_flight'] == {}
+        assert redis.data['crawled'] == {'http://c.onion'}
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_shards_forward_foreign_urls_to_their_owner():
+
+    async def scenario():
+        redis = MemoryRedis()
+        first, second = ShardRouter('shard0'), ShardRouter('shard1')
+        await first.join(redis)
+        await second.join(redis)
+        await first.refresh(redis)
+        urls = {'http://site{}.onion/page'.format(i): INTERNAL for i in range(50)}
+
+        local = await first.forward(redis, urls)
+        received = await second.receive(redis, timeout=0)
+        assert local and received
+        assert all(first.owns(url) for url in local) and not any(first.owns(url) for url in received)
+        assert dict(local, **received) == urls
+        assert await second.receive(redis, timeout=0) == {}
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_coordinator_runs_in_process_shards():
+
+    async def scenario():
+        synthetic = SyntheticWeb(n_hosts=10, pages_per_host=30, n_traps=0, n_slow=0, large_ratio=0, port=0)
+        await synthetic.start()
+        state, coll = MemoryState(), MemoryCollection()
+        coordinator = Coordinator(synthetic.seeds, n_tasks=4, state=state, heartbeat=0.1, resolver=synthetic.resolver,
+                                  storage=MongoArchive(coll), host_delay=0.05, archive_flush_interval=0.1)
+        try:
+            await coordinator.start(1)
+            await asyncio.sleep(0.5)
+            assert coordinator.add_shard() == 'shard1'
+            await asyncio.sleep(1.)
+            stats = await coordinator.stats()
+            assert stats['shards'] == 2 and stats['archived'] > 0
+            assert stats['forwarded'] > 0 and stats['received'] > 0
+            assert set(await state.redis.zrange('shards', 0, -1)) == {'shard0', 'shard1'}
+        finally:
+            await coordinator.stop(timeout=5.)
+            await synthetic.close()
+        assert not coordinator.shards and await state.redis.zrange('shards', 0, -1) == []
+        # the domains moved to shard1 are crawled by it only, from the links it received
+        shard1 = ShardRouter('shard1')
+        shard1.ring.add('shard0')
+        received = [url for _, fields in state.redis.data.get('shard:shard1', []) for url in fields[::2]]
+        assert received and all(shard1.owns(url) for url in received)
+        assert len(coll.docs) >= stats['archived']
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_revisit_interval_follows_page_changes():
+
+    async def scenario():
+        redis = MemoryRedis()
+        revisits = RevisitScheduler(initial_interval=100, min_interval=10, max_interval=1000, backoff=2)
+        url = 'http://foo.onion/news'
+
+        assert await revisits.update(redis, url, {}, 200, {'ETag': '"v1"'}, 'hash1')
+        validators = await revisits.validators(redis, url)
+        assert revisits.conditional_headers(validators) == {'If-None-Match': '"v1"'}
+        assert not await revisits.update(redis, url, validators, 304, {})
+        assert (await revisits.validators(redis, url))['interval'] == 200
+        validators = await revisits.validators(redis, url)
+        assert await revisits.update(redis, url, validators, 200, {'ETag': '"v2"'}, 'hash2')
+        assert (await revisits.validators(redis, url))['interval'] == 100
+
+        assert await revisits.due(redis) == []
+        redis.data['revisit'][url] = 0
+        assert await revisits.due(redis) == [url]
+        assert await revisits.due(redis) == []
+        assert await revisits.priorities(redis, [url, 'http://foo.onion/new'], 1) == \
+            {url: 1, 'http://foo.onion/new': 1}
+        await revisits.update(redis, url, await revisits.validators(redis, url), 304, {}, priority=0)
+        assert await revisits.priorities(redis, [url], 1) == {url: 0}
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_host_tracker_adapts_timeouts_and_breaks_dead_hosts():
+
+    hosts = HostTracker(min_timeout=1, max_timeout=20, failure_threshold=2, open_time=0.05)
+    assert hosts.timeout('new.onion') == 20
+    for _ in range(20):
+        hosts.record('fast.onion', 0.5)
+    assert hosts.timeout('fast.onion') == 1
+    assert hosts.timeout('fast.onion', attempt=2) == 4
+
+    hosts.record('dead.onion', 20, ok=False)
+    assert hosts.allow('dead.onion')
+    hosts.record('dead.onion', 20, ok=False)
+    assert not hosts.allow('dead.onion') and hosts.parked_for('dead.onion') > 0
+    time.sleep(0.06)
+    assert hosts.allow('dead.onion')  # probe
+    assert not hosts.allow('dead.onion')
+    hosts.record('dead.onion', 20, ok=False)
+    assert hosts.hosts['dead.onion'].open_time == 0.1
+    hosts.hosts['dead.onion'].open_until = 0
+    assert hosts.allow('dead.onion')
+    hosts.record('dead.onion', 3)
+    assert hosts.allow('dead.onion') and hosts.allow('dead.onion')
+
+
+def test_robots_rejection_does_not_use_up_the_breaker_probe():
+
+    async def scenario():
+        spider = TorSpider(robots=True, state=MemoryState(), storage=JsonlArchive(tempfile.mkdtemp()))
+        spider.robots.set('dead.onion', parse_robots('User-agent: *\nDisallow: /private'))
+        for _ in range(spider.hosts.failure_threshold):
+            spider.hosts.record('dead.onion', 1., ok=False)
+        spider.hosts.hosts['dead.onion'].open_until = 0
+        redis = MemoryRedis()
+        await spider.crawl_url(redis, 'http://dead.onion/private/1')
+        assert redis.data['disallowed'] == {'http://dead.onion/private/1'}
+        assert spider.hosts.allow('dead.onion')  # the probe is still there
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_metrics_render_prometheus_text():
+
+    metrics = Metrics(prefix='test_')
+    queue = [1, 2, 3]
+    metrics.gauge('queued', 'Queued urls', function=lambda: len(queue))
+    metrics.counter('fetches_total', 'Fetches').inc(result='2xx')
+    metrics.counter('fetches_total').inc(2, result='5xx')
+    metrics.counter('errors_total').inc(2)
+    histogram = metrics.histogram('fetch_seconds', buckets=(0.1, 1))
+    for latency in (0.05, 0.5, 3):
+        histogram.observe(latency)
+    RateMeter(metrics).update({}, {'error_rate': (metrics.counter('errors_total'), metrics.counter('fetches_total'))})
+
+    lines = metrics.render().splitlines()
+    assert '# TYPE test_queued gauge' in lines and 'test_queued 3' in lines
+    assert 'test_fetches_total{result="5xx"} 2' in lines
+    assert 'test_fetch_seconds_bucket{le="1"} 2' in lines and 'test_fetch_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_fetch_seconds_count 3' in lines
+    assert metrics.to_dict()['test_error_rate'] == 2 / 3
+    with metrics.stage('parse'):
+        pass
+    assert 'test_stage_seconds' not in metrics.metrics
+
+
+def test_synthetic_web_is_deterministic():
+
+    web = SyntheticWeb(n_hosts=10, fan_out=20, n_traps=1, seed=1)
+    assert web.page(3, '/p1') == SyntheticWeb(n_hosts=10, fan_out=20, n_traps=1, seed=1).page(3, '/p1')
+    assert web.page(3, '/p1') != SyntheticWeb(n_hosts=10, fan_out=20, n_traps=1, seed=2).page(3, '/p1')
+    assert web.links(0, '/p1/calendar/next')[-1] == '/p1/calendar/next/calendar/next'
+    assert len(web.links(3, '/p1')) == 20
+
+
+def test_canonicalize():
+
+    assert canonicalize('HTTP://Foo.onion:80//a//b/?z=1&a=2#top') == 'http://foo.onion/a/b?a=2&z=1'
+    assert canonicalize('foo.onion/bonjour/', 'https://') == 'https://foo.onion/bonjour'
+    assert canonicalize('http://foo.onion:8080/') == 'http://foo.onion:8080'
+    assert canonicalize('mailto:admin@foo.onion') is None
+
+
+def test_trap_scorer():
+
+    scorer = TrapScorer(max_repeats=3, max_depth=15)
+    trap = 'http://underdj5ziov3ic7.onion/help' + '/crawler/index.php' * 4
+
+    assert scorer.is_trap(trap)
+    assert not scorer.is_trap('http://underdj5ziov3ic7.onion/crawler/index.php')
+    assert scorer.score('http://foo.onion/a/b/c') < scorer.deprioritise_score
+
+
+def test_duplicate_index_finds_near_duplicates():
+
+    text = ' '.join('word{}'.format(i) for i in range(500))
+    index = DuplicateIndex(max_distance=3)
+    index.add('http://foo.onion/?lang=fr', *fingerprint('<p>' + text + '</p>'))
+
+    assert index.find(*fingerprint('<div>' + text + ' footer</div>')) == 'http://foo.onion/?lang=fr'
+    assert index.find(*fingerprint(' '.join('other{}'.format(i) for i in range(500)))) is None
+
+    # pages with more shingles than the counters can hold keep the ones at the start of the text
+    tokens = ['word{}'.format(i) for i in range(MAX_SHINGLES + 1000)]
+    assert simhash(tokens) == simhash(tokens[:MAX_SHINGLES + SHINGLE_SIZE - 1])
+
+
+def test_shared_template_pages_are_not_near_duplicates():
+
+    template = '<nav><ul>{}</ul></nav>'.format(''.join(
+        '<li><a href="/menu{0}">menu entry {0}</a></li>'.format(i) for i in range(200)))
+    index = DuplicateIndex(max_distance=3)
+    n_duplicates = 0
+    for page in range(300):
+        text = ' '.join('page{}word{}'.format(page, i) for i in range(60))
+        html = '<html><body>{}<p>{}</p><footer>about contact</footer></body></html>'.format(template, text)
+        n_duplicates += index.check('http://foo.onion/{}'.format(page), *fingerprint(html)) is not None
+    assert n_duplicates == 0
+
+    html = '<html><body>{}<p>{}</p></body></html>'.format(template, 'same text ' * 30)
+    index.check('http://foo.onion/a', *fingerprint(html))
+    assert index.check('http://foo.onion/b', *fingerprint(html)) == 'http://foo.onion/a'
+
+
+def test_near_duplicate_pages_are_stored_as_references():
+    text = ' '.join('word{}'.format(i) for i in range(200))
+    pages = {'/a': '<p>{}</p><a href="/from_a">more</a>'.format(text),
+             '/b': '<p>{}</p><a href="/from_b">more</a>'.format(text.replace('word100', 'changed'))}
+
+    async def handle(request):
+        return web.Response(text=pages[request.path], content_type='text/html')
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_route('GET', '/{path:.*}', handle)
+        handler = app.make_handler(access_log=None)
+        server = await asyncio.get_event_loop().create_server(handler, '127.0.0.1', 0)
+        root = 'http://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+        coll = MemoryCollection()
+        spider = TorSpider(state=MemoryState(), storage=MongoArchive(coll))
+        spider.std_session = aiohttp.ClientSession()
+        redis = MemoryRedis()
+        try:
+            for path in ('/a', '/b'):
+                await spider.crawl_url(redis, root + path)
+            await spider.archive.close()
+        finally:
+            await spider.std_session.close()
+            server.close()
+            await server.wait_closed()
+            await handler.shutdown(1.)
+        assert coll.docs[root + '/b']['duplicate_of'] == root + '/a' and 'text' not in coll.docs[root + '/b']
+        assert spider.model.sites[spider.url_to_domain(root)].n_duplicates == 1
+        assert root + '/from_a' in redis.data['to_crawl'] and root + '/from_b' not in redis.data['to_crawl']
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_link_graph_counts_degrees_and_exports_columns():
+    directory = tempfile.mkdtemp()
+    graph = LinkGraph(directory, buffer_size=2)
+    graph.add_page('http://a.onion/', ['http://a.onion/1', 'http://b.onion/', 'http://c.onion/x'])
+    graph.add_page('http://b.onion/', ['http://c.onion/x', 'http://c.onion/y', 'http://b.onion/'])
+    graph.add_page('http://b.onion/', ['http://d.onion/'])  # crawled again
+    assert len(graph.pages) == 5 and graph.pages.n_spilled == 4
+    assert graph.in_degree('http://c.onion/x') == 2 and graph.out_degree('http://b.onion/') == 2
+    assert graph.in_degree('http://d.onion/') == 0
+    assert graph.site_links('b.onion', 'c.onion') == 2
+    assert graph.hubs(1) == [('c.onion', 2)]
+
+    graph.export(os.path.join(directory, 'export'))
+    sources = read_column(os.path.join(directory, 'export', 'pages.src.u32'))
+    targets = read_column(os.path.join(directory, 'export', 'pages.dst.u32'))
+    assert [(graph.urls.value(s), graph.urls.value(t)) for s, t in zip(sources, targets)][-2:] == \
+        [('http://b.onion/', 'http://c.onion/x'), ('http://b.onion/', 'http://c.onion/y')]
+    counts = read_column(os.path.join(directory, 'export', 'sites.count.u32'))
+    assert sorted(counts) == [1, 1, 2]
+
+    graph.add_page('http://c.onion/x', ['http://a.onion/'])
+    graph.export(directory)
+    graph.add_page('http://d.onion/', ['http://a.onion/'] * 2)  # after the last export
+    graph.pages.spill()
+    restarted = LinkGraph(directory)
+    assert len(restarted.pages) == 6 and list(restarted.pages) == list(graph.pages)[:6]
+    assert restarted.in_degree('http://c.onion/x') == 2 and restarted.in_degree('http://a.onion/') == 1
+    assert restarted.site_links('b.onion', 'c.onion') == 2 and restarted.hubs(1) == [('c.onion', 2)]
+    restarted.add_page('http://b.onion/', ['http://e.onion/'])  # already recorded
+    restarted.add_page('http://e.onion/', ['http://c.onion/y'])
+    assert len(restarted.pages) == 7 and restarted.site_in_degree('c.onion') == 3
+    for name in ('src.u32', 'dst.u32'):
+        os.remove(os.path.join(directory, 'spill', name))
+    assert list(LinkGraph(directory).pages) == list(restarted.pages)[:6]
+
+    sites = LinkGraph(pages=False)
+    sites.add_page('http://a.onion/', ['http://a.onion/1', 'http://b.onion/', 'http://c.onion/x'])
+    sites.add_page('http://b.onion/', ['http://c.onion/x', 'http://c.onion/y'])
+    assert len(sites.urls) == 0 and len(sites.pages) == 0 and len(sites.domains) == 3
+    assert sites.site_links('b.onion', 'c.onion') == 2 and sites.site_in_degree('c.onion') == 2
+
+
+def test_spider_exports_the_graph_periodically():
+
+    async def scenario():
+        directory = tempfile.mkdtemp()
+        spider = TorSpider(graph_path=directory, graph_interval=0.05, state=MemoryState(),
+                           storage=JsonlArchive(tempfile.mkdtemp()))
+        await spider.start()
+        try:
+            spider.graph.add_page('http://a.onion/', ['http://a.onion/1', 'http://b.onion/'])
+            await asyncio.sleep(0.15)
+            # exported while crawling, not only by close
+            with open(os.path.join(directory, 'graph.json')) as file:
+                assert json.load(file)['n_page_edges'] == 2
+            assert not [name for name in os.listdir(directory) if name.endswith('.tmp')]
+        finally:
+            await spider.close()
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_discovery_scorer_and_frontier_spill():
+    graph = LinkGraph()
+    scorer = DiscoveryScorer(graph, n_buckets=8)
+    graph.add_page('http://a.onion/', ['http://a.onion/1', 'http://b.onion/'])
+    graph.add_page('http://c.onion/', ['http://b.onion/'])
+    new_site = scorer.bucket('http://new.onion/', 'a.onion', EXTERNAL)
+    hub = scorer.bucket('http://b.onion/x', 'a.onion', INTERNAL)
+    deep = scorer.bucket('http://a.onion/1/2/3/4/5/6/7/8', 'a.onion', INTERNAL)
+    assert new_site < hub < deep < scorer.bucket('http://a.onion/x', 'a.onion', DEPRIORITISED) == 7
+    scorer.page_crawled('a.onion', ['http://a.onion/2', 'http://b.onion/', 'http://d.onion/', 'http://e.onion/'])
+    scorer.page_crawled('c.onion', ['http://c.onion/2'])
+    assert scorer.site_yield('a.onion') == 1. and scorer.site_yield('c.onion') == 0.
+    assert scorer.bucket('http://a.onion/2', 'a.onion', INTERNAL) < \
+        scorer.bucket('http://c.onion/2', 'c.onion', INTERNAL)
+
+    async def scenario():
+        frontier = HostScheduler(max_size=4, n_priorities=8)
+        spill = FrontierSpill(frontier, low_watermark=0.5)
+        redis = MemoryRedis()
+        for i in range(4):
+            frontier.put_nowait('http://full.onion/{}'.format(i), 0)
+        spill.put('http://late.onion/', 5)
+        spill.put('http://early.onion/', 1)
+        spill.put('http://later.onion/', 7)
+        await spill.flush(redis)
+        assert await spill.refill(redis) == 0
+        for _ in range(4):
+            frontier.done(await frontier.get())
+        assert await spill.refill(redis) == 2
+        assert sorted(frontier.items(), key=lambda item: item[1]) == [('http://early.onion/', 1),
+                                                                       ('http://late.onion/', 5)]
+        assert await redis.zrange(spill.key, 0, -1) == ['http://later.onion/']
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+
+def test_robots_rules_are_fetched_once_and_sitemaps_streamed():
+    text = """User-agent: otherbot
+Disallow: /
+
+User-agent: *
+Disallow: /private
+Allow: /private/public
+Disallow: /*.php$
+Crawl-delay: 2
+Sitemap: http://foo.onion/sitemap.xml
+"""
+    rules = parse_robots(text)
+    assert rules.crawl_delay == 2 and rules.sitemaps == ['http://foo.onion/sitemap.xml']
+    assert rules.allowed('http://foo.onion/') and not rules.allowed('http://foo.onion/private/a')
+    assert rules.allowed('http://foo.onion/private/public/a')
+    assert not rules.allowed('http://foo.onion/index.php') and rules.allowed('http://foo.onion/index.php?a=1')
+    assert not parse_robots(text, 'OtherBot/1.0').allowed('http://foo.onion/')
+    # whole product tokens only, the groups of the same agent merged
+    merged = 'User-agent: a\nUser-agent: spider\nDisallow: /\n\nUser-agent: aiospider\nDisallow: /a\n\n' \
+             'User-agent: AIOSPIDER/2\nDisallow: /b\nCrawl-delay: 5\n\nUser-agent: *\nDisallow: /c\n'
+    merged_rules = parse_robots(merged)
+    assert merged_rules.allowed('http://foo.onion/') and merged_rules.allowed('http://foo.onion/c')
+    assert not merged_rules.allowed('http://foo.onion/a') and not merged_rules.allowed('http://foo.onion/b')
+    assert merged_rules.crawl_delay == 5
+    assert not parse_robots(merged, 'Spider').allowed('http://foo.onion/')
+    assert not parse_robots(merged, 'otherspider/1.0').allowed('http://foo.onion/c')
+
+    async def scenario():
+        fetches = []
+
+        async def fetch(host):
+            fetches.append(host)
+            await asyncio.sleep(0.01)
+            return 200, text
+
+        redis = MemoryRedis()
+        cache = RobotsCache()
+        results = await asyncio.gather(*[cache.rules(redis, 'foo.onion', fetch) for _ in range(3)])
+        assert fetches == ['foo.onion'] and [fetched for _, fetched in results] == [True, False, False]
+        assert not cache.allowed('http://foo.onion/private') and cache.allowed('http://bar.onion/private')
+        rules, fetched = await RobotsCache().rules(redis, 'foo.onion', fetch)
+        assert not fetched and fetches == ['foo.onion'] and rules.rules == cache.get('foo.onion').rules
+
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+    body = gzip.compress(('<?xml version="1.0"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">' +
+                          ''.join('<url><loc>http://foo.onion/{}</loc></url>'.format(i) for i in range(100)) +
+                          '</urlset>').encode('utf8'))
+    parser = SitemapParser(max_urls=80)
+    urls = []
+    for i in range(0, len(body), 64):
+        urls.extend(parser.feed(body[i:i + 64]))
+    urls.extend(parser.close())
+    assert urls == ['http://foo.onion/{}'.format(i) for i in range(80)]
+    parser = SitemapParser()
+    assert parser.feed(b'<sitemapindex><sitemap><loc>http://foo.onion/s.xml.gz</loc></sitemap></sitemapindex>') == []
+    assert parser.sitemaps == ['http://foo.onion/s.xml.gz']
+
+    assert is_seed_file('foo.onion/robots.txt') and is_seed_file('foo.onion/s.xml.gz')
+    assert not is_seed_file('foo.onion/sitemap.html')
+    assert parse_seed_file('foo.onion/s.xml.gz', body)[:2] == ['foo.onion/0', 'foo.onion/1']
+    assert parse_seed_file('github.com/sitemap.xml', b'\x1f\x8b\x08garbage') == []
+    # a gzip bomb is decompressed up to max_bytes only
+    parser = SitemapParser(max_bytes=10 ** 5)
+    assert parser.feed(gzip.compress(b'<urlset>' + b' ' * 10 ** 8)) + parser.close() == []
+    assert parser.n_bytes == 10 ** 5
+
+
+def test_sitemap_urls_are_scored_like_links():
+
+    async def scenario():
+        spider = TorSpider(discovery=True, robots=True, n_buckets=8, state=MemoryState(),
+                           storage=JsonlArchive(tempfile.mkdtemp()))
+        urls = ['http://foo.onion/a', 'http://foo.onion/p/x/x/x', 'http://foo.onion/a/a/a/a', 'http://bar.onion/x']
+        assert await spider.add_sitemap_urls(MemoryRedis(), 'foo.onion', urls) == 2
+        buckets = dict(spider.frontier.items())
+        assert buckets['http://foo.onion/p/x/x/x'] == 7  # deprioritised, in the last bucket
+        assert buckets['http://foo.onion/a'] == spider.scorer.bucket('http://foo.onion/a', 'foo.onion', INTERNAL) < 7
+
+    asyncio.get_event_loop().run_until_complete(scenario())
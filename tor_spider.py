@@ -1,25 +1,48 @@
 import logging
-import re
-from typing import Dict, Iterable
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Set
 import textwrap
 
 from bs4 import BeautifulSoup
 import asyncio
 import aiohttp
 import async_timeout
-import aiosocks
-from aiosocks.connector import SocksConnector
-import redis
-import aioredis
 import tld
 from concurrent.futures._base import TimeoutError
 import motor.motor_asyncio
 
+from archive import ArchiveWriter
+from backends import ArchiveBackend, MongoArchive, RedisState, StateBackend
+from checkpoint import FrontierCheckpoint
+from circuits import CircuitPool
+from connectors import PooledConnector, connector_options
+from extractors import DEFAULT_BACKEND, parse_page, url_scheme
+from fingerprint import DuplicateIndex
+from hosts import HostTracker
+from metrics import SIZE_BUCKETS, Metrics, RateMeter, serve, write_json
+from revisit import RevisitScheduler
+from robots import RobotsCache, SitemapParser
+from shards import ShardRouter
+from frontier import DEPRIORITISED, EXTERNAL, INTERNAL, BloomFilter, DiscoveryScorer, FrontierSpill, HostScheduler
+from graph import LinkGraph
+from urls import TrapScorer, canonicalize
+
 Url = str  # e.g: http://www.google.com/hello.php
-Urls = Iterable(Url)
+Urls = Iterable[Url]
 Raw_Url = str # e.g www.google.com/hello.php
 Domain = str  # e.g www.google.com
 
+PAGE_SUMMARY_SIZE = 200  # approximate size in bytes of a PageSummary without its url
+SET_ENTRY_SIZE = 50  # approximate overhead in bytes of a string stored in a set
+
+DUPLICATES_MIN_PAGES = 10  # pages to crawl on a site before throttling it for producing duplicates
+
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+CHUNK_SIZE = 64 * 1024
+
 
 class SiteNotFound(Exception):
     """Exception raised when the given URL has not been found"""
@@ -28,20 +51,82 @@ class SiteNotFound(Exception):
         return "Site not found"
 
 
+class ResponseSkipped(Exception):
+    """Exception raised when a response body is not read, e.g because it is not html or too large"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+    def __str__(self):
+        return "Response skipped: " + self.reason
+
+
 class Model:
-    """Class to manage database classes"""
+    """Class to manage database classes
+
+    In compact mode, archived pages are replaced by small summaries and the least recently used inactive sites are
+    evicted once the estimated memory usage exceeds max_memory (in bytes).
+    """
 
-    def __init__(self):
-        self.sites = {}
+    def __init__(self, compact: bool = False, max_memory: int = None):
+        self.sites = OrderedDict()
+        self.compact = compact
+        self.max_memory = max_memory
+        self.memory_usage = 0
+        self._evicted = {}
 
     def __repr__(self):
         return "Model object"
 
     def add_site(self, site: 'Site'):
+        if site.name in self._evicted:
+            site.restore(*self._evicted.pop(site.name))
         self.sites[site.name] = site
+        self.memory_usage += site.memory_usage
 
     def site(self, domain: Domain):
-        return self.sites[domain]
+        site = self.sites[domain]
+        self.sites.move_to_end(domain)
+        return site
+
+    def add_page(self, page: 'Page') -> 'Site':
+        """Adds the page to its site, creating the site if needed, and returns the site"""
+
+        if page.domain not in self.sites:
+            self.add_site(Site(page.domain))
+        site = self.site(page.domain)
+        memory_usage = site.memory_usage
+        site.add_page(page)
+        self.memory_usage += site.memory_usage - memory_usage
+        return site
+
+    def release(self, page: 'Page'):
+        """Called once the page has been archived: in compact mode, replaces it by a summary and evicts sites if the
+        memory budget is exceeded"""
+
+        if not self.compact:
+            return
+        site = page.site
+        memory_usage = site.memory_usage
+        site.compact_page(page)
+        self.memory_usage += site.memory_usage - memory_usage
+        if self.max_memory is not None and self.memory_usage > self.max_memory:
+            self.evict()
+
+    def evict(self):
+        """Evicts least recently used inactive sites until memory usage fits in max_memory"""
+
+        for domain in list(self.sites):
+            if self.memory_usage <= self.max_memory:
+                break
+            site = self.sites[domain]
+            if site.n_active:
+                continue
+            del self.sites[domain]
+            self.memory_usage -= site.memory_usage
+            self._evicted[domain] = (site.n_pages, site.max_deepness)
+            logging.debug('Evicted {} from model'.format(site))
 
 
 class Site:
@@ -50,6 +135,16 @@ class Site:
     def __init__(self, name: str):
         self.name = name
         self.pages = []
+        self.n_active = 0
+        self.memory_usage = sys.getsizeof(name)
+        self._internal_links = set()
+        self._external_links = set()
+        self._n_pages = 0
+        self._max_deepness = 0
+        self.n_enqueued_urls = 0
+        self.n_rejected_urls = 0
+        self.n_deprioritised_urls = 0
+        self.n_duplicates = 0
 
     def __repr__(self):
         return "Site object: " + self.name
@@ -67,39 +162,88 @@ class Site:
 
     @property
     def n_pages(self) -> int:
-        return len(self.pages)
+        return self._n_pages
 
     @property
     def external_links(self) -> Urls:
-        return list(set(link for page in self.pages for link in page.external_links))
+        return list(self._external_links)
 
     @property
     def internal_links(self) -> Urls:
-        return list(set(link for page in self.pages for link in page.internal_links))
+        return list(self._internal_links)
+
+    @property
+    def n_external_links(self) -> int:
+        return len(self._external_links)
+
+    @property
+    def n_internal_links(self) -> int:
+        return len(self._internal_links)
+
+    @property
+    def links_ratio(self) -> float:
+        """Ratio between internal and external links, used to detect sites which never link outside"""
+        return self.n_internal_links / (self.n_external_links + 1)
 
     @property
     def max_deepness(self) -> int:
-        return max(page.deepness for page in self.pages)
+        return self._max_deepness
+
+    @property
+    def duplicate_ratio(self) -> float:
+        """Part of the site pages which duplicate another page"""
+        return self.n_duplicates / self.n_pages if self.n_pages >= DUPLICATES_MIN_PAGES else 0.
 
     def add_page(self, page: 'Page'):
+        """Adds the page to the site and updates the site links with the page ones"""
         self.pages.append(page)
+        self.n_active += 1
+        self._n_pages += 1
+        self._max_deepness = max(self._max_deepness, page.deepness)
+        self.memory_usage += self._add_links(self._internal_links, page.internal_links)
+        self.memory_usage += self._add_links(self._external_links, page.external_links)
+
+    @staticmethod
+    def _add_links(links: set, new_links: Urls) -> int:
+        """Adds new_links to links and returns the approximate memory used by the new ones"""
+        size = 0
+        for link in new_links:
+            if link not in links:
+                links.add(link)
+                size += sys.getsizeof(link) + SET_ENTRY_SIZE
+        return size
+
+    def compact_page(self, page: 'Page'):
+        """Replaces the given page by its summary"""
+        for i in range(len(self.pages) - 1, -1, -1):
+            if self.pages[i] is page:
+                self.pages[i] = PageSummary(page)
+                self.n_active -= 1
+                self.memory_usage += PAGE_SUMMARY_SIZE + sys.getsizeof(page.url)
+                page.release()
+                break
+
+    def restore(self, n_pages: int, max_deepness: int):
+        """Restores the counters of a site previously evicted from the model"""
+        self._n_pages += n_pages
+        self._max_deepness = max(self._max_deepness, max_deepness)
 
     def to_dict(self):
-        return {'name': self.name, 'external_links': self.external_links}
+        return {'name': self.name, 'external_links': self.external_links, 'n_rejected_urls': self.n_rejected_urls,
+                'n_deprioritised_urls': self.n_deprioritised_urls, 'n_duplicates': self.n_duplicates}
 
 
 class Page:
     """Class which represents a web page"""
 
-    def __init__(self, model: Model, url: Url, response: 'Response'):
+    def __init__(self, model: Model, url: Url, response: 'Response', parsed: Dict = None):
+        """parsed is the result of extractors.parse_page, if the page has already been parsed elsewhere"""
         self.url = url
         self._response = response
         self._soup = None
+        self._parsed = parsed
         self._model = model
-        if self.domain not in model.sites:
-            model.add_site(Site(self.domain))
-        self.site = model.site(self.domain)
-        self.site.add_page(self)
+        self.site = model.add_page(self)
 
     def __repr__(self):
         return "Page object: " + self.url
@@ -122,9 +266,16 @@ class Page:
             self._soup = BeautifulSoup(self._response.text, 'html.parser')
         return self._soup
 
+    @property
+    def parsed(self) -> Dict:
+        """Title and links of the page, see extractors.parse_page"""
+        if self._parsed is None:
+            self._parsed = parse_page(self.text, self.url)
+        return self._parsed
+
     @property
     def title(self) -> str:
-        return self.soup.title.string
+        return self.parsed['title']
 
     @property
     def is_empty(self) -> bool:
@@ -145,47 +296,26 @@ class Page:
 
     @property
     def scheme(self) -> str:
-        if self.url.startswith('http://'):
-            return 'http://'
-        elif self.url.startswith('https://'):
-            return 'https://'
-        else:
-            raise ValueError('Unknow protocol for page {}'.format(self.url))
+        return url_scheme(self.url)
 
     @property
     def external_links(self) -> Urls:
         """Finds all links that start with "http" or "https" that do not contain the page domain"""
 
-        external_urls = set()
-        for link in self.soup.find_all(
-                "a", href=re.compile(r"^(?:http://|https://)(?!" + re.escape(self.domain) + ").*$")):
-            if link.attrs['href'] is not None:
-                link = link.attrs['href']
-                if link not in external_urls:
-                    external_urls.add(link)
-        return list(external_urls)
+        return self.parsed['external_links']
 
     @property
     def parent_urls(self) -> Urls:
         """e.g ['www.google.com', 'www.google.com/bonjour', 'www.google.com/bonjour/hello'] for
         www.google.com/bonjour/hello/lol"""
 
-        parts = self.raw_url.split('/')
-        return list('/'.join(parts[:i]) for i in range(1, len(parts)))
+        return self.parsed['parent_urls']
 
     @property
     def internal_links(self) -> Urls:
         """Finds all urls that begin with a "/" or which contain the page url"""
 
-        internal_links = set()
-        for link in self.soup.find_all("a", href=re.compile(r"^/(?!/)|.*" + re.escape(self.domain))):
-            if link.attrs['href'] is not None:
-                ref = link.attrs['href']
-                url = self.scheme + self.domain + ref if ref.startswith('/') else ref
-                url = url.strip('/')
-                if url not in internal_links:
-                    internal_links.add(url)
-        return list(internal_links)
+        return self.parsed['internal_links']
 
     @property
     def iter_forms(self) -> Iterable['Form']:
@@ -193,8 +323,36 @@ class Page:
         pass
 
     def to_dict(self) -> Dict:
-        return {'url': self.url, 'text': str(self.soup), 'site': self.domain, 'external_links': self.external_links,
-                'internal_links': self.internal_links}
+        return {'_id': self.url, 'url': self.url, 'text': self.text, 'site': self.domain,
+                'external_links': self.external_links, 'internal_links': self.internal_links,
+                'content_hash': self.parsed['content_hash'], 'simhash': '{:016x}'.format(self.parsed['simhash'])}
+
+    def to_reference_dict(self, duplicate_of: Url) -> Dict:
+        """Document stored instead of to_dict for a page whose content duplicates the one of another page"""
+        return {'_id': self.url, 'url': self.url, 'site': self.domain, 'duplicate_of': duplicate_of,
+                'content_hash': self.parsed['content_hash']}
+
+    def release(self):
+        """Frees the response and the parsed tree, the page must not be used afterwards"""
+        self._response = None
+        self._soup = None
+        self._parsed = None
+
+
+class PageSummary:
+    """Class which represents an archived web page, keeping only what the model needs"""
+
+    __slots__ = ('url', 'deepness', 'status', 'n_internal_links', 'n_external_links')
+
+    def __init__(self, page: Page):
+        self.url = page.url
+        self.deepness = page.deepness
+        self.status = page.status
+        self.n_internal_links = len(page.internal_links)
+        self.n_external_links = len(page.external_links)
+
+    def __repr__(self):
+        return "PageSummary object: " + self.url
 
 
 class Form:
@@ -228,33 +386,120 @@ class Response:
 class TorSpider:
     """Class to crawl Tor"""
 
-    def __init__(self, n_tasks: int = 100):
+    def __init__(self, n_tasks: int = 100, compact: bool = False, max_memory: int = None, parse_workers: int = 0,
+                 extractor: str = DEFAULT_BACKEND, bloom_capacity: int = 0, bloom_error_rate: float = 0.001,
+                 max_per_host: int = 2, host_delay: float = 1.0, max_queued: int = 10 ** 6,
+                 socks_endpoints: Iterable = (('127.0.0.1', 9150),), pool_limit: int = 1000,
+                 pool_limit_per_host: int = 8, dns_cache_ttl: int = 300, keepalive_timeout: float = 30.,
+                 max_bytes: int = 2 * 1024 ** 2, truncate: bool = True, archive_buffer: int = 1000,
+                 archive_flush_size: int = 100, archive_flush_interval: float = 5., compression: str = None,
+                 duplicate_distance: int = 3, max_duplicate_ratio: float = 0.8, lease_time: float = 300.,
+                 checkpoint_interval: float = 60., redis_address: tuple = ('localhost', 6389),
+                 shard: ShardRouter = None, revisit: bool = False, revisit_interval: float = 24 * 3600.,
+                 timeout: float = 20., max_retries: int = 2, metrics: Metrics = None, metrics_port: int = None,
+                 metrics_path: str = None, metrics_interval: float = 10., resolver=None, state: StateBackend = None,
+                 storage: ArchiveBackend = None, graph: LinkGraph = None, graph_path: str = None,
+                 graph_interval: float = 600., discovery: bool = False, n_buckets: int = 8, robots: bool = False,
+                 robots_ttl: float = 24 * 3600., max_sitemaps: int = 10, max_sitemap_urls: int = 50000):
         self.n_tasks = n_tasks
-        self.external_links_queue = asyncio.Queue()
-        self.internal_links_queue = asyncio.Queue()
-
-        self.model = Model()
-        self.coll = motor.motor_asyncio.AsyncIOMotorClient()['test']['crawls']
-        self.bulk = []
-        self.bulk_size = 10
+        self.extractor = extractor
+        self.parse_executor = ProcessPoolExecutor(parse_workers) if parse_workers else None
+        if graph is None and (graph_path or discovery):
+            # the discovery scorer only needs the sites, the page links are kept when the graph is exported
+            graph = LinkGraph(graph_path, pages=bool(graph_path))
+        self.graph = graph
+        self.graph_path = graph_path
+        self.graph_interval = graph_interval
+        self.scorer = DiscoveryScorer(graph, n_buckets) if discovery else None
+        self.frontier = HostScheduler(max_per_host=max_per_host, min_delay=host_delay, max_size=max_queued,
+                                      n_priorities=n_buckets if discovery else 3)
+        self.shard = shard
+        self.metrics = metrics or Metrics()
+        self.checkpoint = FrontierCheckpoint(self.frontier, lease_time=lease_time, interval=checkpoint_interval,
+                                             name='frontier:' + shard.name if shard else 'frontier',
+                                             owns=shard.owns if shard else None, metrics=self.metrics)
+        self.spill = FrontierSpill(self.frontier, key=self.checkpoint.name + ':spill')
+        self.revisits = RevisitScheduler(initial_interval=revisit_interval,
+                                         name='revisit:' + shard.name if shard else 'revisit') if revisit else None
+        self._background = []
+        self._tasks = []
+        self.robots = RobotsCache(ttl=robots_ttl) if robots else None
+        self.max_sitemaps = max_sitemaps
+        self.max_sitemap_urls = max_sitemap_urls
+        self._sitemap_tasks = set()
+        self.trap_scorer = TrapScorer()
+        self.hosts = HostTracker(max_timeout=timeout, max_retries=max_retries)
+        self._attempts = {}
+        self.duplicates = DuplicateIndex(max_distance=duplicate_distance)
+        self.max_duplicate_ratio = max_duplicate_ratio
+        self.connector_options = connector_options(pool_limit, pool_limit_per_host, dns_cache_ttl, keepalive_timeout,
+                                                   resolver)
+        self.circuits = CircuitPool(socks_endpoints, connector_options=self.connector_options)
+        self.std_session = None
+        self.max_bytes = max_bytes
+        self.truncate = truncate
+        self.seen_filter = BloomFilter(bloom_capacity, bloom_error_rate) if bloom_capacity else None
+
+        self.model = Model(compact=compact, max_memory=max_memory)
+        self.state = state if state is not None else RedisState(redis_address)
+        self.storage = storage if storage is not None else \
+            MongoArchive(motor.motor_asyncio.AsyncIOMotorClient()['test']['crawls'])
+        self.metrics_port = metrics_port
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self._metrics_server = None
+        self.archive = ArchiveWriter(self.storage, max_buffer=archive_buffer, flush_size=archive_flush_size,
+                                     flush_interval=archive_flush_interval, compression=compression,
+                                     metrics=self.metrics)
+        self.register_gauges()
 
         self.r_pool = None
 
     def __str__(self):
         return 'TorSpider object'
 
+    def register_gauges(self):
+        frontier = self.frontier
+        self.metrics.gauge('frontier_urls', 'Urls waiting in the frontier', label='priority',
+                           function=lambda: {priority: frontier.qsize(priority)
+                                             for priority in range(frontier.n_priorities)})
+        self.metrics.gauge('host_in_flight', 'Urls being crawled by host', label='host',
+                           function=lambda: dict(frontier._in_flight))
+        self.metrics.gauge('archive_buffer', 'Documents waiting to be archived', function=self.archive.qsize)
+        self.metrics.gauge('open_breakers', 'Hosts whose breaker is open', function=lambda: self.hosts.n_open)
+        self.metrics.gauge('sites', 'Sites in the model', function=lambda: len(self.model.sites))
+        self.metrics.gauge('model_memory_bytes', 'Estimated memory of the model',
+                           function=lambda: self.model.memory_usage)
+        if self.graph is not None:
+            self.metrics.gauge('graph_links', 'Links in the link graph', function=lambda: len(self.graph.pages))
+            self.metrics.gauge('graph_sites', 'Sites in the link graph', function=lambda: len(self.graph.domains))
+        self.rates = RateMeter(self.metrics)
+
+    def update_rates(self):
+        fetches = self.metrics.counter('fetches_total')
+        self.rates.update({'pages_per_second': self.metrics.counter('pages_total')},
+                          {'error_rate': (self.metrics.counter('fetch_errors_total'), fetches)})
+
     def feed(self, urls: Urls):
         """Setup staring urls for crawling"""
 
         for link in urls:
-            self.external_links_queue.put_nowait(link)
+            self.frontier.put_nowait(link, EXTERNAL)
+
+    def enqueue(self, url: Url, priority: int):
+        """Adds a new url to the frontier, or to the spill set in Redis if the frontier is full"""
+
+        if not self.frontier.put_nowait(url, priority):
+            self.spill.put(url, priority)
 
     @staticmethod
     def url_to_domain(url: Url) -> Domain:
         return url.replace('http://', '').replace('https://', '').split('/')[0]
 
-    @staticmethod
-    async def get(session: aiohttp.ClientSession, url: Url) -> Response:
+    async def get(self, session: aiohttp.ClientSession, url: Url, extra_headers: Dict[str, str] = None,
+                  timeout: float = 20.) -> Response:
+        """Fetches the url, reading at most max_bytes of the body. Raises ResponseSkipped for non html responses, and
+        for responses larger than max_bytes unless truncate is set"""
 
         headers = {
             'Connection': 'keep-alive',
@@ -265,22 +510,99 @@ class TorSpider:
             'Accept-Language': 'en-US,en;q=0.8',
             'Accept-Encoding': 'gzip, deflate, sdch',
         }
+        if extra_headers:
+            headers.update(extra_headers)
 
-        with async_timeout.timeout(20):
+        with async_timeout.timeout(timeout):
             async with session.get(url, headers=headers) as resp:
+                content_type = resp.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type and content_type not in HTML_CONTENT_TYPES:
+                    raise ResponseSkipped('content_type')
+                length = resp.headers.get('Content-Length', '')
+                if not self.truncate and length.isdigit() and int(length) > self.max_bytes:
+                    raise ResponseSkipped('too_large')
+                body = bytearray()
+                # one byte more than max_bytes tells a body too large from one of exactly max_bytes
+                while len(body) <= self.max_bytes:
+                    chunk = await resp.content.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    body.extend(chunk)
+                if len(body) > self.max_bytes:
+                    if not self.truncate:
+                        raise ResponseSkipped('too_large')
+                    logging.debug('Truncated {} to {} bytes'.format(url, self.max_bytes))
+                    del body[self.max_bytes:]
+                self.metrics.histogram('response_bytes', 'Size of the response bodies', SIZE_BUCKETS).observe(len(body))
                 r = Response(resp.status, resp.headers)
-                r.text = await resp.text()
+                r.text = self.decode(body, resp.charset)
                 return r
 
-    async def archive_page(self, page: Page):
-        """Archives the given page in MongoDB"""
-
-        self.bulk.append(page.to_dict())
-        if len(self.bulk) == self.bulk_size:
-            await self.coll.insert(self.bulk)
-            count = await self.coll.count()
-            logging.debug('Inserted {} new documents in database'.format(count))
-            self.bulk = []
+    @staticmethod
+    def decode(body: bytes, charset: str = None) -> str:
+        try:
+            return body.decode(charset or 'utf-8', errors='replace')
+        except LookupError:
+            return body.decode('utf-8', errors='replace')
+
+    def link_priority(self, url: Url, site: Site, priority: int) -> int:
+        """Returns the frontier priority of the url given its trap score, or None if it must not be crawled. The
+        rejected and deprioritised urls are counted on the site."""
+
+        score = self.trap_scorer.score(url, site)
+        if score >= self.trap_scorer.reject_score:
+            if site is not None:
+                site.n_rejected_urls += 1
+            return None
+        if score >= self.trap_scorer.deprioritise_score:
+            if site is not None:
+                site.n_deprioritised_urls += 1
+            return DEPRIORITISED
+        return priority
+
+    def bucket_links(self, domain: Domain, priorities: Dict[Url, int]) -> Dict[Url, int]:
+        """Turns the priorities given by link_priority to urls found on the domain into frontier priorities: the
+        discovery buckets in discovery mode, the priorities themselves otherwise"""
+
+        if self.scorer is None:
+            return priorities
+        return {url: self.scorer.bucket(url, domain, priority) for url, priority in priorities.items()}
+
+    async def filter_new_urls(self, redis_cache, urls: Urls) -> Set[Url]:
+        """Adds the urls to the 'to_crawl' set and returns the ones which have never been seen, in one round trip to
+        Redis. Urls already in the seen filter are dropped without asking Redis."""
+
+        if self.seen_filter is not None:
+            urls = [url for url in urls if self.seen_filter.add(url)]
+        else:
+            urls = list(urls)
+        if not urls:
+            return set()
+        pipe = redis_cache.pipeline()
+        for url in urls:
+            pipe.sadd('to_crawl', url)
+        for url in urls:
+            pipe.sismember('crawled', url)
+        with self.metrics.time('redis_seconds', op='filter'):
+            results = await pipe.execute()
+        added, crawled = results[:len(urls)], results[len(urls):]
+        return {url for url, is_added, is_crawled in zip(urls, added, crawled) if is_added and not is_crawled}
+
+    async def parse(self, url: Url, response: Response) -> Dict:
+        """Parses the response with the spider extractor, in the parse executor if any"""
+
+        with self.metrics.time('parse_seconds'):
+            if not self.parse_executor:
+                return parse_page(response.text, url, self.extractor)
+            return await asyncio.get_event_loop().run_in_executor(self.parse_executor, parse_page, response.text,
+                                                                  url, self.extractor)
+
+    async def archive_page(self, page: Page, duplicate_of: Url = None):
+        """Archives the given page in MongoDB, waiting if the archive writer is late. Duplicate pages are stored as a
+        reference to the original one."""
+
+        with self.metrics.stage('archive'):
+            await self.archive.put(page.to_reference_dict(duplicate_of) if duplicate_of else page.to_dict())
 
     # async def explore(self, url: Url, max_depth: int=0):
     #     """Explore a given url"""
@@ -318,73 +640,405 @@ class TorSpider:
     #                     await self.archive_page(page)
     #                 await redis_cache.sadd('crawled', url)
 
+    async def connect(self):
+        if not self.r_pool:
+            self.r_pool = await self.state.open()
+
+    async def start(self, urls: Urls = (), restore_size: int = 1000):
+        """Restores the frontier from the last checkpoint and the 'to_crawl' set, feeding it with the given urls if
+        nothing was restored, then starts checkpointing it. A shard first joins the ring, and forwards the given urls
+        it does not own"""
+
+        await self.connect()
+        async with self.r_pool.get() as redis_cache:
+            if self.shard is not None:
+                await self.shard.join(redis_cache)
+            restored = await self.checkpoint.restore(redis_cache, restore_size)
+            if not restored and self.shard is not None:
+                priorities = await self.shard.forward(redis_cache, {url: EXTERNAL for url in urls})
+                urls = await self.filter_new_urls(redis_cache, list(priorities))
+        if not restored:
+            self.feed(urls)
+        self._background.append(asyncio.ensure_future(self._run_checkpoint()))
+        self._background.append(asyncio.ensure_future(self._run_spill()))
+        if self.graph is not None and self.graph_path:
+            self._background.append(asyncio.ensure_future(self._run_graph_export()))
+        if self.shard is not None:
+            self._background.append(asyncio.ensure_future(self._run_shard()))
+        if self.revisits is not None:
+            self._background.append(asyncio.ensure_future(self._run_revisits()))
+        if self.metrics_port:
+            self._metrics_server = await serve(self.metrics, port=self.metrics_port)
+        self._background.append(asyncio.ensure_future(self._run_metrics()))
+
+    async def _run_checkpoint(self):
+        async with self.r_pool.get() as redis_cache:
+            await self.checkpoint.run(redis_cache)
+
+    async def _run_spill(self):
+        async with self.r_pool.get() as redis_cache:
+            await self.spill.run(redis_cache)
+
+    async def _run_graph_export(self):
+        """Exports the graph every graph_interval seconds, so that a crash loses only the links found since"""
+
+        while True:
+            await asyncio.sleep(self.graph_interval)
+            try:
+                self.export_graph()
+            except Exception as exc:
+                logging.error('Could not export the graph: {}'.format(exc))
+
+    def export_graph(self):
+        self.graph.export(self.graph_path)
+        logging.info('Exported {} to {}'.format(self.graph, self.graph_path))
+
+    async def _run_metrics(self):
+        """Updates the rate gauges and writes the metrics to metrics_path, if any, every metrics_interval seconds"""
+
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self.update_rates()
+            if self.metrics_path:
+                write_json(self.metrics, self.metrics_path)
+
+    async def _run_revisits(self, interval: float = 60.):
+        """Adds the urls due for a revisit to the frontier, while it has room for them"""
+
+        async with self.r_pool.get() as redis_cache:
+            while True:
+                room = min(self.n_tasks, self.frontier.max_size - self.frontier.qsize())
+                urls = await self.revisits.due(redis_cache, room) if room > 0 else []
+                for url, priority in (await self.revisits.priorities(redis_cache, urls, INTERNAL)).items():
+                    self.enqueue(url, priority)
+                await asyncio.sleep(interval)
+
+    async def _run_shard(self):
+        """Adds the urls forwarded by the other shards to the frontier and sends heartbeats, until the shards are
+        asked to stop"""
+
+        async with self.r_pool.get() as redis_cache:
+            next_beat = 0
+            while True:
+                if time.monotonic() >= next_beat:
+                    if await self.shard.beat(redis_cache, self.crawl_stats()):
+                        logging.info('Shard {} stopping'.format(self.shard.name))
+                        self.stop()
+                        return
+                    next_beat = time.monotonic() + self.shard.heartbeat
+                priorities = await self.shard.receive(redis_cache, timeout=self.shard.heartbeat)
+                for url in await self.filter_new_urls(redis_cache, list(priorities)):
+                    self.enqueue(url, priorities[url])
+
+    def crawl_stats(self) -> Dict[str, int]:
+        stats = {'queued': self.frontier.qsize(), 'sites': len(self.model.sites), 'archived': self.archive.n_written}
+        if self.shard is not None:
+            stats['forwarded'] = self.shard.n_forwarded
+            stats['received'] = self.shard.n_received
+        return stats
+
+    def stop(self):
+        """Stops the crawling tasks, run then saves the frontier and closes the spider"""
+
+        for task in self._tasks:
+            task.cancel()
+
     async def crawl(self, tor_only=False):
         """
-        Get a new url from the Queue, crawls it, extracts external links, adds them to external links queue,
-        get internal links, adds them to internal links queue, store de page in database. If external links queue
-        is empty, crawls links from internal links queue until an external link is found
+        Get a new url from the frontier, crawls it, extracts external links and internal links, adds them to the
+        frontier, store de page in database. External links are crawled before internal ones, or the links most likely
+        to lead to new sites first in discovery mode, and the frontier spreads the fetches across hosts
         """
 
-        if not self.r_pool:
-            self.r_pool = await aioredis.create_pool(('localhost', 6389), minsize=5, maxsize=100)
-        conn = SocksConnector(proxy=aiosocks.Socks5Addr('127.0.0.1', 9150), proxy_auth=None, remote_resolve=True)
+        await self.connect()
+        if self.std_session is None:
+            self.std_session = aiohttp.ClientSession(connector=PooledConnector(**self.connector_options))
         async with self.r_pool.get() as redis_cache:
-            async with aiohttp.ClientSession() as std_session, aiohttp.ClientSession(connector=conn) as tor_session:
-                # while not (self.external_links_queue.empty() and self.internal_links_queue.empty()):
-                while 1:
-                    if not self.external_links_queue.empty():
-                        url = await self.external_links_queue.get()
-                    else:
-                        url = await self.internal_links_queue.get()
-                    if tor_only and not self.url_to_domain(url).endswith('.onion'):
-                        continue
-                    print(self.external_links_queue.qsize(), self.internal_links_queue.qsize(), url[:60])
-                    await redis_cache.srem('to_crawl', url)
-                    session = tor_session if self.url_to_domain(url).endswith('.onion') else std_session
-                    try:
-                        response = await self.get(session, url)
-                    except Exception as exc:
-                        await redis_cache.sadd('error', url)
-                        response = None
-                    if response:
-                        page = Page(self.model, url, response)
-                        if len(page.site.internal_links) / (len(page.site.external_links) + 1) >= 200:
-                            continue
-                        for new_url in page.internal_links + page.parent_urls:
-                            if await redis_cache.sadd('to_crawl', new_url) and not \
-                                    await redis_cache.sismember('crawled', new_url):
-                                await self.internal_links_queue.put(new_url)
-                        for new_url in page.external_links:
-                            if await redis_cache.sadd('to_crawl', new_url) and not \
-                                    await redis_cache.sismember('crawled', new_url):
-                                await self.external_links_queue.put(new_url)
-                        await self.archive_page(page)
-                    await redis_cache.sadd('crawled', url)
+            while 1:
+                url = await self.frontier.get()
+                try:
+                    await self.crawl_url(redis_cache, url, tor_only=tor_only)
+                finally:
+                    self.frontier.done(url)
         await self.r_pool.clear()
 
-    def run(self, n_tasks: int=20, tor_only=False):
-        """Starts the spider"""
+    def prioritise_links(self, page: Page) -> Dict[Url, int]:
+        """Returns the frontier priority of the canonical form of each link of the page, except the rejected ones"""
+
+        internal_priority = INTERNAL if page.site.duplicate_ratio <= self.max_duplicate_ratio else DEPRIORITISED
+        priorities = {}
+        for new_url in page.internal_links + page.parent_urls:
+            new_url = canonicalize(new_url, page.scheme)
+            if new_url and new_url not in priorities:
+                priorities[new_url] = self.link_priority(new_url, page.site, internal_priority)
+        for new_url in page.external_links:
+            new_url = canonicalize(new_url, page.scheme)
+            if new_url and new_url not in priorities:
+                site = self.model.sites.get(self.url_to_domain(new_url))
+                priorities[new_url] = self.link_priority(new_url, site, EXTERNAL)
+        return {new_url: priority for new_url, priority in priorities.items()
+                if priority is not None and (self.robots is None or self.robots.allowed(new_url))}
+
+    async def crawl_url(self, redis_cache, url: Url, tor_only=False):
+        """Crawls the given url, archives the page and adds its new links to the frontier"""
+
+        domain = self.url_to_domain(url)
+        if tor_only and not domain.endswith('.onion'):
+            return
+        priority = self.frontier.priority(url, INTERNAL)
+        if self.robots is not None and not await self.robots_allow(redis_cache, url):
+            pipe = redis_cache.pipeline()
+            pipe.srem('to_crawl', url)
+            pipe.sadd('disallowed', url)
+            await pipe.execute()
+            return
+        # last check before the fetch: allow lets a single probe through a half open breaker, which only the result
+        # of the fetch closes or opens again
+        if not self.hosts.allow(domain):
+            # the breaker of the host opened while the url was queued
+            self.frontier.park(domain, self.hosts.parked_for(domain))
+            self.enqueue(url, priority)
+            return
+        logging.debug('Crawling {}'.format(url))
+        await self.checkpoint.lease(redis_cache, url)
+        attempt = self._attempts.pop(url, 0)
+        validators = await self.revisits.validators(redis_cache, url) if self.revisits is not None else {}
+        circuit = self.circuits.circuit(domain) if domain.endswith('.onion') else None
+        start = time.monotonic()
+        ok = True
+        result = 'ok'
+        try:
+            with self.metrics.stage('get'):
+                response = await self.get(circuit.session if circuit else self.std_session, url,
+                                          RevisitScheduler.conditional_headers(validators),
+                                          self.hosts.timeout(domain, attempt))
+            ok = response.status_code < 500
+            result = '{}xx'.format(response.status_code // 100)
+        except ResponseSkipped as exc:
+            await redis_cache.sadd('skipped:' + exc.reason, url)
+            response = None
+            result = 'skipped'
+        except Exception as exc:
+            response = None
+            ok = False
+            result = type(exc).__name__
+        latency = time.monotonic() - start
+        self.metrics.counter('fetches_total', 'Fetches by result').inc(result=result)
+        self.metrics.histogram('fetch_seconds', 'Fetch latency').observe(latency)
+        if not ok:
+            self.metrics.counter('fetch_errors_total', 'Failed fetches').inc()
+        if circuit:
+            self.circuits.report(circuit, latency, ok=ok)
+        self.hosts.record(domain, latency, ok=ok)
+        if not ok:
+            self.frontier.park(domain, self.hosts.parked_for(domain))
+            if self.hosts.should_retry(attempt):
+                # the url keeps its lease until the retry
+                self._attempts[url] = attempt + 1
+                asyncio.get_event_loop().call_later(self.hosts.backoff(attempt), self.enqueue, url, priority)
+                return
+            await redis_cache.sadd('error', url)
+            response = None
+        if response and response.status_code == 304 and self.revisits is not None:
+            await self.revisits.update(redis_cache, url, validators, response.status_code, response.headers,
+                                       priority=priority)
+            response = None
+        if response:
+            with self.metrics.stage('page'):
+                page = Page(self.model, url, response, await self.parse(url, response))
+            self.metrics.counter('pages_total', 'Parsed pages').inc()
+            if page.site.links_ratio >= 200:
+                self.model.release(page)
+                await self.checkpoint.release(redis_cache, url, crawled=False)
+                return
+            if self.revisits is not None and not await self.revisits.update(
+                    redis_cache, url, validators, response.status_code, response.headers, page.parsed['content_hash'],
+                    priority):
+                # same content as on the previous visit, whose links have already been followed
+                self.model.release(page)
+                await self.checkpoint.release(redis_cache, url)
+                return
+            duplicate_of = self.duplicates.check(url, page.parsed['content_hash'], page.parsed['simhash'])
+            if duplicate_of == url:
+                # the page changed a little since the previous visit
+                duplicate_of = None
+            if duplicate_of:
+                # an exact or near copy, whose links have been followed from the original one
+                page.site.n_duplicates += 1
+                await self.archive_page(page, duplicate_of)
+                self.model.release(page)
+                await self.checkpoint.release(redis_cache, url)
+                return
+            with self.metrics.stage('links'):
+                priorities = self.bucket_links(page.domain, self.prioritise_links(page))
+                if self.scorer is not None:
+                    self.scorer.page_crawled(page.domain, priorities)
+                if self.graph is not None:
+                    self.graph.add_page(url, priorities)
+            if self.shard is not None:
+                priorities = await self.shard.forward(redis_cache, priorities)
+            new_urls = await self.filter_new_urls(redis_cache, list(priorities))
+            for new_url in new_urls:
+                self.enqueue(new_url, priorities[new_url])
+                if self.url_to_domain(new_url) == page.domain:
+                    page.site.n_enqueued_urls += 1
+            await self.archive_page(page)
+            self.model.release(page)
+        await self.checkpoint.release(redis_cache, url)
+
+    def session(self, domain: Domain) -> aiohttp.ClientSession:
+        return self.circuits.circuit(domain).session if domain.endswith('.onion') else self.std_session
+
+    async def fetch_robots(self, domain: Domain):
+        """Returns the status and the text of the robots.txt of the domain"""
+
+        with async_timeout.timeout(self.hosts.timeout(domain)):
+            async with self.session(domain).get('http://{}/robots.txt'.format(domain)) as resp:
+                return resp.status, self.decode(await resp.content.read(512 * 1024), resp.charset)
+
+    async def robots_allow(self, redis_cache, url: Url) -> bool:
+        """Returns whether the robots.txt of its host lets the url be crawled. The robots.txt is fetched on the first
+        url of a host, its sitemaps are then ingested in the background, and its crawl delay is applied to the host."""
+
+        domain = self.url_to_domain(url)
+        rules, fetched = await self.robots.rules(redis_cache, domain, self.fetch_robots)
+        if fetched:
+            task = asyncio.ensure_future(self.ingest_sitemaps(domain, rules.sitemaps))
+            self._sitemap_tasks.add(task)
+            task.add_done_callback(self._sitemap_tasks.discard)
+        if rules.crawl_delay:
+            self.frontier.park(domain, min(rules.crawl_delay, 60.))
+        return rules.allowed(url)
+
+    async def ingest_sitemaps(self, domain: Domain, sitemaps: Urls = (), batch_size: int = 1000):
+        """Adds the urls of the sitemaps of the domain to the frontier, /sitemap.xml if its robots.txt lists none. The
+        sitemaps are parsed while they are received, and their urls added by batches."""
+
+        queue = list(sitemaps) or ['http://{}/sitemap.xml'.format(domain)]
+        done = set()
+        n_urls = 0
+        async with self.r_pool.get() as redis_cache:
+            while queue and len(done) < self.max_sitemaps and n_urls < self.max_sitemap_urls:
+                sitemap = queue.pop(0)
+                if sitemap in done or self.url_to_domain(sitemap) != domain:
+                    continue
+                done.add(sitemap)
+                parser = SitemapParser(self.max_sitemap_urls - n_urls)
+                urls = []
+                try:
+                    with async_timeout.timeout(self.hosts.max_timeout * 3):
+                        async with self.session(domain).get(sitemap) as resp:
+                            if resp.status != 200:
+                                continue
+                            while True:
+                                chunk = await resp.content.read(CHUNK_SIZE)
+                                urls.extend(parser.close() if not chunk else parser.feed(chunk))
+                                if len(urls) >= batch_size or not chunk:
+                                    n_urls += await self.add_sitemap_urls(redis_cache, domain, urls)
+                                    urls = []
+                                if not chunk:
+                                    break
+                except Exception as exc:
+                    logging.debug('Could not fetch the sitemap {}: {}'.format(sitemap, exc))
+                    continue
+                queue.extend(parser.sitemaps)
+        if n_urls:
+            logging.info('Added {} urls from the sitemaps of {}'.format(n_urls, domain))
+
+    async def add_sitemap_urls(self, redis_cache, domain: Domain, urls: Urls) -> int:
+        """Adds the new urls of the domain listed in a sitemap to the frontier, returns their number"""
+
+        site = self.model.sites.get(domain)
+        priorities = {}
+        for url in urls:
+            url = canonicalize(url)
+            if url and self.url_to_domain(url) == domain and self.robots.allowed(url):
+                priority = self.link_priority(url, site, INTERNAL)
+                if priority is not None:
+                    priorities[url] = priority
+        priorities = self.bucket_links(domain, priorities)
+        if self.shard is not None:
+            priorities = await self.shard.forward(redis_cache, priorities)
+        new_urls = await self.filter_new_urls(redis_cache, list(priorities))
+        for url in new_urls:
+            self.enqueue(url, priorities[url])
+        self.metrics.counter('sitemap_urls_total', 'Urls added from sitemaps').inc(len(new_urls))
+        return len(new_urls)
+
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        """Connection pool statistics of the clear web session and of every Tor circuit"""
+
+        stats = {circuit.name: circuit.pool_stats for circuit in self.circuits.circuits.values()}
+        if self.std_session is not None:
+            stats['clearnet'] = self.std_session.connector.stats
+        return stats
+
+    async def close(self):
+        """Saves the frontier, flushes the archive and closes the shared sessions"""
+
+        for task in self._background + list(self._sitemap_tasks):
+            task.cancel()
+        self._background = []
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            self._metrics_server = None
+        if self.r_pool:
+            async with self.r_pool.get() as redis_cache:
+                await self.spill.flush(redis_cache)
+                await self.checkpoint.save(redis_cache)
+                if self.shard is not None:
+                    await self.shard.leave(redis_cache)
+            await self.state.close()
+            self.r_pool = None
+        await self.archive.close()
+        if self.graph is not None and self.graph_path:
+            self.export_graph()
+        logging.info('Connection pools: {}'.format(self.pool_stats()))
+        if self.std_session is not None:
+            await self.std_session.close()
+            self.std_session = None
+        await self.circuits.close()
+
+    async def run_crawl(self, n_tasks: int = 20, tor_only=False, urls: Urls = ()):
+        """Coroutine version of run, for a spider sharing its event loop, e.g an in-process shard"""
+
+        await self.start(urls, restore_size=n_tasks)
+        self._tasks = [asyncio.ensure_future(self.crawl(tor_only=tor_only)) for _ in range(n_tasks)]
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.close()
+
+    def run(self, n_tasks: int=20, tor_only=False, urls: Urls = ()):
+        """Starts the spider, from the saved frontier if any, otherwise from the given urls"""
 
         loop = asyncio.get_event_loop()
-        tasks = [asyncio.ensure_future(self.crawl(tor_only=tor_only)) for _ in range(n_tasks)]
-        loop.run_until_complete(asyncio.gather(*tasks))
+        loop.run_until_complete(self.start(urls, restore_size=n_tasks))
+        self._tasks = [asyncio.ensure_future(self.crawl(tor_only=tor_only)) for _ in range(n_tasks)]
+        try:
+            loop.run_until_complete(asyncio.gather(*self._tasks))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.run_until_complete(self.close())
+            if self.parse_executor:
+                self.parse_executor.shutdown()
+            if self.seen_filter is not None:
+                logging.info('Seen filter: {} urls in {} bytes, estimated false positive rate {:.2e}'.format(
+                    len(self.seen_filter), self.seen_filter.size, self.seen_filter.false_positive_rate))
 
 
 def main():
     n_tasks = 1000
     # asyncio.get_event_loop().set_debug(True)
-    r_cache = redis.StrictRedis(port=6389)
-    urls = []
-    for _ in range(n_tasks):
-        url = r_cache.spop('to_crawl')
-        if url:
-            urls.append(url.decode('utf8'))
-    if not urls:
-        with open('tor_websites.txt') as file:
-            urls = [line.split(' ')[0] for line in file if line.startswith('http://')]
-    spider = TorSpider()
-    spider.feed(urls)
-    spider.run(n_tasks=n_tasks, tor_only=True)
+    with open('tor_websites.txt') as file:
+        urls = [line.split(' ')[0] for line in file if line.startswith('http://')]
+    spider = TorSpider(compact=True, max_memory=512 * 1024 ** 2, parse_workers=4, bloom_capacity=10 ** 7,
+                       max_per_host=4, host_delay=0.5, compression='zlib', metrics_port=9100, robots=True,
+                       socks_endpoints=[('127.0.0.1', 9150, 'circuit{}'.format(i), 'aiospider') for i in range(8)])
+    spider.run(n_tasks=n_tasks, tor_only=True, urls=urls)
 
     # http://underdj5ziov3ic7.onion/help/crawler/index.php/crawler/index.php/crawler/index.php/crawler/index.php/crawler/index.php/page/login/crawler/index.php/crawler/index.php/crawler/index.php/category/BOOKS/category/ITALIAN/crawler/index.php/crawler/index.php/crawler/index.php/help/category/SOCIAL/link/AcmjRPOqapvliz3krwh/link/lnxAly6G9FMYU0vUPsRo/link/AcmjRPOqapvliz3krwh/link/lnxAly6G9FMYU0vUPsRo/link/XoI3teoUrX5UKtsDrjPu/category/SOCIAL/pg/3/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/help/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/ijGwHWMYxEAX4KccxzA/link/uzuhvqOpVbAuzPRqzaUZ/category/INTRODUCTION_POINTS/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/category/GAMBLING_OTHER/category/ADULT/link/uzuhvqOpVbAuzPRqzaUZ/category/FORUMS/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/category/EROTICA/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/category/JAPANESE/link/uzuhvqOpVbAuzPRqzaUZ/category/OTHER_LANGUAGES/link/ijGwHWMYxEAX4KccxzA/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/link/uzuhvqOpVbAuzPRqzaUZ/category/GAMBLING_OTHER
     # http://underdj5ziov3ic7.onion/crawler/index.php
@@ -0,0 +1,85 @@
+"""
+Url canonicalisation and crawler traps detection
+"""
+
+import re
+from collections import Counter
+from typing import TYPE_CHECKING
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+if TYPE_CHECKING:
+    from tor_spider import Site  # tor_spider imports this module
+
+Url = str  # e.g: http://www.google.com/hello.php
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+_duplicate_slashes = re.compile(r'/{2,}')
+_other_scheme = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:(?!\d)')  # e.g mailto:, but not www.google.com:8080
+
+
+def canonicalize(url: Url, default_scheme: str = 'http://') -> Url:
+    """Returns the canonical form of the url, or None if it is not an http(s) url
+
+    The scheme and host are lowercased, default ports, fragments, duplicate and trailing slashes are removed and the
+    query parameters are sorted. Urls without scheme, like Page.parent_urls, get default_scheme.
+    """
+
+    url = url.strip()
+    if '://' not in url:
+        if _other_scheme.match(url):
+            return None
+        url = default_scheme + url
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+    netloc = parts.hostname
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc += ':{}'.format(port)
+    path = _duplicate_slashes.sub('/', parts.path).rstrip('/')
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def url_depth(url: Url) -> int:
+    """Same as Page.deepness: number of path segments of the url"""
+    return len(url.split('://', 1)[-1].split('/')) - 1
+
+
+class TrapScorer:
+    """Scores how likely an url leads into a crawler trap
+
+    Three signals are normalised so that 1 is the limit: the number of times a path segment is repeated (e.g
+    crawler/index.php/crawler/index.php/...) compared with max_repeats, the url depth compared with max_depth and the
+    growth rate of the site, i.e the number of new urls it produced per fetched page, compared with max_growth. The
+    score is the highest of them: urls scoring at least reject_score should not be crawled, the ones scoring at least
+    deprioritise_score should be crawled last.
+    """
+
+    def __init__(self, max_repeats: int = 3, max_depth: int = 15, max_growth: float = 100., min_pages: int = 10,
+                 reject_score: float = 1., deprioritise_score: float = 0.5):
+        self.max_repeats = max_repeats
+        self.max_depth = max_depth
+        self.max_growth = max_growth
+        self.min_pages = min_pages
+        self.reject_score = reject_score
+        self.deprioritise_score = deprioritise_score
+
+    def __repr__(self):
+        return 'TrapScorer object'
+
+    def score(self, url: Url, site: 'Site' = None) -> float:
+        segments = [segment for segment in urlsplit(url).path.split('/') if segment]
+        repeats = max(Counter(segments).values()) - 1 if segments else 0
+        score = max(repeats / self.max_repeats, url_depth(url) / self.max_depth)
+        if site is not None and site.n_pages >= self.min_pages:
+            score = max(score, site.n_enqueued_urls / site.n_pages / self.max_growth)
+        return score
+
+    def is_trap(self, url: Url, site: 'Site' = None) -> bool:
+        return self.score(url, site) >= self.reject_score